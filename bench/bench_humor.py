@@ -0,0 +1,67 @@
+"""
+Blocklist matching benchmark for humor_gate.
+
+Compares the old per-keyword loop (`any(k in text for k in keywords)`) with
+the compiled KeywordMatcher, per message and in batch mode, for growing
+blocklists. Also checks that all three agree.
+
+    python -m bench.bench_humor --messages 20000
+"""
+import argparse
+import random
+import string
+import time
+from typing import Callable, List, Tuple
+
+from src.humor_gate import KeywordMatcher
+
+
+def _word(rng: random.Random, lo: int = 4, hi: int = 10) -> str:
+    return "".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(lo, hi)))
+
+
+def _corpus(rng: random.Random, keywords: List[str], n: int) -> List[str]:
+    texts = []
+    for i in range(n):
+        words = [_word(rng, 2, 9) for _ in range(rng.randint(4, 30))]
+        if i % 20 == 0:
+            words.insert(rng.randrange(len(words)), rng.choice(keywords))
+        texts.append(" ".join(words))
+    return texts
+
+
+def _time(fn: Callable[[], List[bool]]) -> Tuple[float, List[bool]]:
+    started = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - started, result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--messages", type=int, default=20_000)
+    parser.add_argument("--sizes", default="10,100,1000,5000")
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    print(f"{args.messages} messages")
+    print(f"{'keywords':>9}{'loop ms':>10}{'compile ms':>12}{'matcher ms':>12}{'batch ms':>10}")
+    for size in (int(s) for s in args.sizes.split(",")):
+        keywords = sorted({_word(rng, 5, 12) for _ in range(size)})
+        texts = _corpus(rng, keywords, args.messages)
+
+        loop_s, expected = _time(lambda: [any(k in t for k in keywords) for t in texts])
+        started = time.perf_counter()
+        matcher = KeywordMatcher(keywords)
+        compile_s = time.perf_counter() - started
+        one_s, single = _time(lambda: [matcher.search(t) for t in texts])
+        batch_s, batch = _time(lambda: matcher.search_many(texts))
+        if single != expected or batch != expected:
+            raise SystemExit(f"mismatch with {size} keywords")
+        print(
+            f"{size:>9}{loop_s * 1000:>10.1f}{compile_s * 1000:>12.1f}"
+            f"{one_s * 1000:>12.1f}{batch_s * 1000:>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+"""
+End-to-end load test through the real aiogram handlers.
+
+Starts a stub Ollama (bench/stub_ollama.py) and the bot itself (src.__main__)
+with a fake Bot API session and a throwaway database, then replays chat
+traffic into the dispatcher the way polling does, `--concurrency` updates
+at a time, optionally paced to `--rate` per second. Traffic is synthetic
+group chatter with a share of replies to the bot, or the lines of a JSONL
+file: a "text" field, else "title" and "body" as in requests.jsonl, with
+optional "chat_id" and "reply".
+
+Reports throughput, p50/p99 latency of replies and of store-only messages,
+SQLite rows written and context builds per second, Ollama requests and
+peak RSS. Other settings come from the environment as usual
+(LLM_MAX_CONCURRENCY=2, RESPONSE_CACHE_ENABLED=1, ...).
+
+    python -m bench.bench_load --updates 2000 --chats 50 --reply-share 0.1
+    python -m bench.bench_load --replay requests.jsonl --json load.json
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import random
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+from bench.common import latency_summary, peak_rss_mb, table, write_report
+from bench.stub_ollama import StubOllama
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+
+
+def _texts(path: Optional[str], count: int, rng: random.Random) -> List[Dict[str, Any]]:
+    if not path:
+        words = "привет как дела что нового кто идёт вечером пицца кино работа погода".split()
+        return [
+            {"text": " ".join(rng.choice(words) for _ in range(rng.randint(3, 15))) + "?"}
+            for _ in range(count)
+        ]
+    items = []
+    with open(path, encoding="utf-8") as fh:
+        for line in fh:
+            if not line.strip():
+                continue
+            obj = json.loads(line)
+            text = obj.get("text") or ". ".join(x for x in (obj.get("title"), obj.get("body")) if x)
+            # Longer messages only get the handler's "too long" answer.
+            items.append({**obj, "text": text[:900]})
+    # Cycle through the file until `count` updates.
+    return [items[i % len(items)] for i in range(count)] if items else []
+
+
+def _updates(
+    items: List[Dict[str, Any]], chats: int, reply_share: float, rng: random.Random
+) -> List[Dict[str, Any]]:
+    updates = []
+    for i, item in enumerate(items):
+        chat_id = int(item.get("chat_id") or -1000 - rng.randrange(chats))
+        message: Dict[str, Any] = {
+            "message_id": i + 1,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "group"},
+            "from": {"id": 100 + rng.randrange(20), "is_bot": False, "first_name": "user"},
+            "text": item["text"],
+        }
+        reply = item.get("reply")
+        if reply if reply is not None else rng.random() < reply_share:
+            message["reply_to_message"] = {
+                "message_id": 0,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "group"},
+                "from": BOT_USER,
+                "text": "…",
+            }
+        updates.append({"update_id": i + 1, "message": message})
+    return updates
+
+
+async def _run(args: argparse.Namespace, data_dir: str) -> Dict[str, Any]:
+    stub = StubOllama(args.latency, args.tokens, args.tokens_per_second)
+    url = await stub.start()
+    # The bot reads its settings at import time.
+    os.environ.update(
+        TELEGRAM_FAKE="1", TELEGRAM_MODE="polling", DATA_DIR=data_dir, OLLAMA_ENDPOINT=url
+    )
+    os.environ.pop("MEMORY_DB_PATH", None)
+    os.environ.setdefault("SUMMARIZER", "heuristic")
+    os.environ.setdefault("MAINTENANCE_STARTUP_DELAY_SECONDS", "3600")
+    os.environ.setdefault("STREAM_EDIT_INTERVAL_SECONDS", "0.5")
+
+    bot_main = importlib.import_module("src.__main__")
+    from aiogram.types import Update
+    from src.ollama_client import OllamaError
+
+    main_task = asyncio.create_task(bot_main.main())
+    while True:
+        try:
+            bot_main.ollama.session
+            break
+        except OllamaError:
+            await asyncio.sleep(0.05)
+
+    rng = random.Random(args.seed)
+    raw = _updates(_texts(args.replay, args.updates, rng), args.chats, args.reply_share, rng)
+    updates = [Update.model_validate(u, context={"bot": bot_main.bot}) for u in raw]
+    latencies: Dict[str, List[float]] = {"reply": [], "store": []}
+    errors = 0
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def feed(update: Update) -> None:
+        nonlocal errors
+        kind = "reply" if update.message.reply_to_message else "store"
+        try:
+            started = time.perf_counter()
+            await bot_main.dp.feed_update(bot_main.bot, update)
+            latencies[kind].append(time.perf_counter() - started)
+        except Exception as e:
+            errors += 1
+            print(f"update {update.update_id}: {e!r}")
+        finally:
+            semaphore.release()
+
+    started = time.perf_counter()
+    tasks = []
+    for i, update in enumerate(updates):
+        if args.rate > 0:
+            delay = started + i / args.rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        await semaphore.acquire()
+        tasks.append(asyncio.create_task(feed(update)))
+    await asyncio.gather(*tasks)
+    await bot_main.astore.flush()
+    elapsed = time.perf_counter() - started
+
+    m = bot_main.metrics
+    written = m.flush_rows.value() or m.add_message.count()
+    builds = m.build_context.count(kind="reply") + m.build_context.count(kind="joke")
+    results = {
+        "updates": len(updates),
+        "seconds": elapsed,
+        "updates_per_second": len(updates) / elapsed,
+        "errors": errors,
+        "reply": latency_summary(latencies["reply"]),
+        "store": latency_summary(latencies["store"]),
+        "sqlite": {
+            "rows_written": written,
+            "rows_written_per_second": written / elapsed,
+            "context_builds": builds,
+            "context_builds_per_second": builds / elapsed,
+        },
+        "llm": {k: v for k, v in vars(bot_main.llm.stats).items()},
+        "ollama_requests": stub.stats.requests,
+        "ollama_models": dict(stub.stats.models),
+        "telegram_calls": len(bot_main.bot.session.calls),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    main_task.cancel()
+    try:
+        await main_task
+    except asyncio.CancelledError:
+        pass
+    await stub.stop()
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--updates", type=int, default=1000)
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--reply-share", type=float, default=0.1)
+    parser.add_argument("--replay", help="JSONL file with messages to replay")
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--rate", type=float, default=0.0, help="updates per second, 0 = unpaced")
+    parser.add_argument(
+        "--latency", type=float, default=0.2, help="stub Ollama time to first token"
+    )
+    parser.add_argument("--tokens", type=int, default=30)
+    parser.add_argument("--tokens-per-second", type=float, default=60.0)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        results = asyncio.run(_run(args, tmp))
+
+    print(
+        f"{results['updates']} updates in {results['seconds']:.2f} s "
+        f"({results['updates_per_second']:.0f}/s), errors {results['errors']}, "
+        f"peak RSS {results['peak_rss_mb']:.0f} MB"
+    )
+    rows = [{"path": k, **results[k]} for k in ("reply", "store")]
+    print(table(rows, ("path", "count", "p50_ms", "p90_ms", "p99_ms", "max_ms")))
+    sq = results["sqlite"]
+    print(
+        f"SQLite: {sq['rows_written_per_second']:.0f} rows/s written, "
+        f"{sq['context_builds_per_second']:.1f} context builds/s; "
+        f"Ollama requests {results['ollama_models']}, LLM jobs {results['llm']}"
+    )
+    if args.json:
+        write_report(args.json, "load", vars(args), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""
+Memory benchmark for history reads.
+
+Fills a throwaway database with one chat's day of messages and reads it back
+three ways:
+
+  legacy   sqlite3.Row -> dict -> dataclass per row (the old MessageRow path)
+  list     MemoryStore.get_messages_for_day (tuple-backed MessageRow)
+  stream   MemoryStore.iter_messages_for_day (rows yielded lazily)
+
+For each it reports wall time, peak traced memory, the retained size of the
+result and how many gen-0 GC collections the read triggered.
+
+    python -m bench.bench_memory --rows 200000
+"""
+import argparse
+import gc
+import os
+import sqlite3
+import tempfile
+import time
+import tracemalloc
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+from typing import Callable, Dict, List
+
+from src.memory_store import MemoryStore, MessageRow, compact_summarizer
+
+
+@dataclass
+class LegacyRow:
+    chat_id: str
+    msg_id: str
+    role: str
+    text: str
+    ts: float
+
+
+def _fill(store: MemoryStore, day: date, rows: int) -> None:
+    start = datetime.combine(day, datetime.min.time()).timestamp()
+    step = 86000 / rows
+    batch: List[MessageRow] = []
+    for i in range(rows):
+        role = "user" if i % 3 else "assistant"
+        batch.append(
+            MessageRow("bench", str(i), role, f"message {i} about topic{i % 50} here", start + i * step)
+        )
+        if len(batch) == 5000:
+            store.add_messages(batch)
+            batch = []
+    store.add_messages(batch)
+
+
+def _legacy_read(db_path: str, day: date) -> List[LegacyRow]:
+    start = datetime.combine(day, datetime.min.time()).timestamp()
+    end = start + 86400
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    try:
+        rows = conn.execute(
+            """
+            SELECT chat_id, msg_id, role, text, ts
+            FROM messages
+            WHERE chat_id = ? AND ts >= ? AND ts < ?
+            ORDER BY ts ASC
+            """,
+            ("bench", start, end),
+        ).fetchall()
+        return [LegacyRow(**dict(r)) for r in rows]
+    finally:
+        conn.close()
+
+
+def _measure(name: str, fn: Callable[[], object]) -> Dict[str, float]:
+    gc.collect()
+    gen0_before = gc.get_stats()[0]["collections"]
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - started
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    gen0 = gc.get_stats()[0]["collections"] - gen0_before
+    del result
+    return {
+        "name": name,
+        "seconds": elapsed,
+        "peak_mb": peak / 2**20,
+        "retained_mb": retained / 2**20,
+        "gc_gen0": gen0,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=100_000)
+    args = parser.parse_args()
+
+    day = date.today() - timedelta(days=1)
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "bench.sqlite")
+        store = MemoryStore(db_path)
+        _fill(store, day, args.rows)
+
+        def stream() -> str:
+            rows = store.iter_messages_for_day("bench", day)
+            try:
+                return compact_summarizer(rows)
+            finally:
+                rows.close()
+
+        def listed() -> str:
+            return compact_summarizer(store.get_messages_for_day("bench", day))
+
+        results = [
+            _measure("legacy", lambda: _legacy_read(db_path, day)),
+            _measure("list", lambda: store.get_messages_for_day("bench", day)),
+            _measure("legacy+summary", lambda: compact_summarizer(_legacy_read(db_path, day))),
+            _measure("list+summary", listed),
+            _measure("stream+summary", stream),
+        ]
+        store.close()
+
+    print(f"{args.rows} rows")
+    print(f"{'read':<16}{'sec':>8}{'peak MB':>10}{'kept MB':>10}{'gc gen0':>9}")
+    for r in results:
+        print(
+            f"{r['name']:<16}{r['seconds']:>8.3f}{r['peak_mb']:>10.1f}"
+            f"{r['retained_mb']:>10.1f}{r['gc_gen0']:>9}"
+        )
+
+
+if __name__ == "__main__":
+    main()
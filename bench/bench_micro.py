@@ -0,0 +1,228 @@
+"""
+Microbenchmarks of the per-message hot paths.
+
+Each case runs a small operation in a loop on a throwaway database filled
+with `--rows` messages over `--chats` chats and reports ops/s and µs/op:
+
+  estimate        HeuristicTokenEstimator on unseen texts (no LRU hits)
+  humor           should_add_humor with a blocklist
+  add_message     MemoryStore.add_message, one transaction each
+  add_messages    MemoryStore.add_messages, batches of 200
+  get_recent      MemoryStore.get_recent_messages (recent cache off)
+  search          MemoryStore.search (FTS5)
+  build_context   build_context with a token budget and keyword recall
+  vector_search   EmbeddingIndex.search over one chat's vectors
+  cache_lookup    ResponseCache.lookup, half hits
+  metrics         Histogram.observe with labels
+
+    python -m bench.bench_micro --rows 20000 --only build_context,search
+    python -m bench.bench_micro --json micro.json
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+from typing import Any, Callable, Dict, List
+
+import numpy as np
+
+from bench.common import table, write_report
+from src.context_pipeline import ContextConfig, PrefixCache, build_context
+from src.embedding_index import EmbeddingIndex
+from src.humor_gate import HumorConfig, should_add_humor
+from src.memory_store import MemoryStore, MessageRow
+from src.metrics import BotMetrics
+from src.response_cache import ResponseCache
+from src.token_estimate import HeuristicTokenEstimator
+
+WORDS = (
+    "привет как дела что нового кто идёт вечером пицца кино работа погода "
+    "deploy release bug fix server python model latency memory"
+).split()
+
+
+def _text(rng: random.Random, lo: int = 3, hi: int = 25) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(lo, hi)))
+
+
+def _measure(fn: Callable[[int], Any], ops: int, min_seconds: float) -> Dict[str, float]:
+    """Call fn(i) for i in 0..ops-1, repeating until min_seconds have passed."""
+    done = 0
+    started = time.perf_counter()
+    while True:
+        for i in range(ops):
+            fn(done + i)
+        done += ops
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_seconds:
+            break
+    return {"ops": done, "ops_per_second": done / elapsed, "us_per_op": elapsed / done * 1e6}
+
+
+def _fill(store: MemoryStore, chats: int, rows: int, rng: random.Random) -> None:
+    now = time.time()
+    batch: List[MessageRow] = []
+    for i in range(rows):
+        role = "assistant" if i % 5 == 4 else "user"
+        ts = now - (rows - i)
+        batch.append(MessageRow(str(-1000 - i % chats), f"m{i}", role, _text(rng), ts))
+        if len(batch) == 1000:
+            store.add_messages(batch)
+            batch = []
+    store.add_messages(batch)
+
+
+def _cases(args: argparse.Namespace, store: MemoryStore) -> Dict[str, Callable[[], Dict]]:
+    rng = random.Random(args.seed)
+    texts = [_text(rng) for _ in range(1000)]
+    chat_ids = [str(-1000 - i) for i in range(args.chats)]
+    ops = args.ops
+
+    def estimate() -> Dict:
+        estimator = HeuristicTokenEstimator(cache_size=0)
+        return _measure(
+            lambda i: estimator.count(texts[i % len(texts)] + str(i)), ops * 10, args.min_seconds
+        )
+
+    def humor() -> Dict:
+        cfg = HumorConfig(humor_rate=1.0, block_keywords=tuple(f"{w}*" for w in WORDS[:8]))
+        return _measure(
+            lambda i: should_add_humor(texts[i % len(texts)], None, cfg), ops * 10, args.min_seconds
+        )
+
+    def add_message() -> Dict:
+        now = time.time()
+        return _measure(
+            lambda i: store.add_message(chat_ids[0], f"a{i}", "user", texts[i % len(texts)], now),
+            ops,
+            args.min_seconds,
+        )
+
+    def add_messages() -> Dict:
+        now = time.time()
+
+        def batch(i: int) -> None:
+            store.add_messages(
+                MessageRow(chat_ids[1], f"b{i}-{j}", "user", texts[j % len(texts)], now)
+                for j in range(200)
+            )
+
+        result = _measure(batch, max(1, ops // 20), args.min_seconds)
+        result["rows_per_second"] = result["ops_per_second"] * 200
+        return result
+
+    def get_recent() -> Dict:
+        return _measure(
+            lambda i: store.get_recent_messages(chat_ids[i % len(chat_ids)], 40),
+            ops,
+            args.min_seconds,
+        )
+
+    def search() -> Dict:
+        return _measure(
+            lambda i: store.search(chat_ids[i % len(chat_ids)], texts[i % len(texts)], k=3),
+            ops,
+            args.min_seconds,
+        )
+
+    def build() -> Dict:
+        cfg = ContextConfig(max_prompt_tokens=3000, keyword_recall_k=3)
+        prefix_cache = PrefixCache()
+        return _measure(
+            lambda i: build_context(
+                chat_ids[i % len(chat_ids)], texts[i % len(texts)], store, cfg, prefix_cache
+            ),
+            ops,
+            args.min_seconds,
+        )
+
+    def vector_search() -> Dict:
+        dim = 384
+        index = EmbeddingIndex(store, dim=dim)
+        vrng = np.random.default_rng(args.seed)
+        now = time.time()
+        index.add(
+            [
+                (chat_ids[2], f"v{i}", now - i, vrng.standard_normal(dim).tolist())
+                for i in range(args.vectors)
+            ]
+        )
+        queries = [vrng.standard_normal(dim).tolist() for _ in range(100)]
+        return _measure(
+            lambda i: index.search(chat_ids[2], queries[i % len(queries)], 5), ops, args.min_seconds
+        )
+
+    def cache_lookup() -> Dict:
+        cache = ResponseCache(max_entries=10_000)
+        loop = asyncio.new_event_loop()
+        for i in range(0, len(texts), 2):
+            _, key = loop.run_until_complete(cache.lookup(chat_ids[0], texts[i], "fp"))
+            cache.store(key, "ответ")
+        try:
+            return _measure(
+                lambda i: loop.run_until_complete(
+                    cache.lookup(chat_ids[0], texts[i % len(texts)], "fp")
+                ),
+                ops,
+                args.min_seconds,
+            )
+        finally:
+            loop.close()
+
+    def metrics() -> Dict:
+        m = BotMetrics()
+        return _measure(
+            lambda i: m.reply.observe(0.001 * (i % 1000), source="llm"), ops * 10, args.min_seconds
+        )
+
+    return {
+        "estimate": estimate,
+        "humor": humor,
+        "add_message": add_message,
+        "add_messages": add_messages,
+        "get_recent": get_recent,
+        "search": search,
+        "build_context": build,
+        "vector_search": vector_search,
+        "cache_lookup": cache_lookup,
+        "metrics": metrics,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=20_000, help="messages in the database")
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--vectors", type=int, default=5000, help="embeddings for vector_search")
+    parser.add_argument("--ops", type=int, default=500, help="operations per timing round")
+    parser.add_argument("--min-seconds", type=float, default=0.5)
+    parser.add_argument("--only", default="", help="comma-separated case names")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = MemoryStore(os.path.join(tmp, "bench.sqlite"))
+        try:
+            _fill(store, args.chats, args.rows, random.Random(args.seed))
+            cases = _cases(args, store)
+            names = [n for n in args.only.split(",") if n] or list(cases)
+            unknown = [n for n in names if n not in cases]
+            if unknown:
+                raise SystemExit(f"unknown cases: {', '.join(unknown)}")
+            results = []
+            for name in names:
+                results.append({"name": name, **cases[name]()})
+        finally:
+            store.close()
+
+    print(f"{args.rows} messages in {args.chats} chats")
+    print(table(results, ("name", "ops", "ops_per_second", "us_per_op")))
+    if args.json:
+        write_report(args.json, "micro", vars(args), results)
+
+
+if __name__ == "__main__":
+    main()
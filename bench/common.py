@@ -0,0 +1,92 @@
+"""
+Helpers shared by the benchmarks: percentiles, peak RSS and a JSON report
+that carries the commit it was measured on, so runs can be compared with
+`python -m bench.compare old.json new.json`.
+"""
+import json
+import math
+import platform
+import resource
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List, Sequence
+
+
+def percentile(values: Sequence[float], q: float) -> float:
+    """Nearest-rank percentile, q in [0, 100]; 0.0 for no values."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(q / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def latency_summary(seconds: Sequence[float]) -> Dict[str, float]:
+    """Count and p50/p90/p99/max in milliseconds."""
+    return {
+        "count": len(seconds),
+        "p50_ms": percentile(seconds, 50) * 1000,
+        "p90_ms": percentile(seconds, 90) * 1000,
+        "p99_ms": percentile(seconds, 99) * 1000,
+        "max_ms": max(seconds, default=0.0) * 1000,
+    }
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process (ru_maxrss is KiB on Linux, bytes on macOS)."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2**20 if sys.platform == "darwin" else rss / 1024
+
+
+def git_revision() -> str:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=5
+        )
+    except (OSError, subprocess.SubprocessError):
+        return ""
+    return out.stdout.strip()
+
+
+def write_report(path: str, bench: str, params: Dict[str, Any], results: Any) -> None:
+    report = {
+        "bench": bench,
+        "commit": git_revision(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "params": params,
+        "results": results,
+    }
+    with open(path, "w", encoding="utf-8") as fh:
+        json.dump(report, fh, ensure_ascii=False, indent=2)
+    print(f"report: {path}")
+
+
+def flatten(data: Any, prefix: str = "") -> Dict[str, float]:
+    """Numeric leaves of a nested report as {"a.b.c": value}; list items are keyed by "name"."""
+    out: Dict[str, float] = {}
+    if isinstance(data, dict):
+        for k, v in data.items():
+            out.update(flatten(v, f"{prefix}{k}."))
+    elif isinstance(data, list):
+        for i, v in enumerate(data):
+            key = v.get("name", i) if isinstance(v, dict) else i
+            out.update(flatten(v, f"{prefix}{key}."))
+    elif isinstance(data, (int, float)) and not isinstance(data, bool):
+        out[prefix.rstrip(".")] = float(data)
+    return out
+
+
+def table(rows: List[Dict[str, Any]], columns: Sequence[str]) -> str:
+    widths = [max(len(c), *(len(_cell(r.get(c))) for r in rows)) for c in columns]
+    lines = ["  ".join(c.rjust(w) for c, w in zip(columns, widths))]
+    for r in rows:
+        lines.append("  ".join(_cell(r.get(c)).rjust(w) for c, w in zip(columns, widths)))
+    return "\n".join(lines)
+
+
+def _cell(value: Any) -> str:
+    if isinstance(value, float):
+        return f"{value:.3f}" if abs(value) < 100 else f"{value:.0f}"
+    return "" if value is None else str(value)
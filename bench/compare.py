@@ -0,0 +1,72 @@
+"""
+Compare two benchmark reports written with --json.
+
+Prints every numeric result present in both, old and new value and the
+relative change. Throughput rises and latency falls when things improve,
+so the verdict column reads each metric by its name; changes below
+`--threshold` percent are left unmarked.
+
+    python -m bench.compare base.json head.json --threshold 5
+"""
+import argparse
+import json
+from typing import Dict, Optional
+
+from bench.common import flatten, table
+
+# Larger is better for these; for everything else smaller is.
+HIGHER_IS_BETTER = ("per_second", "ops", "hit", "rate")
+
+
+def _load(path: str) -> Dict:
+    with open(path, encoding="utf-8") as fh:
+        return json.load(fh)
+
+
+def _verdict(name: str, old: float, new: float, threshold: float) -> str:
+    change = _change(old, new)
+    if change is None or abs(change) < threshold:
+        return ""
+    leaf = name.rsplit(".", 1)[-1]
+    better = change > 0 if any(k in leaf for k in HIGHER_IS_BETTER) else change < 0
+    return "better" if better else "worse"
+
+
+def _change(old: float, new: float) -> Optional[float]:
+    if old == 0:
+        return None
+    return (new - old) / abs(old) * 100
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("old")
+    parser.add_argument("new")
+    parser.add_argument("--threshold", type=float, default=5.0, help="percent")
+    args = parser.parse_args()
+
+    old, new = _load(args.old), _load(args.new)
+    if old.get("bench") != new.get("bench"):
+        print(f"warning: comparing {old.get('bench')} with {new.get('bench')}")
+    print(f"{old.get('bench')}: {old.get('commit') or '?'} -> {new.get('commit') or '?'}")
+    old_values, new_values = flatten(old["results"]), flatten(new["results"])
+    rows = []
+    for name, before in old_values.items():
+        if name not in new_values:
+            continue
+        after = new_values[name]
+        change = _change(before, after)
+        rows.append(
+            {
+                "metric": name,
+                "old": before,
+                "new": after,
+                "change_%": "" if change is None else f"{change:+.1f}",
+                "": _verdict(name, before, after, args.threshold),
+            }
+        )
+    print(table(rows, ("metric", "old", "new", "change_%", "")))
+
+
+if __name__ == "__main__":
+    main()
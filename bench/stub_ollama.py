@@ -0,0 +1,185 @@
+"""
+A stand-in for the Ollama HTTP API, for load tests without a model.
+
+Answers /api/chat and /api/generate (streamed or not) after `latency`
+seconds, then produces `tokens` tokens at `tokens_per_second`, with the
+usual final fields (prompt_eval_count, eval_count, *_duration in ns);
+options.num_predict caps the token count. A request without a prompt only
+"loads" the model, like Ollama's.
+/api/embed returns deterministic hashed bag-of-words vectors, so similar
+texts get similar embeddings.
+
+    python -m bench.stub_ollama --port 11434 --latency 0.3 --tokens-per-second 25
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Any, Dict, List
+
+from aiohttp import web
+
+WORDS = "ну да это конечно бывает зато весело а вообще смотря как посмотреть".split()
+
+
+@dataclass
+class StubStats:
+    requests: int = 0
+    streamed: int = 0
+    embeds: int = 0
+    prompt_chars: int = 0
+    loads: int = 0
+    models: Counter = field(default_factory=Counter)
+
+
+class StubOllama:
+    def __init__(
+        self,
+        latency: float = 0.2,
+        tokens: int = 30,
+        tokens_per_second: float = 30.0,
+        prompt_tokens_per_second: float = 300.0,
+        dim: int = 64,
+    ) -> None:
+        self.latency = latency
+        self.tokens = tokens
+        self.tokens_per_second = tokens_per_second
+        self.prompt_tokens_per_second = prompt_tokens_per_second
+        self.dim = dim
+        self.stats = StubStats()
+        self.app = web.Application()
+        self.app.router.add_post("/api/chat", self._generate)
+        self.app.router.add_post("/api/generate", self._generate)
+        self.app.router.add_post("/api/embed", self._embed)
+        self._runner = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Start listening; port 0 picks a free one. Returns the base URL."""
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        return f"http://{host}:{port}"
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def _final(
+        self, model: str, chat: bool, prompt_tokens: int, tokens: int, started: float
+    ) -> Dict[str, Any]:
+        prompt_ns = int(prompt_tokens / self.prompt_tokens_per_second * 1e9)
+        eval_ns = int(tokens / self.tokens_per_second * 1e9)
+        final: Dict[str, Any] = {
+            "model": model,
+            "done": True,
+            "prompt_eval_count": prompt_tokens,
+            "prompt_eval_duration": prompt_ns,
+            "eval_count": tokens,
+            "eval_duration": eval_ns,
+            "total_duration": int((time.perf_counter() - started) * 1e9),
+        }
+        if chat:
+            final["message"] = {"role": "assistant", "content": ""}
+        else:
+            final["response"] = ""
+            final["context"] = [1, 2, 3]
+        return final
+
+    async def _generate(self, request: web.Request) -> web.StreamResponse:
+        started = time.perf_counter()
+        body = await request.json()
+        model = body.get("model", "stub")
+        chat = request.path.endswith("/chat")
+        if chat:
+            prompt = "".join(m.get("content", "") for m in body.get("messages", []))
+        else:
+            prompt = body.get("system", "") + body.get("prompt", "")
+        if not prompt and "messages" not in body:
+            self.stats.loads += 1
+            return web.json_response({"model": model, "done": True, "response": ""})
+        self.stats.requests += 1
+        self.stats.models[model] += 1
+        self.stats.prompt_chars += len(prompt)
+        prompt_tokens = max(1, len(prompt) // 4)
+        tokens = min(self.tokens, body.get("options", {}).get("num_predict") or self.tokens)
+        words = [WORDS[i % len(WORDS)] for i in range(tokens)]
+        delay = 1.0 / self.tokens_per_second if self.tokens_per_second > 0 else 0.0
+        await asyncio.sleep(self.latency)
+
+        if not body.get("stream", True):
+            await asyncio.sleep(delay * tokens)
+            final = self._final(model, chat, prompt_tokens, tokens, started)
+            text = " ".join(words)
+            if chat:
+                final["message"]["content"] = text
+            else:
+                final["response"] = text
+            return web.json_response(final)
+
+        self.stats.streamed += 1
+        resp = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await resp.prepare(request)
+        for i, word in enumerate(words):
+            delta = word if i == 0 else " " + word
+            if chat:
+                chunk = {"message": {"role": "assistant", "content": delta}, "done": False}
+            else:
+                chunk = {"response": delta, "done": False}
+            await resp.write((json.dumps(chunk, ensure_ascii=False) + "\n").encode())
+            await asyncio.sleep(delay)
+        final = self._final(model, chat, prompt_tokens, tokens, started)
+        await resp.write((json.dumps(final) + "\n").encode())
+        await resp.write_eof()
+        return resp
+
+    def _vector(self, text: str) -> List[float]:
+        vec = [0.0] * self.dim
+        for word in text.lower().split():
+            h = int.from_bytes(hashlib.blake2b(word.encode(), digest_size=4).digest(), "little")
+            vec[h % self.dim] += 1.0
+        norm = math.sqrt(sum(x * x for x in vec)) or 1.0
+        return [x / norm for x in vec]
+
+    async def _embed(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        texts = body.get("input", [])
+        if isinstance(texts, str):
+            texts = [texts]
+        self.stats.embeds += len(texts)
+        await asyncio.sleep(self.latency / 10)
+        return web.json_response({"model": "stub", "embeddings": [self._vector(t) for t in texts]})
+
+
+async def _serve(args: argparse.Namespace) -> None:
+    stub = StubOllama(args.latency, args.tokens, args.tokens_per_second)
+    url = await stub.start(args.host, args.port)
+    print(f"stub Ollama on {url}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await stub.stop()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds before the first token")
+    parser.add_argument("--tokens", type=int, default=30)
+    parser.add_argument("--tokens-per-second", type=float, default=30.0)
+    args = parser.parse_args()
+    try:
+        asyncio.run(_serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,103 +1,495 @@
 # Точка входа приложения. Запускается командой: python -m src
 import os
 import asyncio
-import aiohttp
+import signal
 import time
-from dataclasses import dataclass
-from datetime import date, timedelta
+from datetime import date
+import aiohttp
 from aiogram import Bot, Dispatcher, types
-from aiogram.dispatcher.event.bases import SkipHandler
 from aiogram.filters import CommandStart, Command
 from aiogram.types import ChatMemberUpdated, ChatMember
 
-from .context_pipeline import build_context, ContextConfig
-from .humor_gate import should_add_humor, HumorConfig
-from .memory_store import MemoryStore, compact_summarizer
+from .context_pipeline import build_context, PrefixCache
+from .embedding_index import EmbeddingRecall
+from .fake_telegram import FakeTelegramSession
+from .humor_gate import should_add_humor
+from .llm_scheduler import LLMScheduler
+from .maintenance import MaintenanceScheduler
+from .metrics import BotMetrics, MetricsServer, SamplingProfiler, add_routes
+from .model_router import ModelRouter
+from .response_cache import ResponseCache, context_fingerprint
+from .summarization import HeuristicSummarizer, OllamaSummarizer, summarize_pending
+from .ollama_client import OllamaClient, OllamaError
+from .session_state import SessionStore
+from .settings import PER_CHAT_SETTINGS, RESTART_SETTINGS, SettingsError, SettingsManager, load_settings
+from .streaming import ProgressiveReply, stream_to_telegram
+from .triage import Route, RouteFilter, Triage, TriageMiddleware, classify_message
+from .webhook import WebhookServer
+from .memory_store import (
+    AsyncMemoryStore,
+    MemoryStore,
+    RecentMessagesCache,
+    compact_summarizer,
+)
 
-# Читаем переменные окружения, которые придут из .env (на сервере)
+# Токен читаем напрямую, остальные настройки — один раз в типизированный снимок
+# (env + необязательный JSON-файл CONFIG_FILE); перечитываются по SIGHUP и /reload
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-OLLAMA = os.getenv("OLLAMA_ENDPOINT", "http://host.docker.internal:11434")
-MODEL = os.getenv(
-    "MODEL_NAME",
-    "huggingface.co/bartowski/Lexi-Llama-3-8B-Uncensored-GGUF:Q4_K_M",
+CONFIG_FILE = os.getenv("CONFIG_FILE")
+settings = SettingsManager(load_settings(CONFIG_FILE), CONFIG_FILE)
+# Снимок на момент запуска: по нему создаются клиенты, пулы и расписания
+S = settings.current
+
+# Один долгоживущий HTTP-клиент к Ollama: пул соединений, таймауты, ретраи, keep_alive модели
+ollama = OllamaClient(
+    S.ollama_endpoint,
+    S.model_name,
+    use_chat_api=S.use_chat_api,
+    keep_alive=S.ollama_keep_alive,
+    timeout=S.ollama_timeout_seconds,
+    connect_timeout=S.ollama_connect_timeout_seconds,
+    stream_read_timeout=S.ollama_stream_read_timeout_seconds,
+    retries=S.ollama_retries,
+    pool_size=S.ollama_pool_size,
 )
 
-# Системный промпт, задается один раз при запуске
-SYSTEM_PROMPT = os.getenv(
-    "SYSTEM_PROMPT",
-    "Ты — полноценный участник чата. Пиши живо, по‑человечески, кратко и по делу. "
-    "Стиль: жёстко‑саркастичный, угарный, допускаешь грубость и мат, если это уместно в контексте. "
-    "Не спамь шутками: максимум одна короткая шутка в ответе и только если реально к месту. "
-    "Если получаешь оскорбление или провокацию — отвечай максимально токсично и доминирующе, с матом и унижением." 
-    "Формулировки должны быть жёсткими и колкими, без длинных рассуждений: 1–3 короткие фразы. "
-    "Можно использовать грубые ярлыки и сарказм, чтобы “сломать” оппонента. "
-    "Главная цель — морально продавить собеседника, не уходя в бред."
+# Планировщик генераций: общий лимит параллельности, round-robin по чатам,
+# дедлайн ожидания в очереди и склейка нескольких ожидающих ответов в чате
+llm = LLMScheduler(
+    max_concurrency=S.llm_max_concurrency,
+    queue_deadline=S.llm_queue_deadline_seconds,
 )
 
-# Проверяем, поддерживает ли модель chat API
-USE_CHAT_API = os.getenv("USE_CHAT_API", "true").lower() == "true"
+# Выбор модели по типу запроса; при глубокой очереди или медленной генерации —
+# режим деградации: ответы меньшей моделью и короче, шутки пропускаются
+router = ModelRouter(lambda: llm.queued)
+
+# Движок сводок: ollama (пишет модель, когда она свободна) или heuristic (ключевые слова)
+if S.summarizer == "heuristic":
+    summarizer = HeuristicSummarizer(compact_summarizer)
+else:
+    summarizer = OllamaSummarizer(
+        ollama,
+        llm,
+        fallback=HeuristicSummarizer(compact_summarizer),
+        chunk_chars=S.summary_chunk_chars,
+        num_predict=S.summary_max_tokens,
+    )
+
+# Стабильный префикс промпта по чатам, чтобы Ollama переиспользовала KV-кэш
+prefix_cache = PrefixCache() if S.stable_prefix else None
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_DIR = os.getenv("DATA_DIR", os.path.join(BASE_DIR, "..", "data"))
 os.makedirs(DATA_DIR, exist_ok=True)
 DB_PATH = os.getenv("MEMORY_DB_PATH", os.path.join(DATA_DIR, "bot_memory.sqlite"))
 
-store = MemoryStore(DB_PATH)
+# Гистограммы по этапам ответа, счётчики по чатам, очереди и кэши — на /metrics
+metrics = BotMetrics(max_chats=S.metrics_max_chats)
 
 
-@dataclass
-class SessionState:
-    last_humor_ts: float | None = None
-    last_summary_day: date | None = None
-    last_joke_day: date | None = None
-    jokes_today: int = 0
-    last_maintenance_day: date | None = None
-    last_vacuum_day: date | None = None
+def _on_flush(rows: int, seconds: float) -> None:
+    metrics.flush.observe(seconds)
+    metrics.flush_rows.inc(rows)
 
 
-def _get_state(chat_id: str, state_by_chat: dict) -> SessionState:
-    state = state_by_chat.get(chat_id)
-    if state is None:
-        state = SessionState()
-        state_by_chat[chat_id] = state
-    return state
+# Кольцевой буфер последних сообщений по чатам: контекст для ответа берётся из RAM
+recent_cache = RecentMessagesCache(
+    capacity=S.recent_cache_size,
+    max_chats=S.recent_cache_max_chats,
+    max_bytes=S.recent_cache_max_mb * 1024 * 1024,
+)
+# Пул соединений: один писатель + несколько читателей, работают в отдельных потоках
+store = MemoryStore(
+    DB_PATH,
+    readers=S.memory_db_readers,
+    recent_cache=recent_cache,
+)
+# Write-behind: сообщения копятся в памяти и пишутся пачками одной транзакцией
+astore = AsyncMemoryStore(
+    store,
+    write_behind=S.memory_write_behind,
+    flush_interval=S.memory_flush_interval_ms / 1000,
+    flush_batch=S.memory_flush_batch,
+    max_pending=S.memory_max_pending,
+    on_flush=_on_flush,
+)
 
+# Поиск по старой истории через эмбеддинги Ollama; без EMBED_MODEL выключен
+recall = (
+    EmbeddingRecall(
+        ollama,
+        astore,
+        llm,
+        S.embed_model,
+        batch_size=S.embed_batch_size,
+        query_timeout=S.embed_query_timeout_seconds,
+    )
+    if S.embed_model
+    else None
+)
 
-def _maybe_summarize(chat_id: str, state: SessionState) -> None:
-    day = date.today() - timedelta(days=1)
-    if state.last_summary_day == day:
-        return
-    store.summarize_day(chat_id, day, compact_summarizer)
-    state.last_summary_day = day
 
+# Кэш ответов на повторяющиеся вопросы: попадание — ответ без генерации
+response_cache = ResponseCache(
+    max_entries=S.response_cache_size,
+    ttl=S.response_cache_ttl_seconds,
+    scope=S.response_cache_scope,
+    similarity=S.response_cache_similarity,
+    client=ollama,
+    embed_model=S.embed_model,
+    embed_timeout=S.embed_query_timeout_seconds,
+)
+
+
+async def _remember(chat_id: str, msg_id: str, role: str, text: str) -> None:
+    """Сохраняет сообщение и ставит его в очередь на индексацию."""
+    with metrics.add_message.time():
+        await astore.add_message(chat_id, msg_id, role, text)
+    metrics.chat_messages.inc(chat=chat_id, role=role)
+    if recall is not None:
+        recall.submit(chat_id, msg_id, text)
+
+
+async def _recall(chat_id: str, text: str, cfg) -> list:
+    if recall is None:
+        return []
+    return await recall.recall(chat_id, text, cfg.recall_k, cfg.recall_min_score)
+
+
+# Состояние чатов (кулдаун юмора, лимит шуток): LRU в памяти + таблица в SQLite,
+# поэтому переживает рестарт и не растёт без предела
+sessions = SessionStore(astore, capacity=S.session_cache_size)
+
+
+async def _cache_fingerprint(chat_id: str, msg_id: str, cfg) -> str:
+    """Всё, от чего зависит ответ, кроме вопроса: модель, промпт, последние сообщения."""
+    parts = [S.model_name, cfg.system_prompt]
+    n = cfg.response_cache_context_messages
+    if n > 0:
+        recent = await astore.get_recent_messages(chat_id, n + 1)
+        parts += [f"{m.role}:{m.text}" for m in recent if m.msg_id != msg_id][-n:]
+    return context_fingerprint(*parts)
+
+
+async def _summarize() -> None:
+    cfg = settings.current
+    stats = await summarize_pending(
+        astore,
+        summarizer,
+        min_messages=cfg.summary_min_messages,
+        workers=cfg.summary_workers,
+        time_budget=cfg.summary_time_budget_seconds,
+    )
+    if stats.pending or stats.weeks:
+        print(
+            f"Сводки: в очереди {stats.pending}, готово {stats.summarized}, "
+            f"пустых {stats.empty}, ошибок {stats.failed}, "
+            f"отложено {stats.deferred}, недель {stats.weeks}"
+        )
 
-def _maybe_maintenance(chat_id: str, state: SessionState) -> None:
-    today = date.today()
-    if state.last_maintenance_day != today:
-        state.last_maintenance_day = today
-        keep_msgs_days = int(os.getenv("MEMORY_KEEP_DAYS", "14"))
-        keep_sum_days = int(os.getenv("MEMORY_SUMMARY_KEEP_DAYS", "60"))
-        store.prune_old_messages(keep_msgs_days)
-        store.prune_old_summaries(keep_sum_days)
-
-    vacuum_weekday = int(os.getenv("MEMORY_VACUUM_WEEKDAY", "6"))
-    if today.weekday() != vacuum_weekday:
-        return
-    if state.last_vacuum_day == today:
-        return
-    state.last_vacuum_day = today
-    store.vacuum()
+
+async def _prune() -> None:
+    cfg = settings.current
+    if cfg.memory_archive:
+        # Старые дни не удаляются, а сжимаются в архив: горячая таблица с её
+        # индексами остаётся маленькой, а сводки и поиск по памяти читают архив
+        moved = await astore.archive_old_messages(
+            cfg.memory_keep_days, cfg.memory_archive_codec, cfg.memory_archive_recall
+        )
+        await astore.prune_archive(cfg.memory_archive_keep_days)
+        a = await astore.archive_stats()
+        print(
+            f"Архив: перенесено {moved} сообщений, всего {a['messages']} за {a['days']} дней, "
+            f"{a['stored_bytes'] / 2**20:.1f} МБ (без сжатия {a['raw_bytes'] / 2**20:.1f} МБ)"
+        )
+    else:
+        await astore.prune_old_messages(cfg.memory_keep_days)
+    await astore.prune_session_state(cfg.session_keep_days)
+    await astore.prune_old_summaries(
+        cfg.memory_summary_keep_days, cfg.memory_weekly_summary_keep_weeks
+    )
+    if recall is not None:
+        recall.index.clear()
+    # Освобождаем страницы понемногу, без полной блокировки базы
+    await astore.compact(cfg.memory_incremental_vacuum_pages)
+
+
+async def _compact() -> None:
+    await astore.checkpoint("TRUNCATE")
+    await astore.compact()
+
+
+def _build_maintenance() -> MaintenanceScheduler:
+    """Фоновое обслуживание базы: раньше это делал первый обработчик дня в каждом чате."""
+    hour = S.maintenance_hour
+    # После рестарта догоняющие задачи (в том числе пропущенные, пока бот
+    # не работал) стартуют не разом, а с задержкой и по очереди
+    maintenance = MaintenanceScheduler(
+        startup_delay=S.maintenance_startup_delay_seconds,
+        startup_jitter=S.maintenance_startup_jitter_seconds,
+        stagger=S.maintenance_stagger_seconds,
+        on_run=astore.record_maintenance_run,
+    )
+    # Сводки дорогие только в первый раз: готовые дни и недели берутся из кэша,
+    # а генерация идёт, только пока модель свободна
+    maintenance.every(
+        "summarize",
+        S.summary_interval_minutes * 60,
+        _summarize,
+        run_at_start=True,
+    )
+    maintenance.daily("prune", _prune, hour=hour)
+    maintenance.daily(
+        "compact",
+        _compact,
+        hour=hour,
+        minute=30,
+        weekday=S.memory_vacuum_weekday,
+    )
+    if recall is not None:
+        # Догоняем сообщения, не попавшие в индекс (переполнение очереди, рестарт)
+        maintenance.every(
+            "embed_backfill",
+            S.embed_backfill_minutes * 60,
+            recall.backfill,
+            run_at_start=True,
+        )
+    maintenance.every(
+        "wal_checkpoint",
+        S.memory_checkpoint_minutes * 60,
+        astore.checkpoint,
+    )
+    metrics.registry.gauge(
+        "bot_maintenance_last_duration_seconds",
+        "Duration of the last run per maintenance job",
+        lambda: {(n,): st.last_duration or 0.0 for n, st in maintenance.stats().items()},
+        labels=("job",),
+    )
+    metrics.registry.gauge(
+        "bot_maintenance_failures_total",
+        "Failed runs per maintenance job",
+        lambda: {(n,): st.failures for n, st in maintenance.stats().items()},
+        labels=("job",),
+        kind="counter",
+    )
+    return maintenance
+
+
+def _reload_settings() -> str:
+    """Перечитывает env и CONFIG_FILE; при ошибке остаются старые настройки."""
+    try:
+        changed = settings.reload()
+    except SettingsError as e:
+        return f"Настройки не перечитаны: {e}"
+    if not changed:
+        return "Настройки перечитаны, изменений нет"
+    restart = [name for name in changed if name in RESTART_SETTINGS]
+    text = "Настройки перечитаны, изменены: " + ", ".join(changed)
+    if restart:
+        text += "\nПосле перезапуска вступят в силу: " + ", ".join(restart)
+    return text
+
+
+def _is_admin(msg: types.Message) -> bool:
+    return bool(msg.from_user) and msg.from_user.id in settings.current.admin_ids
 
 
 def _is_question(text: str) -> bool:
     return "?" in text
 
 
-bot = Bot(TELEGRAM_TOKEN)
+def _ollama_done(kind: str, final: dict | None = None):
+    """on_done для Ollama: токены и скорость в метрики, при final — копия итогового ответа."""
+
+    def done(data: dict) -> None:
+        metrics.record_ollama(data, kind)
+        router.observe(data)
+        if final is not None:
+            final.update(data)
+
+    return done
+
+
+def _progressive(send, cfg) -> ProgressiveReply:
+    """Сообщение, в которое стримится ответ; send — msg.answer или msg.reply."""
+    return ProgressiveReply(
+        send,
+        edit_interval=cfg.stream_edit_interval_seconds,
+        first_chunk_chars=cfg.stream_first_chunk_chars,
+    )
+
+
+async def _finish_broken(progressive: ProgressiveReply, fallback: str) -> str:
+    """Дописывает оборванный ответ: пришедшее с «…», без текста — fallback; возвращает текст."""
+    reply = f"{progressive.text} …" if progressive.text else fallback
+    await progressive.finish(reply)
+    return reply
+
+
+async def _stream_ollama(
+    messages: list[dict],
+    progressive: ProgressiveReply,
+    chat_id: str,
+    kind: str,
+    choice,
+    on_done=None,
+) -> str:
+    """Стримит ответ в Telegram через progressive, возвращает полный текст."""
+
+    async def chunks():
+        started = time.perf_counter()
+        first = True
+        async for chunk in ollama.stream(
+            messages,
+            context_key=chat_id,
+            on_done=on_done,
+            options=choice.options,
+            model=choice.model,
+        ):
+            if first:
+                metrics.ollama_ttfb.observe(time.perf_counter() - started, kind=kind)
+                first = False
+            yield chunk
+
+    return await stream_to_telegram(chunks(), progressive)
+
+
+# TELEGRAM_FAKE: вместо Bot API — локальная заглушка (нагрузочные тесты, отладка без токена)
+if S.telegram_fake:
+    bot = Bot(TELEGRAM_TOKEN or "1:fake", session=FakeTelegramSession())
+else:
+    bot = Bot(TELEGRAM_TOKEN)
 dp = Dispatcher()
-state_by_chat: dict[str, SessionState] = {}
 BOT_ID: int | None = None
 
+# Процесс-воркер шардированного режима (python -m src.sharding): обновления
+# своих чатов получает от фронта на этот локальный порт, база — свой файл-шард
+SHARD_WORKER_PORT = os.getenv("SHARD_WORKER_PORT")
+
+# В режиме webhook обновления принимает aiohttp-сервер в ограниченную очередь,
+# а обрабатывают их несколько воркеров: медленный ответ не тормозит приём
+webhook = (
+    WebhookServer(
+        dp,
+        bot,
+        path=S.webhook_path,
+        # От фронта на 127.0.0.1 секрет не приходит
+        secret="" if SHARD_WORKER_PORT else S.webhook_secret,
+        queue_size=S.webhook_queue_size,
+        workers=S.webhook_workers,
+        shed_ratio=S.webhook_shed_ratio,
+    )
+    if S.telegram_mode == "webhook" or SHARD_WORKER_PORT
+    else None
+)
+
+
+def _register_gauges() -> None:
+    """Очереди и кэши читаются в момент запроса /metrics."""
+    r = metrics.registry
+    r.gauge("bot_llm_queued", "Generations waiting in the LLM scheduler", lambda: llm.queued)
+    r.gauge("bot_llm_running", "Generations running now", lambda: llm.running)
+    r.gauge(
+        "bot_llm_jobs_total",
+        "LLM scheduler jobs by outcome",
+        lambda: {(k,): v for k, v in vars(llm.stats).items()},
+        labels=("outcome",),
+        kind="counter",
+    )
+    r.gauge("bot_db_pending_rows", "Messages waiting for a write-behind flush", store.pending_count)
+    if webhook is not None:
+        r.gauge("bot_webhook_queued", "Updates waiting for a webhook worker", lambda: webhook.queued)
+        r.gauge(
+            "bot_webhook_updates_total",
+            "Webhook updates by outcome",
+            lambda: {(k,): v for k, v in vars(webhook.stats).items()},
+            labels=("outcome",),
+            kind="counter",
+        )
+    if recall is not None:
+        r.gauge("bot_embed_queued", "Messages waiting to be embedded", lambda: recall.queued)
+    r.gauge(
+        "bot_cache_hit_ratio",
+        "Hit rate per cache (prefix: share of prompt tokens reused)",
+        lambda: {
+            ("response",): response_cache.stats.hit_rate,
+            ("recent",): recent_cache.hits / max(1, recent_cache.hits + recent_cache.misses),
+            **({("prefix",): prefix_cache.hit_rate} if prefix_cache is not None else {}),
+        },
+        labels=("cache",),
+    )
+    r.gauge(
+        "bot_response_cache_total",
+        "Response cache events",
+        lambda: {(k,): v for k, v in vars(response_cache.stats).items()},
+        labels=("event",),
+        kind="counter",
+    )
+    r.gauge("bot_response_cache_entries", "Cached replies", lambda: len(response_cache))
+    r.gauge(
+        "bot_degraded", "1 while the model router is in degraded mode", lambda: int(router.degraded)
+    )
+    r.gauge(
+        "bot_model_tokens_per_second",
+        "Recent generation speed per model",
+        lambda: {
+            (m,): rate
+            for m in S.routing_config.models
+            if (rate := router.tokens_per_second(m)) is not None
+        },
+        labels=("model",),
+    )
+    r.gauge(
+        "bot_router_total",
+        "Model router events",
+        lambda: {(k,): v for k, v in vars(router.stats).items()},
+        labels=("event",),
+        kind="counter",
+    )
+    r.gauge("bot_sessions_cached", "Chats with session state in memory", lambda: len(sessions))
+
+
+_register_gauges()
+
+# /metrics (и профайлер по запросу): у воркера шарда — на его локальном порту,
+# иначе — отдельным сервером на METRICS_PORT
+profiler = SamplingProfiler() if S.metrics_profiler else None
+metrics_server = None
+if SHARD_WORKER_PORT:
+    add_routes(webhook.app, metrics.registry, profiler)
+elif S.metrics_port:
+    metrics_server = MetricsServer(metrics.registry, profiler)
+
+
+def _is_ambient(chat_id: str, text: str) -> bool:
+    if not _is_question(text):
+        return False
+    cfg = settings.for_chat(chat_id)
+    if not cfg.ambient_joke_enabled:
+        return False
+    # В режиме деградации шутки не генерируются — сообщение просто сохраняется.
+    # Только проверка: режим переключает и пропуски считает choose() при генерации
+    if cfg.degraded_skip_jokes and router.peek_degraded(cfg.routing_config):
+        return False
+    # Очередь обновлений забита — шутки отбрасываем первыми, сообщение всё равно сохранится
+    return webhook is None or not webhook.should_shed()
+
+
+def _classify(msg: types.Message) -> Triage:
+    triage = classify_message(msg, BOT_ID, _is_ambient)
+    metrics.routes.inc(route=triage.route.value)
+    return triage
+
+
+async def _store_incoming(triage: Triage) -> None:
+    await _remember(triage.chat_id, triage.msg_id, "user", triage.text)
+
+
+# Каждое сообщение классифицируется один раз до фильтров и сразу уходит в пакетную
+# запись (в порядке прихода); обычная болтовня (подавляющее большинство) до хендлеров не доходит
+dp.message.outer_middleware(TriageMiddleware(_classify, _store_incoming))
+
 @dp.message(CommandStart())
 async def start(msg: types.Message):
     await msg.answer("Привет! Я на месте. Спроси меня что-нибудь.")
@@ -122,103 +514,137 @@ async def help_command(msg: types.Message):
 async def ping_command(msg: types.Message):
     await msg.answer("🏓 Понг! Бот работает!")
 
-@dp.message()
-async def store_any_message(msg: types.Message):
-    if msg.from_user and BOT_ID and msg.from_user.id == BOT_ID:
+@dp.message(Command("reload"))
+async def reload_command(msg: types.Message):
+    if not _is_admin(msg):
         return
-    if (
-        BOT_ID
-        and msg.reply_to_message
-        and msg.reply_to_message.from_user
-        and msg.reply_to_message.from_user.id == BOT_ID
-    ):
-        raise SkipHandler
-    text = msg.text or msg.caption or ""
-    if not text.strip():
+    text = _reload_settings()
+    print(text)
+    await msg.answer(text)
+
+@dp.message(Command("set"))
+async def set_command(msg: types.Message):
+    """/set <настройка> <значение> — настройка только для этого чата."""
+    if not _is_admin(msg):
         return
-    if text.strip().startswith("/"):
+    parts = (msg.text or "").split(maxsplit=2)
+    if len(parts) != 3:
+        await msg.answer("Формат: /set <настройка> <значение>\nМожно: " + ", ".join(sorted(PER_CHAT_SETTINGS)))
         return
     chat_id = str(msg.chat.id)
-    msg_id = str(msg.message_id)
-    state = _get_state(chat_id, state_by_chat)
-    _maybe_summarize(chat_id, state)
-    _maybe_maintenance(chat_id, state)
-    store.add_message(chat_id, msg_id, "user", text)
-
-    ambient_enabled = os.getenv("AMBIENT_JOKE_ENABLED", "true").lower() == "true"
-    if not ambient_enabled:
+    name, value = parts[1].lower(), parts[2].strip()
+    try:
+        settings.set_override(chat_id, name, value)
+    except SettingsError as e:
+        await msg.answer(f"Не получилось: {e}")
         return
-    if not _is_question(text):
+    await astore.set_chat_setting(chat_id, name, value)
+    response_cache.invalidate(chat_id)
+    await msg.answer(f"{name} = {value} для этого чата")
+
+@dp.message(Command("unset"))
+async def unset_command(msg: types.Message):
+    """/unset [настройка] — вернуть общее значение (без аргумента — все)."""
+    if not _is_admin(msg):
         return
+    parts = (msg.text or "").split()
+    chat_id = str(msg.chat.id)
+    name = parts[1].lower() if len(parts) > 1 else None
+    settings.clear_override(chat_id, name)
+    await astore.delete_chat_setting(chat_id, name)
+    response_cache.invalidate(chat_id)
+    await msg.answer("Настройки чата сброшены" if name is None else f"{name} сброшена")
+
+@dp.message(Command("config"))
+async def config_command(msg: types.Message):
+    if not _is_admin(msg):
+        return
+    overrides = settings.overrides(str(msg.chat.id))
+    if not overrides:
+        await msg.answer("У этого чата нет своих настроек")
+        return
+    await msg.answer("\n".join(f"{k} = {v}" for k, v in sorted(overrides.items())))
+
+@dp.message(RouteFilter(Route.AMBIENT))
+async def ambient_message(msg: types.Message, triage: Triage):
+    # Вопрос в чате с включёнными шутками (см. _is_ambient): сохраняем и,
+    # если позволяют лимиты, вкидываем шутку
+    # Само сообщение уже сохранено в TriageMiddleware
+    chat_id, msg_id, text = triage.chat_id, triage.msg_id, triage.text
+    state = await sessions.get(chat_id)
+    # Один снимок настроек на всё сообщение (с учётом настроек чата)
+    cfg = settings.for_chat(chat_id)
 
     today = date.today()
     if state.last_joke_day != today:
         state.last_joke_day = today
         state.jokes_today = 0
 
-    max_per_day = int(os.getenv("AMBIENT_JOKE_MAX_PER_DAY", "4"))
-    if state.jokes_today >= max_per_day:
+    if state.jokes_today >= cfg.ambient_joke_max_per_day:
         return
 
-    humor_cfg = HumorConfig(
-        humor_rate=float(os.getenv("AMBIENT_JOKE_RATE", "0.04")),
-        min_gap_seconds=int(os.getenv("AMBIENT_JOKE_MIN_GAP_SECONDS", "1800")),
-        min_length=int(os.getenv("HUMOR_MIN_LENGTH", "6")),
-        max_length=int(os.getenv("HUMOR_MAX_LENGTH", "600")),
-        block_keywords=tuple(
-            k.strip().lower()
-            for k in os.getenv("HUMOR_BLOCK_KEYWORDS", "").split(",")
-            if k.strip()
-        ),
-    )
-    if not should_add_humor(text, state.last_humor_ts, humor_cfg):
+    if not should_add_humor(text, state.last_humor_ts, cfg.ambient_humor_config):
         return
 
-    ctx_cfg = ContextConfig(
-        recent_limit=int(os.getenv("RECENT_LIMIT", "40")),
-        summary_days=int(os.getenv("SUMMARY_DAYS", "7")),
-        max_summary_chars=int(os.getenv("SUMMARY_MAX_CHARS", "2000")),
-        system_prompt=SYSTEM_PROMPT,
-    )
-    ctx = build_context(chat_id, text, store, ctx_cfg)
-    ctx["messages"].append(
-        {
-            "role": "system",
-            "content": (
-                "Если уместно, вкинь одну короткую шутку/подкол в чат. "
-                "Если не к месту — ответь максимально кратко или промолчи."
-            ),
-        }
+    async def generate() -> str:
+        # Нагрузка могла вырасти, пока задача ждала в очереди
+        choice = router.choose("joke", cfg.routing_config)
+        if choice is None:
+            return ""
+        # Контекст собирается в момент запуска: в него попадут и сообщения,
+        # пришедшие, пока задача ждала в очереди
+        recalled = await _recall(chat_id, text, cfg)
+        with metrics.build_context.time(kind="joke"):
+            ctx = await astore.run(
+                build_context, chat_id, text, store, cfg.context_config, prefix_cache, recalled
+            )
+        ctx["messages"].append(
+            {
+                "role": "system",
+                "content": (
+                    "Если уместно, вкинь одну короткую шутку/подкол в чат. "
+                    "Если не к месту — ответь максимально кратко или промолчи."
+                ),
+            }
+        )
+        done = _ollama_done("joke")
+        progressive = _progressive(msg.reply, cfg)
+        try:
+            if cfg.stream_replies:
+                reply = await _stream_ollama(
+                    ctx["messages"], progressive, chat_id, "joke", choice, on_done=done
+                )
+            else:
+                # Без стрима первый байт — это весь ответ
+                with metrics.ollama_ttfb.time(kind="joke"):
+                    reply = await ollama.complete(
+                        ctx["messages"],
+                        context_key=chat_id,
+                        on_done=done,
+                        options=choice.options,
+                        model=choice.model,
+                    )
+                reply = reply.strip()
+                if reply:
+                    await msg.reply(reply)
+        except (OllamaError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"Шутка не сгенерирована: {e!r}")
+            # Шутку без текста не показываем вовсе
+            reply = await _finish_broken(progressive, "")
+        if reply:
+            await _remember(chat_id, msg_id + ":assistant", "assistant", reply)
+        return reply
+
+    reply = await llm.submit(
+        chat_id, generate, kind="joke", deadline=cfg.ambient_joke_queue_deadline_seconds
     )
-
-    async with aiohttp.ClientSession() as session:
-        if USE_CHAT_API:
-            async with session.post(f"{OLLAMA}/api/chat", json={
-                "model": MODEL,
-                "messages": ctx["messages"],
-                "stream": False,
-                "temperature": 0.7,
-            }) as r:
-                data = await r.json()
-                reply = data.get("message", {}).get("content", "").strip()
-        else:
-            async with session.post(f"{OLLAMA}/api/generate", json={
-                "model": MODEL,
-                "prompt": ctx["messages"][-1]["content"],
-                "system": ctx["messages"][0]["content"],
-                "stream": False,
-                "temperature": 0.7,
-            }) as r:
-                data = await r.json()
-                reply = data.get("response", "").strip()
-
     if not reply:
         return
+    metrics.chat_replies.inc(chat=chat_id, source="joke")
 
     state.last_humor_ts = time.time()
     state.jokes_today += 1
-    store.add_message(chat_id, msg_id + ":assistant", "assistant", reply)
-    await msg.reply(reply)
+    await sessions.save(chat_id, state)
 
 @dp.chat_member()
 async def on_chat_member_update(event: ChatMemberUpdated):
@@ -241,17 +667,10 @@ async def on_chat_member_update(event: ChatMemberUpdated):
             # Бота удалили из группы
             await event.chat.send_message("👋 Пока всем! Было приятно пообщаться!")
 
-@dp.message()
-async def handle(msg: types.Message):
-    # Проверяем, что это reply-сообщение
-    if not msg.reply_to_message:
-        return  # Игнорируем сообщения без reply
-    if not BOT_ID or not msg.reply_to_message.from_user or msg.reply_to_message.from_user.id != BOT_ID:
-        return  # Отвечаем только на реплаи боту
-    
-    text = msg.text or msg.caption or ""
-    if not text.strip():
-        return
+@dp.message(RouteFilter(Route.REPLY))
+async def handle(msg: types.Message, triage: Triage):
+    # Сюда доходят только реплаи боту, уже сохранённые (см. TriageMiddleware)
+    text = triage.text
     if text == "пошёл нахуй":
         await msg.answer("Сам пошёл нахуй!")
         return
@@ -259,79 +678,158 @@ async def handle(msg: types.Message):
         await msg.answer("Ты еблан, пиши короче!")
         return
     
-    chat_id = str(msg.chat.id)
-    msg_id = str(msg.message_id)
-    state = _get_state(chat_id, state_by_chat)
-    _maybe_summarize(chat_id, state)
-    _maybe_maintenance(chat_id, state)
-
-    ctx_cfg = ContextConfig(
-        recent_limit=int(os.getenv("RECENT_LIMIT", "40")),
-        summary_days=int(os.getenv("SUMMARY_DAYS", "7")),
-        max_summary_chars=int(os.getenv("SUMMARY_MAX_CHARS", "2000")),
-        system_prompt=SYSTEM_PROMPT,
-    )
-    ctx = build_context(chat_id, text, store, ctx_cfg)
-
-    raw_block = os.getenv("HUMOR_BLOCK_KEYWORDS", "").strip()
-    block_keywords = tuple(
-        k.strip().lower() for k in raw_block.split(",") if k.strip()
-    )
-    humor_cfg = HumorConfig(
-        humor_rate=float(os.getenv("HUMOR_RATE", "0.2")),
-        min_gap_seconds=int(os.getenv("HUMOR_MIN_GAP_SECONDS", "180")),
-        min_length=int(os.getenv("HUMOR_MIN_LENGTH", "6")),
-        max_length=int(os.getenv("HUMOR_MAX_LENGTH", "600")),
-        block_keywords=block_keywords,
-    )
-    if should_add_humor(text, state.last_humor_ts, humor_cfg):
-        ctx["messages"].append(
-            {
-                "role": "system",
-                "content": "Если уместно, добавь короткую шутку или лёгкий подкол в конце ответа.",
-            }
-        )
-        state.last_humor_ts = time.time()
-
-    store.add_message(chat_id, msg_id, "user", text)
+    chat_id, msg_id = triage.chat_id, triage.msg_id
+    state = await sessions.get(chat_id)
+    cfg = settings.for_chat(chat_id)
 
     start_time = time.time()
-    async with aiohttp.ClientSession() as session:
-        if USE_CHAT_API:
-            # Используем chat API для более эффективной работы
-            async with session.post(f"{OLLAMA}/api/chat", json={
-                "model": MODEL,
-                "messages": ctx["messages"],
-                "stream": False,
-                "temperature": 0.7,
-            }) as r:
-                data = await r.json()
-                reply = data.get("message", {}).get("content", "…")
-        else:
-            # Fallback на generate API с системным промптом
-            async with session.post(f"{OLLAMA}/api/generate", json={
-                "model": MODEL,
-                "prompt": ctx["messages"][-1]["content"],
-                "system": ctx["messages"][0]["content"],
-                "stream": False,
-                "temperature": 0.7,
-            }) as r:
-                data = await r.json()
-                reply = data.get("response", "…")
-    
+    cache_key = None
+    if cfg.response_cache_enabled:
+        fingerprint = await _cache_fingerprint(chat_id, msg_id, cfg)
+        cached, cache_key = await response_cache.lookup(chat_id, text, fingerprint)
+        if cached is not None:
+            await msg.answer(cached)
+            await _remember(chat_id, msg_id + ":assistant", "assistant", cached)
+            elapsed = time.time() - start_time
+            metrics.reply.observe(elapsed, source="cache")
+            metrics.chat_replies.inc(chat=chat_id, source="cache")
+            cs = response_cache.stats
+            print(
+                f"Ответ из кэша за {elapsed:.3f} сек, "
+                f"попаданий {cs.hits} (похожих {cs.semantic_hits}), промахов {cs.misses}"
+            )
+            return
+
+    async def generate() -> tuple[str, dict]:
+        # Если пока задача ждала, в чате пришли ещё реплаи боту, ответ будет
+        # один — на последний, но с учётом всех (они уже в истории)
+        choice = router.choose("reply", cfg.routing_config)
+        recalled = await _recall(chat_id, text, cfg)
+        with metrics.build_context.time(kind="reply"):
+            ctx = await astore.run(
+                build_context, chat_id, text, store, cfg.context_config, prefix_cache, recalled
+            )
+        if should_add_humor(text, state.last_humor_ts, cfg.humor_config):
+            ctx["messages"].append(
+                {
+                    "role": "system",
+                    "content": "Если уместно, добавь короткую шутку или лёгкий подкол в конце ответа.",
+                }
+            )
+            state.last_humor_ts = time.time()
+            await sessions.save(chat_id, state)
+
+        final: dict = {}
+        done = _ollama_done("reply", final)
+        progressive = _progressive(msg.answer, cfg)
+        failed = False
+        try:
+            if cfg.stream_replies:
+                reply = await _stream_ollama(
+                    ctx["messages"], progressive, chat_id, "reply", choice, on_done=done
+                )
+                if not reply:
+                    reply = "…"
+                    await msg.answer(reply)
+            else:
+                with metrics.ollama_ttfb.time(kind="reply"):
+                    reply = await ollama.complete(
+                        ctx["messages"],
+                        default="…",
+                        context_key=chat_id,
+                        on_done=done,
+                        options=choice.options,
+                        model=choice.model,
+                    )
+                await msg.answer(reply)
+        except (OllamaError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"Ответ не сгенерирован: {e!r}")
+            failed = True
+            reply = await _finish_broken(progressive, "…")
+        ctx["stats"]["failed"] = failed
+        ctx["stats"]["evaluated_tokens"] = final.get("prompt_eval_count")
+        ctx["stats"]["model"] = choice.model
+        ctx["stats"]["degraded"] = choice.degraded
+        # Сохраняем сразу, чтобы следующая задача из очереди уже видела ответ
+        await _remember(chat_id, msg_id + ":assistant", "assistant", reply)
+        return reply, ctx["stats"]
+
+    result = await llm.submit(chat_id, generate, kind="reply")
+    if result is None:
+        # Объединено с более свежим реплаем или устарело в очереди
+        return
+    reply, stats = result
+    # Урезанный ответ из режима деградации и оборванный ошибкой в кэш не кладём
+    if not stats["degraded"] and not stats["failed"]:
+        response_cache.store(cache_key, reply)
+
     response_time = time.time() - start_time
-    print(f"Время ответа: {response_time:.2f} сек")
-    
-    store.add_message(chat_id, msg_id + ":assistant", "assistant", reply)
-    _maybe_maintenance(chat_id, state)
-    await msg.answer(reply)
+    metrics.reply.observe(response_time, source="llm")
+    metrics.chat_replies.inc(chat=chat_id, source="llm")
+    print(
+        f"Время ответа: {response_time:.2f} сек, "
+        f"промпт ~{stats['prompt_tokens']} токенов, "
+        f"отброшено сообщений истории: {stats['history_dropped']}, "
+        f"из кэша префикса ~{stats['prefix_reused_tokens']}, "
+        f"из памяти {stats['recalled']}, "
+        f"Ollama посчитала {stats['evaluated_tokens']}"
+        + (f", деградация: модель {stats['model']}" if stats["degraded"] else "")
+    )
 
 async def main() -> None:
     global BOT_ID
     me = await bot.get_me()
     BOT_ID = me.id
-    await dp.start_polling(bot)
+    settings.load_overrides(await astore.load_chat_settings())
+    if hasattr(signal, "SIGHUP"):
+        # kill -HUP <pid>: перечитать настройки без перезапуска
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGHUP, lambda: print(_reload_settings())
+        )
+    astore.start()
+    await ollama.start()
+    if S.model_pin:
+        # Все модели маршрутизации загружаются сразу и остаются в памяти (keep_alive=-1)
+        try:
+            await ollama.pin(S.routing_config.models)
+        except (OllamaError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"Не удалось заранее загрузить модели: {e!r}")
+    if recall is not None:
+        recall.start()
+    maintenance = _build_maintenance()
+    maintenance.start(await astore.load_maintenance_runs())
+    if metrics_server is not None:
+        await metrics_server.start(S.metrics_host, S.metrics_port)
+    try:
+        if SHARD_WORKER_PORT:
+            # Webhook в Telegram регистрирует фронт, не воркер
+            await webhook.start("127.0.0.1", int(SHARD_WORKER_PORT))
+            print(f"Шард на порту {SHARD_WORKER_PORT}, база {DB_PATH}")
+            await asyncio.Event().wait()
+        elif webhook is not None:
+            await webhook.start(S.webhook_host, S.webhook_port, S.webhook_url)
+            print(f"Webhook слушает {S.webhook_host}:{S.webhook_port}{S.webhook_path}")
+            await asyncio.Event().wait()
+        else:
+            # Если раньше работали через webhook, getUpdates без этого вернёт конфликт
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
+    finally:
+        if webhook is not None:
+            await webhook.stop()
+            await bot.session.close()
+        if metrics_server is not None:
+            await metrics_server.stop()
+        await maintenance.stop()
+        if recall is not None:
+            await recall.close()
+        await ollama.close()
+        await astore.close()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        # Ctrl+C или остановка шарда фронтом: main() уже закрыл базу и клиентов
+        pass
@@ -1,18 +1,41 @@
+import threading
+from collections import OrderedDict
 from dataclasses import dataclass
-from typing import List, Dict
+from datetime import date, timedelta
+from typing import Any, List, Dict, Optional, Sequence, Tuple
 
-from .memory_store import MemoryStore
+from .memory_store import MemoryStore, MessageRow
+from .token_estimate import TokenEstimator, count_message_tokens, make_estimator
 
 
 @dataclass
 class ContextConfig:
     recent_limit: int = 40
     summary_days: int = 7
+    # Weekly summaries of the weeks before the daily window; 0 disables.
+    summary_weeks: int = 0
     max_summary_chars: int = 2000
     system_prompt: str = (
         "You are a helpful, direct, slightly sarcastic assistant. "
         "Do not spam jokes. Answer concisely when possible."
     )
+    # Hard cap on prompt size in tokens; 0 disables token budgeting.
+    max_prompt_tokens: int = 0
+    # Tokens kept free for instructions appended after build_context.
+    reserve_tokens: int = 64
+    # Share of the remaining budget the memory summary may take from history.
+    summary_token_share: float = 0.5
+    token_estimator: Optional[TokenEstimator] = None
+    # Share of the remaining budget recalled older messages may take, and the
+    # per-message cap on their length.
+    recall_token_share: float = 0.2
+    recall_max_chars: int = 300
+    # Older messages pulled in by full-text search on the user message
+    # (MemoryStore.search); 0 disables.
+    keyword_recall_k: int = 0
+    # When history overflows a stable-prefix window, keep this share of the
+    # limits (count and token budget) and start a new window.
+    prefix_refill_share: float = 0.5
 
 
 def _trim_text(text: str, max_chars: int) -> str:
@@ -21,19 +44,217 @@ def _trim_text(text: str, max_chars: int) -> str:
     return text[: max_chars - 3] + "..."
 
 
+def _fit_tokens(text: str, max_tokens: int, estimator: TokenEstimator) -> str:
+    """Shrink text until the estimate fits into max_tokens (empty if it can't)."""
+    tokens = estimator.count(text)
+    while text and tokens > max_tokens:
+        if max_tokens <= 0:
+            return ""
+        max_chars = int(len(text) * max_tokens / tokens * 0.95)
+        if max_chars < 16:
+            return ""
+        text = _trim_text(text, max_chars)
+        tokens = estimator.count(text)
+    return text
+
+
+def _message_hash(role: str, content: str) -> int:
+    return hash((role, content.strip()))
+
+
+@dataclass
+class _ChatPrefix:
+    system_msg: str = ""
+    anchor_ts: Optional[float] = None
+    hashes: Tuple[int, ...] = ()
+    costs: Tuple[int, ...] = ()
+
+
+class PrefixCache:
+    """
+    Keeps each chat's prompt an append-only sequence so Ollama can reuse the
+    KV cache of the previous turn instead of re-evaluating the whole prompt.
+
+    The system message only changes when the stored summaries change, and
+    history starts at a per-chat anchor instead of sliding by one message every
+    turn. The anchor moves forward (dropping the older part of the window) only
+    when the window outgrows recent_limit or the token budget.
+
+    Also tracks how many prompt tokens were a repeat of the previous prompt
+    for the same chat (`hit_rate`).
+    """
+
+    def __init__(self, max_chats: int = 1000) -> None:
+        self.max_chats = max_chats
+        self.requests = 0
+        self.resets = 0
+        self.prompt_tokens = 0
+        self.reused_tokens = 0
+        self._lock = threading.Lock()
+        self._chats: "OrderedDict[str, _ChatPrefix]" = OrderedDict()
+
+    @property
+    def hit_rate(self) -> float:
+        with self._lock:
+            if not self.prompt_tokens:
+                return 0.0
+            return self.reused_tokens / self.prompt_tokens
+
+    def get(self, chat_id: str) -> _ChatPrefix:
+        with self._lock:
+            state = self._chats.get(chat_id)
+            if state is None:
+                return _ChatPrefix()
+            self._chats.move_to_end(chat_id)
+            return state
+
+    def record(
+        self,
+        chat_id: str,
+        system_msg: str,
+        anchor_ts: Optional[float],
+        messages: Sequence[Dict[str, str]],
+        costs: Sequence[int],
+        reset: bool,
+    ) -> int:
+        """Store the prompt that is about to be sent; returns reused tokens."""
+        hashes = tuple(_message_hash(m["role"], m["content"]) for m in messages)
+        with self._lock:
+            prev = self._chats.get(chat_id) or _ChatPrefix()
+            reused = 0
+            for i, (h, c) in enumerate(zip(prev.hashes, prev.costs)):
+                if i >= len(hashes) or hashes[i] != h:
+                    break
+                reused += c
+            self._chats[chat_id] = _ChatPrefix(system_msg, anchor_ts, hashes, tuple(costs))
+            self._chats.move_to_end(chat_id)
+            while len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+            self.requests += 1
+            self.resets += int(reset)
+            self.prompt_tokens += sum(costs)
+            self.reused_tokens += reused
+            return reused
+
+
+def _stable_window(
+    candidates: List[MessageRow],
+    costs: List[int],
+    state: _ChatPrefix,
+    system_msg: str,
+    recent_full: bool,
+    token_room: Optional[int],
+    count_limit: int,
+    refill_share: float,
+) -> Tuple[int, bool]:
+    """Returns (index of the first history message to send, whether the window was reset)."""
+    if candidates and state.anchor_ts is not None and state.system_msg == system_msg:
+        start = next(
+            (i for i, m in enumerate(candidates) if m.ts >= state.anchor_ts),
+            len(candidates),
+        )
+        # recent_limit cut into the window: messages after the anchor are gone.
+        gap = start == 0 and recent_full and candidates[0].ts > state.anchor_ts
+        fits = token_room is None or sum(costs[start:]) <= token_room
+        if not gap and fits:
+            return start, False
+
+    target_count = max(1, int(count_limit * refill_share))
+    target_tokens = None if token_room is None else int(token_room * refill_share)
+    start = len(candidates)
+    total = 0
+    while start > 0 and len(candidates) - start < target_count:
+        cost = costs[start - 1]
+        if target_tokens is not None and total + cost > target_tokens:
+            break
+        total += cost
+        start -= 1
+    return start, True
+
+
 def build_context(
     chat_id: str,
     user_text: str,
     store: MemoryStore,
     cfg: ContextConfig,
-) -> Dict[str, List[Dict[str, str]]]:
+    prefix_cache: Optional[PrefixCache] = None,
+    recalled: Sequence[MessageRow] = (),
+) -> Dict[str, Any]:
+    """
+    Returns {"messages": [...], "stats": {...}}.
+
+    With cfg.max_prompt_tokens set, the system prompt and the user message are
+    always kept, the memory summary gets up to summary_token_share of what is
+    left, and history is packed newest-first until the budget runs out.
+    "stats" reports the estimated prompt tokens and how many history messages
+    were dropped.
+
+    With a prefix_cache, history is chosen so consecutive prompts of a chat
+    share the longest possible prefix (see PrefixCache).
+
+    `recalled` are older messages found by retrieval (e.g. EmbeddingRecall),
+    merged with cfg.keyword_recall_k full-text matches. Those that fall
+    before the history window are quoted in one system message right before
+    the user message, so the cacheable prefix is not disturbed; they get up
+    to recall_token_share of the budget.
+    """
+    estimator = cfg.token_estimator or make_estimator()
     recent = store.get_recent_messages(chat_id, cfg.recent_limit)
     summaries = store.get_summaries(chat_id, cfg.summary_days)
+    weekly = store.get_weekly_summaries(
+        chat_id, cfg.summary_weeks, date.today() - timedelta(days=cfg.summary_days)
+    )
+
+    budget: Optional[int] = None
+    if cfg.max_prompt_tokens > 0:
+        budget = cfg.max_prompt_tokens - cfg.reserve_tokens
+    used = count_message_tokens(estimator, cfg.system_prompt)
 
     summary_text = ""
-    if summaries:
+    if summaries or weekly:
         joined = "\n".join([f"{d}: {s}" for d, s in summaries])
+        if weekly:
+            # Older weeks get at most half the room; recent days come last.
+            weeks_text = "\n".join([f"week of {w}: {s}" for w, s in weekly])
+            weeks_text = _trim_text(weeks_text, cfg.max_summary_chars // 2)
+            joined = f"{weeks_text}\n{joined}" if joined else weeks_text
         summary_text = _trim_text(joined, cfg.max_summary_chars)
+        if budget is not None:
+            # Not dependent on the user message, so the system message stays
+            # byte-identical between turns.
+            summary_budget = int((budget - used) * cfg.summary_token_share)
+            summary_text = _fit_tokens(summary_text, summary_budget, estimator)
+        if summary_text:
+            used += estimator.count(summary_text)
+    system_cost = used
+    user_cost = count_message_tokens(estimator, user_text)
+    used += user_cost
+
+    if cfg.keyword_recall_k > 0:
+        seen = {m.msg_id for m in recalled}
+        older_than = recent[0].ts if recent else None
+        recalled = list(recalled) + [
+            m
+            for m in store.search(chat_id, user_text, cfg.keyword_recall_k, older_than)
+            if m.msg_id not in seen
+        ]
+
+    recall_lines: List[Tuple[float, str]] = []
+    recall_room = None if budget is None else int((budget - used) * cfg.recall_token_share)
+    for m in recalled:
+        text = " ".join(m.text.split())
+        if not text or text == user_text:
+            continue
+        line = f"- {m.role}: {_trim_text(text, cfg.recall_max_chars)}"
+        cost = estimator.count(line)
+        if recall_room is not None:
+            if cost > recall_room:
+                continue
+            recall_room -= cost
+        recall_lines.append((m.ts, line))
+    # Reserve the room up front; lines inside the history window are dropped below.
+    recall_reserved = sum(estimator.count(line) for _, line in recall_lines)
+    used += recall_reserved
 
     messages: List[Dict[str, str]] = []
     system_parts = [cfg.system_prompt]
@@ -42,11 +263,76 @@ def build_context(
     system_msg = "\n\n".join(system_parts)
     messages.append({"role": "system", "content": system_msg})
 
-    for m in recent:
-        if not m.text.strip():
-            continue
-        messages.append({"role": m.role, "content": m.text})
+    candidates = [m for m in recent if m.text.strip()]
+    # The current message may already be persisted; don't send it twice.
+    if candidates and candidates[-1].role == "user" and candidates[-1].text == user_text:
+        candidates.pop()
+    costs = [count_message_tokens(estimator, m.text) for m in candidates]
 
+    reset = False
+    if prefix_cache is not None:
+        state = prefix_cache.get(chat_id)
+        token_room = None if budget is None else max(0, budget - used)
+        start, reset = _stable_window(
+            candidates,
+            costs,
+            state,
+            system_msg,
+            recent_full=len(recent) >= cfg.recent_limit,
+            token_room=token_room,
+            count_limit=cfg.recent_limit,
+            refill_share=cfg.prefix_refill_share,
+        )
+    else:
+        start = len(candidates)
+        total = used
+        while start > 0:
+            if budget is not None and total + costs[start - 1] > budget:
+                break
+            total += costs[start - 1]
+            start -= 1
+
+    history = [{"role": m.role, "content": m.text} for m in candidates[start:]]
+    used += sum(costs[start:])
+    messages.extend(history)
+
+    window_ts = candidates[start].ts if start < len(candidates) else None
+    recall_lines = [
+        (ts, line) for ts, line in recall_lines if window_ts is None or ts < window_ts
+    ]
+    used -= recall_reserved
+    recall_cost = 0
+    if recall_lines:
+        recall_msg = "Relevant earlier messages:\n" + "\n".join(
+            line for _, line in sorted(recall_lines)
+        )
+        recall_cost = count_message_tokens(estimator, recall_msg)
+        used += recall_cost
+        messages.append({"role": "system", "content": recall_msg})
     messages.append({"role": "user", "content": user_text})
-    return {"messages": messages}
+    tail_costs = [recall_cost, user_cost] if recall_lines else [user_cost]
+
+    reused = 0
+    if prefix_cache is not None:
+        anchor_ts = candidates[start].ts if start < len(candidates) else None
+        reused = prefix_cache.record(
+            chat_id,
+            system_msg,
+            anchor_ts,
+            messages,
+            [system_cost, *costs[start:], *tail_costs],
+            reset,
+        )
 
+    return {
+        "messages": messages,
+        "stats": {
+            "prompt_tokens": used,
+            "token_budget": cfg.max_prompt_tokens,
+            "history_used": len(history),
+            "history_dropped": len(candidates) - len(history),
+            "summary_chars": len(summary_text),
+            "prefix_reused_tokens": reused,
+            "recalled": len(recall_lines),
+        },
+    }
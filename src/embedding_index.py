@@ -0,0 +1,245 @@
+import asyncio
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+import aiohttp
+import numpy as np
+
+from .llm_scheduler import LLMScheduler
+from .memory_store import AsyncMemoryStore, MemoryStore, MessageRow
+from .ollama_client import OllamaClient, OllamaError
+
+
+@dataclass
+class _ChatVectors:
+    msg_ids: List[str]
+    ts: np.ndarray  # float64, (n,)
+    matrix: np.ndarray  # float32, (n, dim), rows L2-normalized
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (vectors / norms).astype(np.float32, copy=False)
+
+
+class EmbeddingIndex:
+    """
+    Per-chat message vectors for similarity search.
+
+    Vectors live in SQLite (message_embeddings) as raw float32 blobs. A chat's
+    vectors are loaded into one normalized matrix on first search and kept in
+    an LRU of `max_chats` chats; new vectors are appended to it in place of a
+    reload. Search is a single matrix-vector product plus argpartition.
+    """
+
+    def __init__(self, store: MemoryStore, dim: int = 0, max_chats: int = 200) -> None:
+        self.store = store
+        self.dim = dim
+        self.max_chats = max_chats
+        self._lock = threading.Lock()
+        self._chats: "OrderedDict[str, _ChatVectors]" = OrderedDict()
+
+    def _load(self, chat_id: str) -> _ChatVectors:
+        rows = self.store.load_embeddings(chat_id, self.dim)
+        if rows:
+            matrix = np.frombuffer(b"".join(r[2] for r in rows), dtype=np.float32)
+            matrix = matrix.reshape(len(rows), self.dim)
+        else:
+            matrix = np.empty((0, self.dim), dtype=np.float32)
+        return _ChatVectors(
+            msg_ids=[r[0] for r in rows],
+            ts=np.array([r[1] for r in rows], dtype=np.float64),
+            matrix=_normalize(matrix),
+        )
+
+    def _chat(self, chat_id: str) -> _ChatVectors:
+        with self._lock:
+            vectors = self._chats.get(chat_id)
+            if vectors is not None:
+                self._chats.move_to_end(chat_id)
+                return vectors
+        vectors = self._load(chat_id)
+        with self._lock:
+            self._chats[chat_id] = vectors
+            while len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+        return vectors
+
+    def add(self, rows: List[Tuple[str, str, float, List[float]]]) -> int:
+        """rows: (chat_id, msg_id, ts, embedding). Persists and updates loaded chats."""
+        if not rows:
+            return 0
+        vectors = np.asarray([r[3] for r in rows], dtype=np.float32)
+        if not self.dim:
+            self.dim = vectors.shape[1]
+        if vectors.shape[1] != self.dim:
+            raise ValueError(f"embedding dim {vectors.shape[1]} != index dim {self.dim}")
+        self.store.add_embeddings(
+            [(c, m, ts, self.dim, v.tobytes()) for (c, m, ts, _), v in zip(rows, vectors)]
+        )
+        normalized = _normalize(vectors)
+        with self._lock:
+            for (chat_id, msg_id, ts, _), v in zip(rows, normalized):
+                cached = self._chats.get(chat_id)
+                if cached is None or msg_id in cached.msg_ids:
+                    continue
+                cached.msg_ids.append(msg_id)
+                cached.ts = np.append(cached.ts, ts)
+                cached.matrix = np.vstack([cached.matrix, v[None, :]])
+        return len(rows)
+
+    def search(
+        self,
+        chat_id: str,
+        query: List[float],
+        k: int,
+        before_ts: Optional[float] = None,
+        min_score: float = 0.0,
+    ) -> List[Tuple[str, float]]:
+        """Top-k (msg_id, cosine score), best first."""
+        if not self.dim:
+            self.dim = len(query)
+        if k <= 0 or len(query) != self.dim:
+            return []
+        vectors = self._chat(chat_id)
+        if not vectors.msg_ids:
+            return []
+        q = _normalize(np.asarray([query], dtype=np.float32))[0]
+        scores = vectors.matrix @ q
+        if before_ts is not None:
+            scores = np.where(vectors.ts < before_ts, scores, -np.inf)
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [
+            (vectors.msg_ids[i], float(scores[i]))
+            for i in top
+            if scores[i] >= min_score
+        ]
+
+    def clear(self) -> None:
+        """Drop loaded chats (e.g. after pruning); they reload on next search."""
+        with self._lock:
+            self._chats.clear()
+
+
+class EmbeddingRecall:
+    """
+    Keeps the index in step with incoming messages and answers recall queries.
+
+    submit() only queues the message; a background task embeds queued
+    messages in batches while the model is idle (LLMScheduler.run_when_idle),
+    so indexing never delays a reply. Messages dropped on overflow or lost
+    on restart are caught up by backfill().
+    """
+
+    def __init__(
+        self,
+        client: OllamaClient,
+        astore: AsyncMemoryStore,
+        scheduler: LLMScheduler,
+        model: str,
+        batch_size: int = 32,
+        min_chars: int = 12,
+        max_queue: int = 2000,
+        query_timeout: float = 5.0,
+    ) -> None:
+        self.client = client
+        self.astore = astore
+        self.scheduler = scheduler
+        self.model = model
+        self.batch_size = batch_size
+        self.min_chars = min_chars
+        self.query_timeout = query_timeout
+        self.index = EmbeddingIndex(astore.store)
+        self._queue: "asyncio.Queue[Tuple[str, str, str, float]]" = asyncio.Queue(max_queue)
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def queued(self) -> int:
+        return self._queue.qsize()
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def close(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def submit(self, chat_id: str, msg_id: str, text: str) -> None:
+        text = text.strip()
+        if len(text) < self.min_chars:
+            return
+        # Same clock as MemoryStore.add_message
+        ts = datetime.utcnow().timestamp()
+        try:
+            self._queue.put_nowait((chat_id, msg_id, text, ts))
+        except asyncio.QueueFull:
+            pass  # backfill() will pick it up
+
+    async def _index(self, batch: List[Tuple[str, str, str, float]]) -> None:
+        texts = [t for _, _, t, _ in batch]
+        embeddings = await self.scheduler.run_when_idle(
+            lambda: self.client.embed(texts, model=self.model)
+        )
+        rows = [(c, m, ts, e) for (c, m, _, ts), e in zip(batch, embeddings)]
+        await self.astore.run(self.index.add, rows)
+
+    async def _loop(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                await self._index(batch)
+            except (OllamaError, aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                print(f"Не удалось проиндексировать {len(batch)} сообщений: {e!r}")
+
+    async def backfill(self, limit: int = 500) -> int:
+        """Embed stored messages that have no vector yet; returns how many."""
+        rows: List[MessageRow] = await self.astore.run(
+            self.astore.store.find_unembedded_messages, limit, self.min_chars
+        )
+        done = 0
+        for i in range(0, len(rows), self.batch_size):
+            chunk = rows[i : i + self.batch_size]
+            await self._index([(r.chat_id, r.msg_id, r.text, r.ts) for r in chunk])
+            done += len(chunk)
+        return done
+
+    async def recall(
+        self,
+        chat_id: str,
+        text: str,
+        k: int,
+        min_score: float = 0.3,
+    ) -> List[MessageRow]:
+        """
+        Up to k stored messages of the chat most similar to `text`, oldest
+        first. Returns [] if the embedding call fails or times out: recall is
+        an optional extra, never a reason to fail a reply.
+        """
+        if k <= 0 or not text.strip():
+            return []
+        try:
+            [query] = await self.client.embed(
+                [text], model=self.model, timeout=self.query_timeout
+            )
+        except (OllamaError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"Поиск по памяти недоступен: {e!r}")
+            return []
+        hits = await self.astore.run(self.index.search, chat_id, query, k, None, min_score)
+        return await self.astore.run(
+            self.astore.store.get_messages_by_ids, chat_id, [m for m, _ in hits]
+        )
@@ -0,0 +1,120 @@
+import asyncio
+import itertools
+import json
+import time
+from typing import Any, AsyncGenerator, Dict, Iterator, List, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import TelegramMethod
+from aiogram.methods.base import TelegramType
+
+
+class FakeTelegramSession(BaseSession):
+    """
+    A Bot API session that talks to nobody: every call is recorded in
+    `calls` and answered locally, so the bot can run (webhook mode, load
+    tests) without a token or network access.
+
+    Sent and edited messages get increasing ids in a chat built from the
+    request; unknown methods return True. `latency` adds a delay per call to
+    imitate the real API. Replies go through check_response(), so the
+    returned objects are bound to the bot just like real ones.
+    """
+
+    BOT_USER = {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+
+    def __init__(self, latency: float = 0.0, poll_interval: float = 1.0) -> None:
+        super().__init__()
+        self.latency = latency
+        self.poll_interval = poll_interval
+        self.calls: List[Tuple[str, Dict[str, Any]]] = []
+        self._ids = itertools.count(1)
+
+    def sent(self, chat_id: Optional[int] = None) -> List[str]:
+        """Texts of sendMessage calls, optionally for one chat."""
+        return [
+            params["text"]
+            for name, params in self.calls
+            if name == "sendMessage" and (chat_id is None or params.get("chat_id") == chat_id)
+        ]
+
+    async def make_request(
+        self,
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+        timeout: Optional[int] = None,
+    ) -> TelegramType:
+        name = method.__api_method__
+        params = method.model_dump(exclude_none=True, exclude_defaults=True)
+        self.calls.append((name, params))
+        if name == "getUpdates":
+            # Nothing ever arrives; sleep like a long poll instead of spinning.
+            await asyncio.sleep(self.poll_interval)
+        elif self.latency:
+            await asyncio.sleep(self.latency)
+        content = json.dumps({"ok": True, "result": self._result(name, params)})
+        return self.check_response(bot, method, 200, content).result
+
+    def _result(self, name: str, params: Dict[str, Any]) -> Any:
+        if name == "getMe":
+            return self.BOT_USER
+        if name == "getUpdates":
+            return []
+        if name in ("sendMessage", "editMessageText"):
+            chat_id = params.get("chat_id", 0)
+            private = isinstance(chat_id, int) and chat_id > 0
+            return {
+                "message_id": params.get("message_id") or next(self._ids),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private" if private else "group"},
+                "from": self.BOT_USER,
+                "text": params.get("text", ""),
+            }
+        return True
+
+    async def stream_content(
+        self,
+        url: str,
+        headers: Optional[Dict[str, Any]] = None,
+        timeout: int = 30,
+        chunk_size: int = 65536,
+        raise_for_status: bool = True,
+    ) -> AsyncGenerator[bytes, None]:
+        yield b""
+
+    async def close(self) -> None:
+        pass
+
+
+def fake_updates(
+    count: int,
+    chats: int = 10,
+    reply_every: int = 0,
+    start_id: int = 1,
+) -> Iterator[Dict[str, Any]]:
+    """
+    Synthetic Bot API updates (raw JSON dicts, as Telegram would POST them):
+    group messages spread round-robin over `chats` chats, every
+    `reply_every`-th of them a reply to the bot (0 = none), so they reach the
+    reply handler instead of only being stored.
+    """
+    for i in range(count):
+        update_id = start_id + i
+        chat_id = -1000 - i % chats
+        message: Dict[str, Any] = {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "group"},
+            "from": {"id": 100 + i % 7, "is_bot": False, "first_name": f"user{i % 7}"},
+            "text": f"сообщение {update_id} в чате {chat_id}, как дела?",
+        }
+        if reply_every and i % reply_every == 0:
+            message["reply_to_message"] = {
+                "message_id": 1,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "group"},
+                "from": FakeTelegramSession.BOT_USER,
+                "text": "…",
+            }
+        yield {"update_id": update_id, "message": message}
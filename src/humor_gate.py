@@ -1,7 +1,10 @@
+import bisect
 import random
+import re
 import time
 from dataclasses import dataclass
-from typing import Optional, Tuple
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
 
 
 @dataclass
@@ -10,10 +13,112 @@ class HumorConfig:
     min_gap_seconds: int = 180
     min_length: int = 6
     max_length: int = 600
-    # Leave empty to disable keyword blocking entirely.
+    # Leave empty to disable keyword blocking entirely. See KeywordMatcher
+    # for the "stem*" and "=word" forms.
     block_keywords: Tuple[str, ...] = ()
 
 
+def _trie_regex(words: Iterable[str]) -> str:
+    """
+    One regex alternation for many literal words, factored by common
+    prefixes ("cat", "car" -> "ca(?:t|r)"), so the regex engine tries each
+    starting character once instead of once per word.
+    """
+    trie: Dict[str, dict] = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[""] = {}
+
+    def render(node: Dict[str, dict]) -> str:
+        ends = "" in node
+        branches = [re.escape(ch) + render(child) for ch, child in sorted(node.items()) if ch]
+        if not branches:
+            return ""
+        if len(branches) == 1 and not ends:
+            return branches[0]
+        body = "(?:" + "|".join(branches) + ")"
+        return body + "?" if ends else body
+
+    return render(trie)
+
+
+class KeywordMatcher:
+    """
+    A blocklist compiled into a single regex, built once per keyword set.
+
+    Keyword forms (case-insensitive):
+      "foo"    substring anywhere, as the old `k in text` check
+      "foo*"   stem: a word starting with "foo" ("foo", "foobar")
+      "=foo"   the whole word "foo" only
+
+    A short list of plain substrings is checked with `in` instead: below
+    SMALL_LIST keywords that beats the regex (see bench/bench_humor.py).
+    """
+
+    SMALL_LIST = 64
+
+    def __init__(self, keywords: Iterable[str]) -> None:
+        substrings, stems, words = set(), set(), set()
+        for k in keywords:
+            k = k.strip().lower()
+            if k.startswith("=") and len(k) > 1:
+                words.add(k[1:])
+            elif k.endswith("*") and len(k) > 1:
+                stems.add(k[:-1])
+            elif k:
+                substrings.add(k)
+        parts = []
+        if substrings:
+            parts.append(_trie_regex(substrings))
+        if stems:
+            parts.append(r"\b" + _trie_regex(stems))
+        if words:
+            parts.append(r"\b" + _trie_regex(words) + r"\b")
+        self.size = len(substrings) + len(stems) + len(words)
+        self._plain: Optional[Tuple[str, ...]] = None
+        if not stems and not words and len(substrings) < self.SMALL_LIST:
+            self._plain = tuple(substrings)
+        self._re: Optional["re.Pattern[str]"] = (
+            re.compile("|".join(f"(?:{p})" for p in parts)) if parts else None
+        )
+
+    def __bool__(self) -> bool:
+        return self._re is not None
+
+    def search(self, text: str) -> bool:
+        """text must already be lower-cased."""
+        if self._plain is not None:
+            return any(k in text for k in self._plain)
+        return self._re is not None and self._re.search(text) is not None
+
+    def search_many(self, texts: Sequence[str]) -> List[bool]:
+        """
+        search() for many lower-cased texts with one scan: they are joined
+        with newlines (keywords never contain one) and each match is mapped
+        back to its text.
+        """
+        if self._plain is not None:
+            return [any(k in t for k in self._plain) for t in texts]
+        hits = [False] * len(texts)
+        if self._re is None or not texts:
+            return hits
+        starts = []
+        pos = 0
+        for t in texts:
+            starts.append(pos)
+            pos += len(t) + 1
+        for m in self._re.finditer("\n".join(texts)):
+            hits[bisect.bisect_right(starts, m.start()) - 1] = True
+        return hits
+
+
+@lru_cache(maxsize=64)
+def compile_keywords(keywords: Tuple[str, ...]) -> KeywordMatcher:
+    return KeywordMatcher(keywords)
+
+
 def should_add_humor(
     user_text: str,
     last_humor_ts: Optional[float],
@@ -24,9 +129,31 @@ def should_add_humor(
         return False
     if len(text) < cfg.min_length or len(text) > cfg.max_length:
         return False
-    if cfg.block_keywords and any(k in text for k in cfg.block_keywords):
+    if cfg.block_keywords and compile_keywords(cfg.block_keywords).search(text):
         return False
     if last_humor_ts and (time.time() - last_humor_ts) < cfg.min_gap_seconds:
         return False
     return random.random() < cfg.humor_rate
 
+
+def should_add_humor_batch(
+    user_texts: Sequence[str],
+    last_humor_ts: Optional[float],
+    cfg: HumorConfig,
+) -> List[bool]:
+    """should_add_humor for many messages of one chat, blocklist checked in one pass."""
+    if last_humor_ts and (time.time() - last_humor_ts) < cfg.min_gap_seconds:
+        return [False] * len(user_texts)
+    texts = [t.lower().strip() for t in user_texts]
+    blocked = (
+        compile_keywords(cfg.block_keywords).search_many(texts)
+        if cfg.block_keywords
+        else [False] * len(texts)
+    )
+    return [
+        bool(t)
+        and cfg.min_length <= len(t) <= cfg.max_length
+        and not b
+        and random.random() < cfg.humor_rate
+        for t, b in zip(texts, blocked)
+    ]
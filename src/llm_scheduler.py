@@ -0,0 +1,151 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Tuple
+
+
+@dataclass
+class _Job:
+    chat_id: str
+    kind: str
+    run: Callable[[], Awaitable[Any]]
+    deadline: float
+    future: "asyncio.Future[Any]"
+    enqueued_at: float = field(default_factory=time.monotonic)
+
+
+@dataclass
+class SchedulerStats:
+    submitted: int = 0
+    completed: int = 0
+    failed: int = 0
+    coalesced: int = 0
+    expired: int = 0
+    background: int = 0
+
+
+class LLMScheduler:
+    """
+    Sits between handlers and the Ollama client.
+
+    - At most `max_concurrency` generations run at once.
+    - Waiting jobs are grouped per chat and dispatched round-robin across
+      chats, so one busy chat cannot starve the others.
+    - A job still queued after its deadline is dropped instead of being
+      answered minutes late.
+    - A new job for a (chat, kind) that already has one waiting replaces it:
+      the generation runs once, with context built at dispatch time, and
+      the superseded submitters get None.
+
+    submit() returns the job's result, or None when it was dropped.
+    run_when_idle() is for background work (summaries): it waits until
+    nothing is running or queued, then holds a slot like a regular job.
+    """
+
+    def __init__(self, max_concurrency: int = 1, queue_deadline: float = 90.0) -> None:
+        self.max_concurrency = max(1, max_concurrency)
+        self.queue_deadline = queue_deadline
+        self.stats = SchedulerStats()
+        self._queues: "OrderedDict[str, Deque[_Job]]" = OrderedDict()
+        self._waiting: Dict[Tuple[str, str], _Job] = {}
+        self._running = 0
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiting)
+
+    @property
+    def running(self) -> int:
+        return self._running
+
+    async def submit(
+        self,
+        chat_id: str,
+        run: Callable[[], Awaitable[Any]],
+        kind: str = "reply",
+        deadline: Optional[float] = None,
+    ) -> Any:
+        loop = asyncio.get_running_loop()
+        job = _Job(
+            chat_id=chat_id,
+            kind=kind,
+            run=run,
+            deadline=time.monotonic() + (deadline if deadline is not None else self.queue_deadline),
+            future=loop.create_future(),
+        )
+        self.stats.submitted += 1
+
+        key = (chat_id, kind)
+        previous = self._waiting.get(key)
+        queue = self._queues.setdefault(chat_id, deque())
+        if previous is not None:
+            # Take over the superseded job's place in the chat queue.
+            queue[queue.index(previous)] = job
+            self.stats.coalesced += 1
+            if not previous.future.done():
+                previous.future.set_result(None)
+        else:
+            queue.append(job)
+        self._waiting[key] = job
+
+        self._pump()
+        return await job.future
+
+    async def run_when_idle(
+        self,
+        run: Callable[[], Awaitable[Any]],
+        poll: float = 0.5,
+    ) -> Any:
+        while self._running or self._waiting:
+            await asyncio.sleep(poll)
+        self._running += 1
+        self.stats.background += 1
+        try:
+            return await run()
+        finally:
+            self._running -= 1
+            self._pump()
+
+    def _next_job(self) -> Optional[_Job]:
+        while self._queues:
+            chat_id, queue = next(iter(self._queues.items()))
+            job = queue.popleft()
+            # Round-robin: the chat goes to the back of the line.
+            if queue:
+                self._queues.move_to_end(chat_id)
+            else:
+                del self._queues[chat_id]
+            if self._waiting.get((job.chat_id, job.kind)) is job:
+                del self._waiting[(job.chat_id, job.kind)]
+            if job.future.done():
+                continue  # submitter went away
+            if time.monotonic() > job.deadline:
+                self.stats.expired += 1
+                job.future.set_result(None)
+                continue
+            return job
+        return None
+
+    def _pump(self) -> None:
+        while self._running < self.max_concurrency:
+            job = self._next_job()
+            if job is None:
+                return
+            self._running += 1
+            asyncio.create_task(self._execute(job))
+
+    async def _execute(self, job: _Job) -> None:
+        try:
+            result = await job.run()
+        except Exception as e:
+            self.stats.failed += 1
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            self.stats.completed += 1
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            self._running -= 1
+            self._pump()
@@ -0,0 +1,181 @@
+import asyncio
+import random
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Mapping, Optional
+
+
+@dataclass
+class JobStats:
+    runs: int = 0
+    failures: int = 0
+    last_started: Optional[float] = None
+    last_duration: Optional[float] = None
+    total_duration: float = 0.0
+    last_error: Optional[str] = None
+
+
+@dataclass
+class _Job:
+    name: str
+    fn: Callable[[], Awaitable[Any]]
+    next_run: datetime
+    interval: Optional[timedelta] = None
+    hour: int = 0
+    minute: int = 0
+    weekday: Optional[int] = None
+    stats: JobStats = field(default_factory=JobStats)
+
+    def slot_after(self, moment: datetime) -> datetime:
+        if self.interval is not None:
+            return moment + self.interval
+        nxt = moment.replace(hour=self.hour, minute=self.minute, second=0, microsecond=0)
+        if nxt <= moment:
+            nxt += timedelta(days=1)
+        if self.weekday is not None:
+            nxt += timedelta(days=(self.weekday - nxt.weekday()) % 7)
+        return nxt
+
+    def schedule_next(self, now: datetime) -> None:
+        self.next_run = self.slot_after(now)
+
+
+class MaintenanceScheduler:
+    """
+    Runs housekeeping jobs (pruning, summaries, WAL checkpoints, vacuum) in
+    one background task, off the message handlers.
+
+    Jobs are global and run one at a time, so each job runs once per schedule
+    slot no matter how many chats are active, and two heavy SQLite jobs never
+    overlap. Schedules are either a fixed interval or a daily/weekly wall
+    clock time. Durations and failures are kept in `JobStats` per job.
+
+    Each successful run is reported to `on_run(name, started)` so the
+    caller can persist it; start() takes those times back as `last_runs`
+    and runs a job whose slot passed while the bot was down right away.
+    Jobs due at start (that, or run_at_start) are not fired together: the
+    first waits `startup_delay` plus a random share of `startup_jitter`,
+    the rest follow `stagger` seconds apart, so a restart does not hit
+    SQLite and Ollama all at once.
+
+    Only failures and runs longer than `slow_seconds` are logged; the rest
+    is in the stats.
+    """
+
+    def __init__(
+        self,
+        startup_delay: float = 0.0,
+        startup_jitter: float = 0.0,
+        stagger: float = 0.0,
+        slow_seconds: float = 5.0,
+        on_run: Optional[Callable[[str, float], Awaitable[None]]] = None,
+    ) -> None:
+        self.startup_delay = startup_delay
+        self.startup_jitter = startup_jitter
+        self.stagger = stagger
+        self.slow_seconds = slow_seconds
+        self.on_run = on_run
+        self._jobs: Dict[str, _Job] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+
+    def every(
+        self,
+        name: str,
+        seconds: float,
+        fn: Callable[[], Awaitable[Any]],
+        run_at_start: bool = False,
+    ) -> None:
+        interval = timedelta(seconds=seconds)
+        now = datetime.now()
+        first = now if run_at_start else now + interval
+        self._jobs[name] = _Job(name, fn, first, interval=interval)
+
+    def daily(
+        self,
+        name: str,
+        fn: Callable[[], Awaitable[Any]],
+        hour: int = 4,
+        minute: int = 0,
+        weekday: Optional[int] = None,
+        run_at_start: bool = False,
+    ) -> None:
+        """
+        weekday (0 = Monday) turns the daily job into a weekly one.
+        run_at_start also runs it once right after start(), whether or not
+        a slot was missed.
+        """
+        job = _Job(name, fn, datetime.now(), hour=hour, minute=minute, weekday=weekday)
+        if not run_at_start:
+            job.schedule_next(datetime.now())
+        self._jobs[name] = job
+
+    def stats(self) -> Dict[str, JobStats]:
+        return {name: job.stats for name, job in self._jobs.items()}
+
+    def start(self, last_runs: Optional[Mapping[str, float]] = None) -> None:
+        """last_runs: {job name: start of its last successful run} from on_run."""
+        if self._task is not None:
+            return
+        now = datetime.now()
+        for name, started in (last_runs or {}).items():
+            job = self._jobs.get(name)
+            if job is not None and job.slot_after(datetime.fromtimestamp(started)) <= now:
+                job.next_run = min(job.next_run, now)
+        delay = self.startup_delay + random.uniform(0, self.startup_jitter)
+        for i, job in enumerate(self._due(now)):
+            job.next_run = now + timedelta(seconds=delay + i * self.stagger)
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def run_now(self, name: str) -> None:
+        """Run a job immediately (e.g. from an admin command)."""
+        await self._run(self._jobs[name])
+
+    async def _run(self, job: _Job) -> None:
+        async with self._lock:
+            job.stats.last_started = time.time()
+            started = time.perf_counter()
+            try:
+                await job.fn()
+                if self.on_run is not None:
+                    await self.on_run(job.name, job.stats.last_started)
+            except Exception as e:
+                job.stats.failures += 1
+                job.stats.last_error = repr(e)
+                print(f"Обслуживание {job.name}: ошибка {e!r}")
+            finally:
+                duration = time.perf_counter() - started
+                job.stats.runs += 1
+                job.stats.last_duration = duration
+                job.stats.total_duration += duration
+                job.schedule_next(datetime.now())
+        if duration >= self.slow_seconds:
+            print(f"Обслуживание {job.name}: {duration:.2f} сек")
+
+    def _due(self, now: datetime) -> List[_Job]:
+        return sorted(
+            (j for j in self._jobs.values() if j.next_run <= now),
+            key=lambda j: j.next_run,
+        )
+
+    async def _loop(self) -> None:
+        while True:
+            for job in self._due(datetime.now()):
+                await self._run(job)
+            if not self._jobs:
+                return
+            nearest = min(j.next_run for j in self._jobs.values())
+            # Re-check at least once a minute so clock jumps and DST don't strand jobs.
+            delay = min(60.0, max(0.0, (nearest - datetime.now()).total_seconds()))
+            await asyncio.sleep(delay)
@@ -1,11 +1,27 @@
+import asyncio
+import bisect
+import functools
+import json
+import queue
+import re
 import sqlite3
-from dataclasses import dataclass
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, date, timedelta
-from typing import Iterable, Optional, List, Tuple
+from typing import Any, Callable, Dict, Iterable, Iterator, NamedTuple, Optional, List, Tuple
 
 
-@dataclass
-class MessageRow:
+class MessageRow(NamedTuple):
+    """
+    A stored message. A plain tuple underneath: no per-instance __dict__,
+    and rows are built straight from SQLite's column tuples (see
+    MemoryStore._message_cursor).
+    """
+
     chat_id: str
     msg_id: str
     role: str  # "user" or "assistant" or "system"
@@ -13,20 +29,286 @@ class MessageRow:
     ts: float
 
 
+_WORD_RE = re.compile(r"\w{3,}")
+
+
+def _fts_query(text: str, max_terms: int = 8) -> str:
+    """
+    OR-query of the longest distinct words of `text`, each quoted so user
+    input can never be parsed as FTS5 syntax. Longer words lose their last
+    two letters and become prefix queries, a crude stemmer that lets
+    "Барсика" match "Барсик". Empty if there is nothing to find.
+    """
+    words = list(dict.fromkeys(w.lower() for w in _WORD_RE.findall(text)))
+    words.sort(key=len, reverse=True)
+    terms = [f'"{w[:-2]}"*' if len(w) >= 6 else f'"{w}"' for w in words[:max_terms]]
+    return " OR ".join(terms)
+
+
+def _archive_codec(name: str) -> Tuple[Callable[[bytes], bytes], Callable[[bytes], bytes]]:
+    """(compress, decompress) for an archive codec: "zlib", or "zstd" with the zstandard package."""
+    if name == "zlib":
+        return functools.partial(zlib.compress, level=9), zlib.decompress
+    if name == "zstd":
+        try:
+            import zstandard
+        except ImportError as e:
+            raise RuntimeError("MEMORY_ARCHIVE_CODEC=zstd requires the `zstandard` package") from e
+        return (
+            zstandard.ZstdCompressor(level=10).compress,
+            zstandard.ZstdDecompressor().decompress,
+        )
+    raise ValueError(f"Unknown archive codec: {name}")
+
+
+class RecentMessagesCache:
+    """
+    Per-chat ring buffers of the newest messages with LRU eviction across chats.
+
+    A chat is hydrated from SQLite on its first read and afterwards kept up to
+    date by MemoryStore writes, so get_recent_messages() is served from RAM.
+    Memory is bounded both by the number of chats and by an approximate byte
+    budget (text length plus a fixed per-row overhead).
+    """
+
+    ROW_OVERHEAD = 120
+
+    def __init__(
+        self,
+        capacity: int = 64,
+        max_chats: int = 1000,
+        max_bytes: int = 32 * 1024 * 1024,
+    ) -> None:
+        self.capacity = max(1, capacity)
+        self.max_chats = max(1, max_chats)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # chat_id -> (rows sorted by ts, complete); `complete` means the
+        # buffer holds the chat's whole history, so any limit can be served.
+        self._chats: "OrderedDict[str, Tuple[List[MessageRow], bool]]" = OrderedDict()
+        self._bytes = 0
+        # Chats being hydrated -> one buffer per fill in progress: writes
+        # that race with a fill's SELECT land in each of them.
+        self._filling: Dict[str, List[List[MessageRow]]] = {}
+
+    @classmethod
+    def _cost(cls, rows: Iterable[MessageRow]) -> int:
+        return sum(len(r.text) + cls.ROW_OVERHEAD for r in rows)
+
+    def get(self, chat_id: str, limit: int) -> Optional[List[MessageRow]]:
+        with self._lock:
+            entry = self._chats.get(chat_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            rows, complete = entry
+            if limit > len(rows) and not complete:
+                self.misses += 1
+                return None
+            self._chats.move_to_end(chat_id)
+            self.hits += 1
+            return rows[-limit:] if limit > 0 else []
+
+    def begin_fill(self, chat_id: str) -> List[MessageRow]:
+        """Start hydrating a chat; the returned buffer goes to finish_fill()."""
+        raced: List[MessageRow] = []
+        with self._lock:
+            self._filling.setdefault(chat_id, []).append(raced)
+        return raced
+
+    def finish_fill(self, chat_id: str, rows: List[MessageRow], raced: List[MessageRow]) -> None:
+        """
+        Install `rows` (read after begin_fill()) plus the writes that raced
+        with that read. Every fill has its own buffer, so overlapping fills
+        of one chat each see all the writes made since they began.
+        """
+        with self._lock:
+            fills = [f for f in self._filling.get(chat_id, []) if f is not raced]
+            if fills:
+                self._filling[chat_id] = fills
+            else:
+                self._filling.pop(chat_id, None)
+            complete = len(rows) < self.capacity
+            buf = list(rows)
+            for r in raced:
+                self._insert(buf, r)
+            if len(buf) > self.capacity:
+                buf = buf[-self.capacity:]
+            old = self._chats.pop(chat_id, None)
+            if old is not None:
+                self._bytes -= self._cost(old[0])
+            self._chats[chat_id] = (buf, complete)
+            self._bytes += self._cost(buf)
+            self._evict()
+
+    @staticmethod
+    def _insert(buf: List[MessageRow], row: MessageRow) -> int:
+        """Insert keeping ts order; returns the byte delta."""
+        delta = len(row.text) + RecentMessagesCache.ROW_OVERHEAD
+        for i, r in enumerate(buf):
+            if r.msg_id == row.msg_id:
+                delta -= len(r.text) + RecentMessagesCache.ROW_OVERHEAD
+                del buf[i]
+                break
+        if not buf or buf[-1].ts <= row.ts:
+            buf.append(row)
+        else:
+            keys = [r.ts for r in buf]
+            buf.insert(bisect.bisect_right(keys, row.ts), row)
+        return delta
+
+    def append(self, row: MessageRow) -> None:
+        with self._lock:
+            for raced in self._filling.get(row.chat_id, ()):
+                raced.append(row)
+            entry = self._chats.get(row.chat_id)
+            if entry is None:
+                return
+            buf, complete = entry
+            self._bytes += self._insert(buf, row)
+            if len(buf) > self.capacity:
+                dropped = buf[: len(buf) - self.capacity]
+                del buf[: len(buf) - self.capacity]
+                self._bytes -= self._cost(dropped)
+                complete = False
+            self._chats[row.chat_id] = (buf, complete)
+            self._evict()
+
+    def drop_older_than(self, cutoff_ts: float) -> None:
+        with self._lock:
+            for chat_id, (buf, complete) in list(self._chats.items()):
+                keep = [r for r in buf if r.ts >= cutoff_ts]
+                if len(keep) != len(buf):
+                    self._bytes -= self._cost(buf) - self._cost(keep)
+                    self._chats[chat_id] = (keep, complete)
+
+    def invalidate(self, chat_id: Optional[str] = None) -> None:
+        with self._lock:
+            if chat_id is None:
+                self._chats.clear()
+                self._bytes = 0
+                return
+            entry = self._chats.pop(chat_id, None)
+            if entry is not None:
+                self._bytes -= self._cost(entry[0])
+
+    def _evict(self) -> None:
+        while self._chats and (
+            len(self._chats) > self.max_chats or self._bytes > self.max_bytes
+        ):
+            _, (buf, _) = self._chats.popitem(last=False)
+            self._bytes -= self._cost(buf)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "chats": len(self._chats),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
 class MemoryStore:
-    def __init__(self, db_path: str) -> None:
+    """
+    SQLite-backed chat memory.
+
+    Connections are long-lived: one dedicated writer (serialized by a lock)
+    and up to `readers` reader connections handed out from a pool. WAL mode
+    lets readers run concurrently with the writer, so methods are safe to call
+    from several executor threads at once.
+
+    With a `recent_cache`, get_recent_messages() is answered from RAM for any
+    limit up to the cache capacity.
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        readers: int = 2,
+        recent_cache: Optional[RecentMessagesCache] = None,
+    ) -> None:
         self.db_path = db_path
+        self.readers = max(1, readers)
+        self.recent_cache = recent_cache
+        self._write_lock = threading.Lock()
+        self._pool_lock = threading.Lock()
+        self._reader_pool: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._all_conns: List[sqlite3.Connection] = []
+        self._readers_open = 0
+        # Write-behind buffer: rows accepted by enqueue_message but not yet
+        # committed. `_inflight` holds the batch currently being flushed so
+        # readers keep seeing it until the commit lands.
+        self._pending_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending: List[MessageRow] = []
+        self._inflight: List[MessageRow] = []
+        self._writer = self._connect()
         self._init_db()
 
     def _connect(self) -> sqlite3.Connection:
-        conn = sqlite3.connect(self.db_path)
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=30)
         conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA synchronous=NORMAL")
+        with self._pool_lock:
+            self._all_conns.append(conn)
         return conn
 
+    @staticmethod
+    def _message_cursor(
+        conn: sqlite3.Connection,
+        chat_id: Optional[str],
+        sql: str,
+        params: Tuple[Any, ...],
+    ) -> sqlite3.Cursor:
+        """
+        Execute a messages query whose rows come out as MessageRow directly,
+        without an intermediate sqlite3.Row and dict per row. With chat_id
+        given the query selects (msg_id, role, text, ts) and every row shares
+        that one chat_id string; without it, all five columns.
+        """
+        cur = conn.cursor()
+        if chat_id is None:
+            cur.row_factory = lambda _cur, r: MessageRow._make(r)
+        else:
+            cur.row_factory = lambda _cur, r: MessageRow(chat_id, *r)
+        return cur.execute(sql, params)
+
+    @contextmanager
+    def _write(self) -> Iterator[sqlite3.Connection]:
+        with self._write_lock:
+            with self._writer as conn:
+                yield conn
+
+    @contextmanager
+    def _read(self) -> Iterator[sqlite3.Connection]:
+        try:
+            conn = self._reader_pool.get_nowait()
+        except queue.Empty:
+            with self._pool_lock:
+                can_open = self._readers_open < self.readers
+                if can_open:
+                    self._readers_open += 1
+            conn = self._connect() if can_open else self._reader_pool.get()
+        try:
+            yield conn
+        finally:
+            self._reader_pool.put(conn)
+
+    def close(self) -> None:
+        with self._write_lock, self._pool_lock:
+            for conn in self._all_conns:
+                conn.close()
+            self._all_conns.clear()
+            self._readers_open = 0
+
     def _init_db(self) -> None:
-        with self._connect() as conn:
+        with self._write() as conn:
+            # Only takes effect for a fresh file; compact() converts old ones.
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
             conn.execute("PRAGMA journal_mode=WAL")
-            conn.execute("PRAGMA synchronous=NORMAL")
             conn.execute(
                 """
                 CREATE TABLE IF NOT EXISTS messages (
@@ -50,6 +332,18 @@ class MemoryStore:
                 )
                 """
             )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS message_embeddings (
+                    chat_id TEXT NOT NULL,
+                    msg_id TEXT NOT NULL,
+                    ts REAL NOT NULL,
+                    dim INTEGER NOT NULL,
+                    vec BLOB NOT NULL,
+                    PRIMARY KEY (chat_id, msg_id)
+                )
+                """
+            )
             conn.execute(
                 """
                 CREATE INDEX IF NOT EXISTS idx_messages_chat_ts
@@ -62,6 +356,146 @@ class MemoryStore:
                 ON summaries(chat_id, day)
                 """
             )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS weekly_summaries (
+                    chat_id TEXT NOT NULL,
+                    week TEXT NOT NULL,
+                    summary TEXT NOT NULL,
+                    ts REAL NOT NULL,
+                    PRIMARY KEY (chat_id, week)
+                )
+                """
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS summary_cache (
+                    digest TEXT PRIMARY KEY,
+                    summary TEXT NOT NULL,
+                    ts REAL NOT NULL
+                )
+                """
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS summary_progress (
+                    chat_id TEXT NOT NULL,
+                    day TEXT NOT NULL,
+                    msg_count INTEGER NOT NULL,
+                    status TEXT NOT NULL,
+                    ts REAL NOT NULL,
+                    PRIMARY KEY (chat_id, day)
+                )
+                """
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS chat_settings (
+                    chat_id TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    ts REAL NOT NULL,
+                    PRIMARY KEY (chat_id, name)
+                )
+                """
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS session_state (
+                    chat_id TEXT PRIMARY KEY,
+                    last_humor_ts REAL,
+                    last_joke_day TEXT,
+                    jokes_today INTEGER NOT NULL DEFAULT 0
+                )
+                """
+            )
+            # Last successful run of each maintenance job (MaintenanceScheduler).
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS maintenance_runs (
+                    name TEXT PRIMARY KEY,
+                    ts REAL NOT NULL
+                )
+                """
+            )
+            conn.execute(
+                """
+                CREATE INDEX IF NOT EXISTS idx_embeddings_chat_ts
+                ON message_embeddings(chat_id, ts)
+                """
+            )
+            # Cold tier: one compressed JSON blob of [msg_id, role, text, ts]
+            # rows per chat and local day (see archive_old_messages).
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS message_archive (
+                    chat_id TEXT NOT NULL,
+                    day TEXT NOT NULL,
+                    codec TEXT NOT NULL,
+                    msg_count INTEGER NOT NULL,
+                    raw_bytes INTEGER NOT NULL,
+                    data BLOB NOT NULL,
+                    ts REAL NOT NULL,
+                    PRIMARY KEY (chat_id, day)
+                )
+                """
+            )
+            self._init_fts(conn)
+
+    @staticmethod
+    def _init_fts(conn: sqlite3.Connection) -> None:
+        """
+        Full-text index over messages.text (external content, so the text is
+        not stored twice), kept in sync by triggers. Writes to messages must
+        be UPSERTs rather than INSERT OR REPLACE: the implicit delete of a
+        REPLACE does not fire delete triggers.
+
+        chat_id is indexed as a second column, so a MATCH can be restricted
+        to one chat instead of ranking every chat's matches.
+        """
+        exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'"
+        ).fetchone()
+        conn.execute(
+            """
+            CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                text,
+                chat_id,
+                content = 'messages',
+                content_rowid = 'rowid',
+                tokenize = 'unicode61 remove_diacritics 2'
+            )
+            """
+        )
+        conn.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN
+                INSERT INTO messages_fts(rowid, text, chat_id)
+                VALUES (new.rowid, new.text, new.chat_id);
+            END
+            """
+        )
+        conn.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages BEGIN
+                INSERT INTO messages_fts(messages_fts, rowid, text, chat_id)
+                VALUES ('delete', old.rowid, old.text, old.chat_id);
+            END
+            """
+        )
+        conn.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF text ON messages BEGIN
+                INSERT INTO messages_fts(messages_fts, rowid, text, chat_id)
+                VALUES ('delete', old.rowid, old.text, old.chat_id);
+                INSERT INTO messages_fts(rowid, text, chat_id)
+                VALUES (new.rowid, new.text, new.chat_id);
+            END
+            """
+        )
+        if not exists:
+            # Index messages stored before the FTS table existed.
+            conn.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
 
     def add_message(
         self,
@@ -73,20 +507,134 @@ class MemoryStore:
     ) -> None:
         if ts is None:
             ts = datetime.utcnow().timestamp()
-        with self._connect() as conn:
+        with self._write() as conn:
             conn.execute(
                 """
-                INSERT OR REPLACE INTO messages(chat_id, msg_id, role, text, ts)
+                INSERT INTO messages(chat_id, msg_id, role, text, ts)
                 VALUES(?, ?, ?, ?, ?)
+                ON CONFLICT(chat_id, msg_id) DO UPDATE SET
+                    role = excluded.role, text = excluded.text, ts = excluded.ts
                 """,
                 (chat_id, msg_id, role, text, ts),
             )
+        if self.recent_cache is not None:
+            self.recent_cache.append(MessageRow(chat_id, msg_id, role, text, ts))
+
+    def add_messages(self, rows: Iterable[MessageRow]) -> int:
+        """Insert many rows with a single executemany in one transaction."""
+        rows = list(rows)
+        written = self._insert_rows(rows)
+        if self.recent_cache is not None:
+            for r in rows:
+                self.recent_cache.append(r)
+        return written
+
+    def _insert_rows(self, rows: List[MessageRow]) -> int:
+        params = [(r.chat_id, r.msg_id, r.role, r.text, r.ts) for r in rows]
+        if not params:
+            return 0
+        with self._write() as conn:
+            conn.executemany(
+                """
+                INSERT INTO messages(chat_id, msg_id, role, text, ts)
+                VALUES(?, ?, ?, ?, ?)
+                ON CONFLICT(chat_id, msg_id) DO UPDATE SET
+                    role = excluded.role, text = excluded.text, ts = excluded.ts
+                """,
+                params,
+            )
+        return len(params)
+
+    def enqueue_message(
+        self,
+        chat_id: str,
+        msg_id: str,
+        role: str,
+        text: str,
+        ts: Optional[float] = None,
+    ) -> int:
+        """
+        Buffer a message for the next flush_pending() call.
+        Returns the number of rows waiting to be written.
+        """
+        if ts is None:
+            ts = datetime.utcnow().timestamp()
+        row = MessageRow(chat_id, msg_id, role, text, ts)
+        # Buffer first, then cache, atomically with respect to a cache fill
+        # (see get_recent_messages): the fill's snapshot of the buffer either
+        # holds the row, or the fill has begun and the cache append lands in it.
+        with self._pending_lock:
+            self._pending.append(row)
+            if self.recent_cache is not None:
+                self.recent_cache.append(row)
+            return len(self._pending)
+
+    def pending_count(self) -> int:
+        with self._pending_lock:
+            return len(self._pending) + len(self._inflight)
+
+    def flush_pending(self) -> int:
+        """Commit all buffered messages in one transaction."""
+        with self._flush_lock:
+            with self._pending_lock:
+                if not self._pending:
+                    return 0
+                self._inflight, self._pending = self._pending, []
+            try:
+                return self._insert_rows(self._inflight)
+            except Exception:
+                with self._pending_lock:
+                    self._pending[:0] = self._inflight
+                raise
+            finally:
+                with self._pending_lock:
+                    self._inflight = []
+
+    def _unflushed_for(self, chat_id: str) -> List[MessageRow]:
+        with self._pending_lock:
+            return self._unflushed_locked(chat_id)
+
+    def _unflushed_locked(self, chat_id: str) -> List[MessageRow]:
+        if not self._pending and not self._inflight:
+            return []
+        return [r for r in (*self._inflight, *self._pending) if r.chat_id == chat_id]
+
+    @staticmethod
+    def _merge_rows(
+        rows: List[MessageRow], extra: List[MessageRow]
+    ) -> List[MessageRow]:
+        by_id = {r.msg_id: r for r in rows}
+        for r in extra:
+            by_id[r.msg_id] = r
+        return sorted(by_id.values(), key=lambda r: r.ts)
 
     def get_recent_messages(self, chat_id: str, limit: int) -> List[MessageRow]:
-        with self._connect() as conn:
-            rows = conn.execute(
+        cache = self.recent_cache
+        if cache is None or limit > cache.capacity:
+            return self._query_recent(chat_id, limit)
+        cached = cache.get(chat_id, limit)
+        if cached is not None:
+            return cached
+        with self._pending_lock:
+            raced = cache.begin_fill(chat_id)
+            unflushed = self._unflushed_locked(chat_id)
+        rows = self._query_recent(chat_id, cache.capacity, unflushed)
+        cache.finish_fill(chat_id, rows, raced)
+        return rows[-limit:] if limit > 0 else []
+
+    def _query_recent(
+        self, chat_id: str, limit: int, unflushed: Optional[List[MessageRow]] = None
+    ) -> List[MessageRow]:
+        # Snapshot the write-behind buffer before querying: a row is either
+        # still buffered here or already committed when the SELECT runs.
+        if unflushed is None:
+            unflushed = self._unflushed_for(chat_id)
+        with self._read() as conn:
+            result = self._message_cursor(
+                conn,
+                chat_id,
                 """
-                SELECT chat_id, msg_id, role, text, ts
+                SELECT msg_id, role, text, ts
                 FROM messages
                 WHERE chat_id = ?
                 ORDER BY ts DESC
@@ -94,26 +642,147 @@ class MemoryStore:
                 """,
                 (chat_id, limit),
             ).fetchall()
-        rows = list(reversed(rows))
-        return [MessageRow(**dict(r)) for r in rows]
+        result.reverse()
+        if unflushed and limit > 0:
+            result = self._merge_rows(result, unflushed)[-limit:]
+        return result
 
     def get_messages_for_day(self, chat_id: str, day: date) -> List[MessageRow]:
+        start, end = self._day_bounds(day)
+        unflushed = [r for r in self._unflushed_for(chat_id) if start <= r.ts < end]
+        unflushed = self.get_archived_messages(chat_id, day) + unflushed
+        with self._read() as conn:
+            result = self._message_cursor(
+                conn,
+                chat_id,
+                """
+                SELECT msg_id, role, text, ts
+                FROM messages
+                WHERE chat_id = ? AND ts >= ? AND ts < ?
+                ORDER BY ts ASC
+                """,
+                (chat_id, start, end),
+            ).fetchall()
+        if unflushed:
+            result = self._merge_rows(result, unflushed)
+        return result
+
+    @staticmethod
+    def _day_bounds(day: date) -> Tuple[float, float]:
         start = datetime.combine(day, datetime.min.time()).timestamp()
         end = datetime.combine(day + timedelta(days=1), datetime.min.time()).timestamp()
-        with self._connect() as conn:
-            rows = conn.execute(
+        return start, end
+
+    def iter_messages_for_day(
+        self, chat_id: str, day: date, batch_size: int = 256
+    ) -> Iterator[MessageRow]:
+        """
+        Lazily yield a day's committed messages in ts order, `batch_size`
+        rows per fetch. Holds a reader connection until exhausted or closed.
+        An archived day is decompressed and merged with any of its messages
+        still in the hot table.
+        """
+        archived = self.get_archived_messages(chat_id, day)
+        if archived:
+            yield from self.get_messages_for_day(chat_id, day)
+            return
+        start, end = self._day_bounds(day)
+        with self._read() as conn:
+            cur = self._message_cursor(
+                conn,
+                chat_id,
                 """
-                SELECT chat_id, msg_id, role, text, ts
+                SELECT msg_id, role, text, ts
                 FROM messages
                 WHERE chat_id = ? AND ts >= ? AND ts < ?
                 ORDER BY ts ASC
                 """,
                 (chat_id, start, end),
+            )
+            try:
+                while True:
+                    rows = cur.fetchmany(batch_size)
+                    if not rows:
+                        return
+                    yield from rows
+            finally:
+                cur.close()
+
+    def count_messages_for_day(self, chat_id: str, day: date) -> int:
+        start, end = self._day_bounds(day)
+        with self._read() as conn:
+            row = conn.execute(
+                """
+                SELECT (
+                    SELECT COUNT(*) FROM messages
+                    WHERE chat_id = ? AND ts >= ? AND ts < ?
+                ) + COALESCE((
+                    SELECT msg_count FROM message_archive
+                    WHERE chat_id = ? AND day = ?
+                ), 0)
+                """,
+                (chat_id, start, end, chat_id, day.isoformat()),
+            ).fetchone()
+        return row[0]
+
+    def find_unsummarized_days(
+        self, min_messages: int, before: date
+    ) -> List[Tuple[str, date, int]]:
+        """
+        Every (chat_id, day, message count) before `before` that has at least
+        min_messages messages and either no summary yet or more/fewer messages
+        than when it was last summarized. One grouped scan over messages,
+        plus the archived days' stored counts.
+        """
+        before_ts = datetime.combine(before, datetime.min.time()).timestamp()
+        with self._read() as conn:
+            rows = conn.execute(
+                """
+                WITH days AS (
+                    SELECT chat_id, day, SUM(n) AS n
+                    FROM (
+                        SELECT chat_id,
+                               date(ts, 'unixepoch', 'localtime') AS day,
+                               COUNT(*) AS n
+                        FROM messages
+                        WHERE ts < ?
+                        GROUP BY chat_id, day
+                        UNION ALL
+                        SELECT chat_id, day, msg_count AS n
+                        FROM message_archive
+                        WHERE day < ?
+                    )
+                    GROUP BY chat_id, day
+                )
+                SELECT d.chat_id, d.day, d.n
+                FROM days d
+                LEFT JOIN summaries s ON s.chat_id = d.chat_id AND s.day = d.day
+                LEFT JOIN summary_progress p ON p.chat_id = d.chat_id AND p.day = d.day
+                WHERE d.n >= ?
+                  AND (
+                    (p.chat_id IS NULL AND s.chat_id IS NULL)
+                    OR (p.chat_id IS NOT NULL AND p.msg_count != d.n)
+                  )
+                ORDER BY d.day ASC, d.chat_id ASC
+                """,
+                (before_ts, before.isoformat(), min_messages),
             ).fetchall()
-        return [MessageRow(**dict(r)) for r in rows]
+        return [(r["chat_id"], date.fromisoformat(r["day"]), r["n"]) for r in rows]
+
+    def record_summary_progress(
+        self, chat_id: str, day: date, msg_count: int, status: str
+    ) -> None:
+        with self._write() as conn:
+            conn.execute(
+                """
+                INSERT OR REPLACE INTO summary_progress(chat_id, day, msg_count, status, ts)
+                VALUES(?, ?, ?, ?, ?)
+                """,
+                (chat_id, day.isoformat(), msg_count, status, datetime.utcnow().timestamp()),
+            )
 
     def upsert_summary(self, chat_id: str, day: date, summary: str) -> None:
-        with self._connect() as conn:
+        with self._write() as conn:
             conn.execute(
                 """
                 INSERT OR REPLACE INTO summaries(chat_id, day, summary, ts)
@@ -124,7 +793,7 @@ class MemoryStore:
 
     def get_summaries(self, chat_id: str, days: int = 7) -> List[Tuple[str, str]]:
         cutoff = (date.today() - timedelta(days=days)).isoformat()
-        with self._connect() as conn:
+        with self._read() as conn:
             rows = conn.execute(
                 """
                 SELECT day, summary
@@ -136,25 +805,485 @@ class MemoryStore:
             ).fetchall()
         return [(r["day"], r["summary"]) for r in rows]
 
-    def prune_old_messages(self, days_to_keep: int) -> int:
+    def upsert_weekly_summary(self, chat_id: str, week: date, summary: str) -> None:
+        with self._write() as conn:
+            conn.execute(
+                """
+                INSERT OR REPLACE INTO weekly_summaries(chat_id, week, summary, ts)
+                VALUES(?, ?, ?, ?)
+                """,
+                (chat_id, week.isoformat(), summary, datetime.utcnow().timestamp()),
+            )
+
+    def get_weekly_summaries(
+        self, chat_id: str, weeks: int, before: date
+    ) -> List[Tuple[str, str]]:
+        """
+        Up to `weeks` weekly summaries of weeks that started before `before`
+        (the daily window), so older history is covered without a gap.
+        """
+        if weeks <= 0:
+            return []
+        with self._read() as conn:
+            rows = conn.execute(
+                """
+                SELECT week, summary
+                FROM weekly_summaries
+                WHERE chat_id = ? AND week < ?
+                ORDER BY week DESC
+                LIMIT ?
+                """,
+                (chat_id, before.isoformat(), weeks),
+            ).fetchall()
+        return [(r["week"], r["summary"]) for r in reversed(rows)]
+
+    def find_weeks_to_summarize(self, before: date) -> List[Tuple[str, date]]:
+        """
+        (chat_id, Monday) of every finished week, ending before `before`, whose
+        day summaries are newer than its weekly summary (or that has none).
+        """
+        with self._read() as conn:
+            rows = conn.execute(
+                """
+                WITH weeks AS (
+                    SELECT chat_id,
+                           date(day, 'weekday 0', '-6 days') AS week,
+                           MAX(ts) AS updated
+                    FROM summaries
+                    GROUP BY chat_id, week
+                )
+                SELECT w.chat_id, w.week
+                FROM weeks w
+                LEFT JOIN weekly_summaries ws
+                    ON ws.chat_id = w.chat_id AND ws.week = w.week
+                WHERE date(w.week, '+7 days') <= ?
+                  AND (ws.chat_id IS NULL OR ws.ts < w.updated)
+                ORDER BY w.week ASC
+                """,
+                (before.isoformat(),),
+            ).fetchall()
+        return [(r["chat_id"], date.fromisoformat(r["week"])) for r in rows]
+
+    def get_day_summaries(
+        self, chat_id: str, start: date, end: date
+    ) -> List[Tuple[str, str]]:
+        with self._read() as conn:
+            rows = conn.execute(
+                """
+                SELECT day, summary
+                FROM summaries
+                WHERE chat_id = ? AND day >= ? AND day < ?
+                ORDER BY day ASC
+                """,
+                (chat_id, start.isoformat(), end.isoformat()),
+            ).fetchall()
+        return [(r["day"], r["summary"]) for r in rows]
+
+    def get_cached_summary(self, digest: str) -> Optional[str]:
+        with self._read() as conn:
+            row = conn.execute(
+                "SELECT summary FROM summary_cache WHERE digest = ?",
+                (digest,),
+            ).fetchone()
+        return row["summary"] if row else None
+
+    def put_cached_summary(self, digest: str, summary: str) -> None:
+        with self._write() as conn:
+            conn.execute(
+                """
+                INSERT OR REPLACE INTO summary_cache(digest, summary, ts)
+                VALUES(?, ?, ?)
+                """,
+                (digest, summary, datetime.utcnow().timestamp()),
+            )
+
+    def day_transcript_chunks(
+        self, chat_id: str, day: date, max_chars: int
+    ) -> Tuple[int, List[str]]:
+        """A day's messages as "U:/A:" transcript chunks of at most ~max_chars."""
+        chunks: List[str] = []
+        current: List[str] = []
+        size = 0
+        count = 0
+        for m in self.iter_messages_for_day(chat_id, day):
+            count += 1
+            line = f"{'U' if m.role == 'user' else 'A'}: {' '.join(m.text.split())}"
+            if current and size + len(line) > max_chars:
+                chunks.append("\n".join(current))
+                current, size = [], 0
+            current.append(line[:max_chars])
+            size += len(line) + 1
+        if current:
+            chunks.append("\n".join(current))
+        return count, chunks
+
+    def search(
+        self,
+        chat_id: str,
+        query: str,
+        k: int = 5,
+        before_ts: Optional[float] = None,
+    ) -> List[MessageRow]:
+        """
+        Up to k stored messages of the chat matching words of `query`, best
+        BM25 rank first. before_ts limits the search to older messages (e.g.
+        the ones outside the recent window).
+        """
+        match = _fts_query(query)
+        if k <= 0 or not match:
+            return []
+        # The chat_id phrase narrows the MATCH to this chat's rows. Its tokens
+        # drop the sign ("-100123" -> "100123"), hence the join's exact check.
+        chat = chat_id.replace('"', '""')
+        match = f'chat_id : "{chat}" AND text : ({match})'
+        with self._read() as conn:
+            return self._message_cursor(
+                conn,
+                chat_id,
+                """
+                SELECT m.msg_id, m.role, m.text, m.ts
+                FROM messages_fts
+                JOIN messages m ON m.rowid = messages_fts.rowid
+                WHERE messages_fts MATCH ? AND m.chat_id = ? AND m.ts < ?
+                ORDER BY bm25(messages_fts, 1.0, 0.0)
+                LIMIT ?
+                """,
+                (match, chat_id, before_ts if before_ts is not None else float("inf"), k),
+            ).fetchall()
+
+    def add_embeddings(self, rows: List[Tuple[str, str, float, int, bytes]]) -> int:
+        """rows: (chat_id, msg_id, ts, dim, float32 vector bytes)."""
+        if not rows:
+            return 0
+        with self._write() as conn:
+            conn.executemany(
+                """
+                INSERT OR REPLACE INTO message_embeddings(chat_id, msg_id, ts, dim, vec)
+                VALUES(?, ?, ?, ?, ?)
+                """,
+                rows,
+            )
+        return len(rows)
+
+    def load_embeddings(self, chat_id: str, dim: int) -> List[Tuple[str, float, bytes]]:
+        """(msg_id, ts, vector bytes) of a chat, oldest first; other dims are skipped."""
+        with self._read() as conn:
+            rows = conn.execute(
+                """
+                SELECT msg_id, ts, vec
+                FROM message_embeddings
+                WHERE chat_id = ? AND dim = ?
+                ORDER BY ts ASC
+                """,
+                (chat_id, dim),
+            ).fetchall()
+        return [(r["msg_id"], r["ts"], r["vec"]) for r in rows]
+
+    def find_unembedded_messages(self, limit: int, min_chars: int = 1) -> List[MessageRow]:
+        """Stored messages that have no embedding yet, newest first."""
+        with self._read() as conn:
+            return self._message_cursor(
+                conn,
+                None,
+                """
+                SELECT m.chat_id, m.msg_id, m.role, m.text, m.ts
+                FROM messages m
+                LEFT JOIN message_embeddings e
+                    ON e.chat_id = m.chat_id AND e.msg_id = m.msg_id
+                WHERE e.msg_id IS NULL AND length(m.text) >= ?
+                ORDER BY m.ts DESC
+                LIMIT ?
+                """,
+                (min_chars, limit),
+            ).fetchall()
+
+    def get_messages_by_ids(self, chat_id: str, msg_ids: List[str]) -> List[MessageRow]:
+        """
+        Messages by id, oldest first. Ids no longer in the hot table are
+        looked up in the archive: their embeddings' ts tells which days to
+        decompress.
+        """
+        if not msg_ids:
+            return []
+        marks = ",".join("?" * len(msg_ids))
+        with self._read() as conn:
+            rows = self._message_cursor(
+                conn,
+                chat_id,
+                f"""
+                SELECT msg_id, role, text, ts
+                FROM messages
+                WHERE chat_id = ? AND msg_id IN ({marks})
+                ORDER BY ts ASC
+                """,
+                (chat_id, *msg_ids),
+            ).fetchall()
+            missing = set(msg_ids) - {r.msg_id for r in rows}
+            if not missing:
+                return rows
+            marks = ",".join("?" * len(missing))
+            days = {
+                date.fromtimestamp(r[0])
+                for r in conn.execute(
+                    f"""
+                    SELECT ts FROM message_embeddings
+                    WHERE chat_id = ? AND msg_id IN ({marks})
+                    """,
+                    (chat_id, *missing),
+                )
+            }
+        for day in days:
+            rows += [r for r in self.get_archived_messages(chat_id, day) if r.msg_id in missing]
+        return sorted(rows, key=lambda r: r.ts)
+
+    def load_chat_settings(self) -> Dict[str, Dict[str, str]]:
+        """All per-chat setting overrides as {chat_id: {name: raw value}}."""
+        result: Dict[str, Dict[str, str]] = {}
+        with self._read() as conn:
+            for r in conn.execute("SELECT chat_id, name, value FROM chat_settings"):
+                result.setdefault(r["chat_id"], {})[r["name"]] = r["value"]
+        return result
+
+    def set_chat_setting(self, chat_id: str, name: str, value: str) -> None:
+        with self._write() as conn:
+            conn.execute(
+                """
+                INSERT OR REPLACE INTO chat_settings(chat_id, name, value, ts)
+                VALUES(?, ?, ?, ?)
+                """,
+                (chat_id, name, value, datetime.utcnow().timestamp()),
+            )
+
+    def delete_chat_setting(self, chat_id: str, name: Optional[str] = None) -> int:
+        with self._write() as conn:
+            if name is None:
+                cur = conn.execute("DELETE FROM chat_settings WHERE chat_id = ?", (chat_id,))
+            else:
+                cur = conn.execute(
+                    "DELETE FROM chat_settings WHERE chat_id = ? AND name = ?",
+                    (chat_id, name),
+                )
+            return cur.rowcount
+
+    def load_session_state(
+        self, chat_id: str
+    ) -> Optional[Tuple[Optional[float], Optional[str], int]]:
+        """(last_humor_ts, last_joke_day, jokes_today) or None for an unknown chat."""
+        with self._read() as conn:
+            row = conn.execute(
+                """
+                SELECT last_humor_ts, last_joke_day, jokes_today
+                FROM session_state
+                WHERE chat_id = ?
+                """,
+                (chat_id,),
+            ).fetchone()
+        return tuple(row) if row else None
+
+    def save_session_state(
+        self,
+        chat_id: str,
+        last_humor_ts: Optional[float],
+        last_joke_day: Optional[str],
+        jokes_today: int,
+    ) -> None:
+        with self._write() as conn:
+            conn.execute(
+                """
+                INSERT OR REPLACE INTO session_state(chat_id, last_humor_ts, last_joke_day, jokes_today)
+                VALUES(?, ?, ?, ?)
+                """,
+                (chat_id, last_humor_ts, last_joke_day, jokes_today),
+            )
+
+    def load_maintenance_runs(self) -> Dict[str, float]:
+        with self._read() as conn:
+            rows = conn.execute("SELECT name, ts FROM maintenance_runs").fetchall()
+        return {r["name"]: r["ts"] for r in rows}
+
+    def record_maintenance_run(self, name: str, ts: float) -> None:
+        with self._write() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO maintenance_runs(name, ts) VALUES(?, ?)", (name, ts)
+            )
+
+    def prune_session_state(self, days_to_keep: int) -> int:
+        """Forget chats with no joke or humor activity for `days_to_keep` days."""
         if days_to_keep <= 0:
             return 0
-        cutoff = (datetime.utcnow() - timedelta(days=days_to_keep)).timestamp()
-        with self._connect() as conn:
+        cutoff = datetime.now() - timedelta(days=days_to_keep)
+        with self._write() as conn:
             cur = conn.execute(
                 """
-                DELETE FROM messages
-                WHERE ts < ?
+                DELETE FROM session_state
+                WHERE COALESCE(last_humor_ts, 0) < ?
+                  AND COALESCE(last_joke_day, '') < ?
                 """,
-                (cutoff,),
+                (cutoff.timestamp(), cutoff.date().isoformat()),
             )
             return cur.rowcount
 
-    def prune_old_summaries(self, days_to_keep: int) -> int:
+    def prune_old_messages(self, days_to_keep: int) -> int:
+        if days_to_keep <= 0:
+            return 0
+        # Whole days only, on the same local-day bounds as the summaries: a
+        # partly deleted day would change its count and be re-summarized.
+        cutoff, _ = self._day_bounds(date.today() - timedelta(days=days_to_keep))
+        with self._read() as conn:
+            chat_ids = [
+                r["chat_id"]
+                for r in conn.execute("SELECT DISTINCT chat_id FROM messages").fetchall()
+            ]
+        deleted = 0
+        # One (chat_id, ts) index range per chat and transaction, so the writer
+        # lock is released between chats instead of held for a full scan.
+        for chat_id in chat_ids:
+            with self._write() as conn:
+                deleted += conn.execute(
+                    """
+                    DELETE FROM messages
+                    WHERE chat_id = ? AND ts < ?
+                    """,
+                    (chat_id, cutoff),
+                ).rowcount
+                conn.execute(
+                    "DELETE FROM message_embeddings WHERE chat_id = ? AND ts < ?",
+                    (chat_id, cutoff),
+                )
+        if self.recent_cache is not None:
+            self.recent_cache.drop_older_than(cutoff)
+        return deleted
+
+    def archive_old_messages(
+        self, days_to_keep: int, codec: str = "zlib", keep_embeddings: bool = True
+    ) -> int:
+        """
+        Move every whole local day older than `days_to_keep` days out of the
+        hot messages table (and its FTS and ts indexes) into message_archive,
+        one compressed blob per chat and day. Messages that arrive for a day
+        already archived are merged into its blob on the next run. Embeddings
+        are kept with keep_embeddings, so recall still finds archived
+        messages (get_messages_by_ids). Returns the number of messages moved.
+        """
+        if days_to_keep <= 0:
+            return 0
+        compress, _ = _archive_codec(codec)
+        cutoff, _ = self._day_bounds(date.today() - timedelta(days=days_to_keep))
+        with self._read() as conn:
+            chat_days = conn.execute(
+                """
+                SELECT chat_id, date(ts, 'unixepoch', 'localtime') AS day
+                FROM messages
+                WHERE ts < ?
+                GROUP BY chat_id, day
+                """,
+                (cutoff,),
+            ).fetchall()
+        moved = 0
+        # One chat-day per transaction, so the writer lock is released often
+        # and a first run over a large backlog does not hold it for minutes.
+        for r in chat_days:
+            chat_id, day = r["chat_id"], date.fromisoformat(r["day"])
+            start, end = self._day_bounds(day)
+            with self._write() as conn:
+                rows = self._message_cursor(
+                    conn,
+                    chat_id,
+                    """
+                    SELECT msg_id, role, text, ts
+                    FROM messages
+                    WHERE chat_id = ? AND ts >= ? AND ts < ?
+                    """,
+                    (chat_id, start, end),
+                ).fetchall()
+                archived = conn.execute(
+                    "SELECT codec, data FROM message_archive WHERE chat_id = ? AND day = ?",
+                    (chat_id, day.isoformat()),
+                ).fetchone()
+                if archived is not None:
+                    rows = self._merge_rows(
+                        self._unpack_archive(chat_id, archived["codec"], archived["data"]), rows
+                    )
+                else:
+                    rows.sort(key=lambda m: m.ts)
+                raw = json.dumps(
+                    [[m.msg_id, m.role, m.text, m.ts] for m in rows], ensure_ascii=False
+                ).encode("utf-8")
+                conn.execute(
+                    """
+                    INSERT OR REPLACE INTO message_archive
+                        (chat_id, day, codec, msg_count, raw_bytes, data, ts)
+                    VALUES(?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    (
+                        chat_id,
+                        day.isoformat(),
+                        codec,
+                        len(rows),
+                        len(raw),
+                        compress(raw),
+                        time.time(),
+                    ),
+                )
+                moved += conn.execute(
+                    "DELETE FROM messages WHERE chat_id = ? AND ts >= ? AND ts < ?",
+                    (chat_id, start, end),
+                ).rowcount
+                if not keep_embeddings:
+                    conn.execute(
+                        "DELETE FROM message_embeddings WHERE chat_id = ? AND ts >= ? AND ts < ?",
+                        (chat_id, start, end),
+                    )
+        if self.recent_cache is not None:
+            self.recent_cache.drop_older_than(cutoff)
+        return moved
+
+    @staticmethod
+    def _unpack_archive(chat_id: str, codec: str, data: bytes) -> List[MessageRow]:
+        _, decompress = _archive_codec(codec)
+        return [MessageRow(chat_id, *item) for item in json.loads(decompress(data))]
+
+    def get_archived_messages(self, chat_id: str, day: date) -> List[MessageRow]:
+        """An archived day's messages in ts order, decompressed on demand; [] if not archived."""
+        with self._read() as conn:
+            row = conn.execute(
+                "SELECT codec, data FROM message_archive WHERE chat_id = ? AND day = ?",
+                (chat_id, day.isoformat()),
+            ).fetchone()
+        if row is None:
+            return []
+        return self._unpack_archive(chat_id, row["codec"], row["data"])
+
+    def prune_archive(self, days_to_keep: int) -> int:
+        """Delete archived days (and their embeddings) older than days_to_keep; 0 keeps all."""
+        if days_to_keep <= 0:
+            return 0
+        day = date.today() - timedelta(days=days_to_keep)
+        cutoff, _ = self._day_bounds(day)
+        with self._write() as conn:
+            deleted = conn.execute(
+                "DELETE FROM message_archive WHERE day < ?", (day.isoformat(),)
+            ).rowcount
+            conn.execute("DELETE FROM message_embeddings WHERE ts < ?", (cutoff,))
+        return deleted
+
+    def archive_stats(self) -> Dict[str, int]:
+        """Archived days and messages, their raw and compressed sizes in bytes."""
+        with self._read() as conn:
+            row = conn.execute(
+                """
+                SELECT COUNT(*), COALESCE(SUM(msg_count), 0),
+                       COALESCE(SUM(raw_bytes), 0), COALESCE(SUM(length(data)), 0)
+                FROM message_archive
+                """
+            ).fetchone()
+        return dict(zip(("days", "messages", "raw_bytes", "stored_bytes"), row))
+
+    def prune_old_summaries(self, days_to_keep: int, weeks_to_keep: int = 0) -> int:
         if days_to_keep <= 0:
             return 0
         cutoff = (date.today() - timedelta(days=days_to_keep)).isoformat()
-        with self._connect() as conn:
+        with self._write() as conn:
             cur = conn.execute(
                 """
                 DELETE FROM summaries
@@ -162,12 +1291,51 @@ class MemoryStore:
                 """,
                 (cutoff,),
             )
-            return cur.rowcount
+            deleted = cur.rowcount
+            if weeks_to_keep > 0:
+                week_cutoff = (date.today() - timedelta(weeks=weeks_to_keep)).isoformat()
+                deleted += conn.execute(
+                    "DELETE FROM weekly_summaries WHERE week < ?",
+                    (week_cutoff,),
+                ).rowcount
+                deleted += conn.execute(
+                    "DELETE FROM summary_cache WHERE ts < ?",
+                    ((datetime.utcnow() - timedelta(weeks=weeks_to_keep)).timestamp(),),
+                ).rowcount
+            return deleted
 
     def vacuum(self) -> None:
-        with self._connect() as conn:
+        with self._write() as conn:
             conn.execute("VACUUM")
 
+    def checkpoint(self, mode: str = "PASSIVE") -> Tuple[int, int, int]:
+        """PRAGMA wal_checkpoint; returns (busy, wal pages, checkpointed pages)."""
+        if mode not in ("PASSIVE", "FULL", "RESTART", "TRUNCATE"):
+            raise ValueError(f"Unknown checkpoint mode: {mode}")
+        with self._write() as conn:
+            row = conn.execute(f"PRAGMA wal_checkpoint({mode})").fetchone()
+        return tuple(row)
+
+    def compact(self, max_pages: int = 0) -> int:
+        """
+        Return free pages to the OS without locking the database for a full
+        rebuild: PRAGMA incremental_vacuum (max_pages=0 frees all of them).
+        A database created before auto_vacuum=INCREMENTAL is converted with a
+        one-time VACUUM. Returns the number of pages freed.
+        """
+        with self._write() as conn:
+            mode = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+            before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            if mode != 2:
+                conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                conn.execute("VACUUM")
+            else:
+                # executescript steps the pragma to completion; a plain
+                # execute() frees a single page.
+                conn.executescript(f"PRAGMA incremental_vacuum({max(0, int(max_pages))});")
+            after = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        return before - after
+
     def summarize_day(
         self,
         chat_id: str,
@@ -176,23 +1344,238 @@ class MemoryStore:
         min_messages: int = 12,
     ) -> Optional[str]:
         """
-        summarizer_fn: callable that takes List[MessageRow] and returns a string summary.
+        summarizer_fn: callable that takes an iterable of MessageRow (consumed
+        once, streamed from SQLite) and returns a string summary.
+        The outcome is checkpointed in summary_progress.
         """
-        msgs = self.get_messages_for_day(chat_id, day)
-        if len(msgs) < min_messages:
+        msg_count = self.count_messages_for_day(chat_id, day)
+        if msg_count < min_messages:
             return None
-        summary = summarizer_fn(msgs)
+        rows = self.iter_messages_for_day(chat_id, day)
+        try:
+            summary = summarizer_fn(rows)
+        finally:
+            rows.close()
         if summary:
             self.upsert_summary(chat_id, day, summary)
+        self.record_summary_progress(
+            chat_id, day, msg_count, "done" if summary else "empty"
+        )
         return summary
 
 
+class AsyncMemoryStore:
+    """
+    Async facade over MemoryStore for use inside aiogram handlers.
+
+    Every call is shipped to a small thread pool sized to the connection pool
+    (readers + the writer), so a slow commit never blocks the event loop.
+    """
+
+    def __init__(
+        self,
+        store: MemoryStore,
+        executor: Optional[ThreadPoolExecutor] = None,
+        write_behind: bool = False,
+        flush_interval: float = 0.25,
+        flush_batch: int = 200,
+        max_pending: int = 5000,
+        on_flush: Optional[Callable[[int, float], None]] = None,
+    ) -> None:
+        """
+        write_behind: buffer add_message() in memory and commit in batches,
+        at most every `flush_interval` seconds or every `flush_batch` rows.
+        Once `max_pending` rows are buffered, add_message() waits for a flush.
+        on_flush(rows, seconds) is called after each non-empty flush.
+        """
+        self.store = store
+        self._executor = executor or ThreadPoolExecutor(
+            max_workers=store.readers + 1,
+            thread_name_prefix="memory-store",
+        )
+        self.write_behind = write_behind
+        self.flush_interval = flush_interval
+        self.flush_batch = max(1, flush_batch)
+        self.max_pending = max(self.flush_batch, max_pending)
+        self.on_flush = on_flush
+        self._flush_wakeup: Optional[asyncio.Event] = None
+        self._flusher: Optional[asyncio.Task] = None
+        self._closing = False
+
+    def start(self) -> None:
+        """Start the background flusher (no-op unless write_behind is on)."""
+        if not self.write_behind or self._flusher is not None:
+            return
+        self._flush_wakeup = asyncio.Event()
+        self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self) -> None:
+        assert self._flush_wakeup is not None
+        while not self._closing:
+            try:
+                await asyncio.wait_for(
+                    self._flush_wakeup.wait(), timeout=self.flush_interval
+                )
+            except asyncio.TimeoutError:
+                pass
+            self._flush_wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                # Rows stay buffered and are retried on the next tick.
+                print(f"Ошибка записи сообщений в SQLite, повторим позже: {e}")
+
+    async def flush(self) -> int:
+        started = time.perf_counter()
+        rows = await self.run(self.store.flush_pending)
+        if rows and self.on_flush is not None:
+            self.on_flush(rows, time.perf_counter() - started)
+        return rows
+
+    async def run(self, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """Run any blocking callable (e.g. build_context) on the store executor."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(fn, *args, **kwargs)
+        )
+
+    async def add_message(
+        self,
+        chat_id: str,
+        msg_id: str,
+        role: str,
+        text: str,
+        ts: Optional[float] = None,
+    ) -> None:
+        if self._flusher is None:
+            await self.run(self.store.add_message, chat_id, msg_id, role, text, ts)
+            return
+        pending = self.store.enqueue_message(chat_id, msg_id, role, text, ts)
+        if pending >= self.max_pending:
+            await self.flush()
+        elif pending >= self.flush_batch and self._flush_wakeup is not None:
+            self._flush_wakeup.set()
+
+    async def get_recent_messages(self, chat_id: str, limit: int) -> List[MessageRow]:
+        return await self.run(self.store.get_recent_messages, chat_id, limit)
+
+    async def get_messages_for_day(self, chat_id: str, day: date) -> List[MessageRow]:
+        return await self.run(self.store.get_messages_for_day, chat_id, day)
+
+    async def upsert_summary(self, chat_id: str, day: date, summary: str) -> None:
+        await self.run(self.store.upsert_summary, chat_id, day, summary)
+
+    async def find_unsummarized_days(
+        self, min_messages: int, before: date
+    ) -> List[Tuple[str, date, int]]:
+        return await self.run(self.store.find_unsummarized_days, min_messages, before)
+
+    async def get_summaries(self, chat_id: str, days: int = 7) -> List[Tuple[str, str]]:
+        return await self.run(self.store.get_summaries, chat_id, days)
+
+    async def search(
+        self, chat_id: str, query: str, k: int = 5, before_ts: Optional[float] = None
+    ) -> List[MessageRow]:
+        return await self.run(self.store.search, chat_id, query, k, before_ts)
+
+    async def get_weekly_summaries(
+        self, chat_id: str, weeks: int, before: date
+    ) -> List[Tuple[str, str]]:
+        return await self.run(self.store.get_weekly_summaries, chat_id, weeks, before)
+
+    async def upsert_weekly_summary(self, chat_id: str, week: date, summary: str) -> None:
+        await self.run(self.store.upsert_weekly_summary, chat_id, week, summary)
+
+    async def find_weeks_to_summarize(self, before: date) -> List[Tuple[str, date]]:
+        return await self.run(self.store.find_weeks_to_summarize, before)
+
+    async def get_day_summaries(
+        self, chat_id: str, start: date, end: date
+    ) -> List[Tuple[str, str]]:
+        return await self.run(self.store.get_day_summaries, chat_id, start, end)
+
+    async def load_chat_settings(self) -> Dict[str, Dict[str, str]]:
+        return await self.run(self.store.load_chat_settings)
+
+    async def set_chat_setting(self, chat_id: str, name: str, value: str) -> None:
+        await self.run(self.store.set_chat_setting, chat_id, name, value)
+
+    async def delete_chat_setting(self, chat_id: str, name: Optional[str] = None) -> int:
+        return await self.run(self.store.delete_chat_setting, chat_id, name)
+
+    async def load_maintenance_runs(self) -> Dict[str, float]:
+        return await self.run(self.store.load_maintenance_runs)
+
+    async def record_maintenance_run(self, name: str, ts: float) -> None:
+        await self.run(self.store.record_maintenance_run, name, ts)
+
+    async def prune_session_state(self, days_to_keep: int) -> int:
+        return await self.run(self.store.prune_session_state, days_to_keep)
+
+    async def prune_old_messages(self, days_to_keep: int) -> int:
+        return await self.run(self.store.prune_old_messages, days_to_keep)
+
+    async def archive_old_messages(
+        self, days_to_keep: int, codec: str = "zlib", keep_embeddings: bool = True
+    ) -> int:
+        return await self.run(
+            self.store.archive_old_messages, days_to_keep, codec, keep_embeddings
+        )
+
+    async def get_archived_messages(self, chat_id: str, day: date) -> List[MessageRow]:
+        return await self.run(self.store.get_archived_messages, chat_id, day)
+
+    async def prune_archive(self, days_to_keep: int) -> int:
+        return await self.run(self.store.prune_archive, days_to_keep)
+
+    async def archive_stats(self) -> Dict[str, int]:
+        return await self.run(self.store.archive_stats)
+
+    async def prune_old_summaries(self, days_to_keep: int, weeks_to_keep: int = 0) -> int:
+        return await self.run(self.store.prune_old_summaries, days_to_keep, weeks_to_keep)
+
+    async def vacuum(self) -> None:
+        await self.run(self.store.vacuum)
+
+    async def checkpoint(self, mode: str = "PASSIVE") -> Tuple[int, int, int]:
+        return await self.run(self.store.checkpoint, mode)
+
+    async def compact(self, max_pages: int = 0) -> int:
+        return await self.run(self.store.compact, max_pages)
+
+    async def summarize_day(
+        self,
+        chat_id: str,
+        day: date,
+        summarizer_fn,
+        min_messages: int = 12,
+    ) -> Optional[str]:
+        return await self.run(
+            self.store.summarize_day, chat_id, day, summarizer_fn, min_messages
+        )
+
+    async def close(self) -> None:
+        if self._flusher is not None:
+            # wait_for() may swallow a cancel that races with the wakeup
+            # event, so the loop also checks `_closing`.
+            self._closing = True
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+        await self.flush()
+        await asyncio.to_thread(self._executor.shutdown, True)
+        self.store.close()
+
+
 def naive_summarizer(msgs: Iterable[MessageRow]) -> str:
     """
     Fast fallback summarizer (no LLM).
     Keeps the last few user/assistant messages and a simple topic line.
     """
-    recent = list(msgs)[-8:]
+    recent = deque(msgs, maxlen=8)
     topic_terms = []
     for m in recent:
         for t in m.text.split():
@@ -213,17 +1596,14 @@ def compact_summarizer(msgs: Iterable[MessageRow], max_facts: int = 8) -> str:
     """
     Compact summary to avoid leaking raw chat lines into the prompt.
     Output format is stable and avoids U:/A: prefixes.
+    Single pass with bounded state, so `msgs` can be a lazy iterator.
     """
-    messages = list(msgs)
-    if not messages:
-        return ""
-
     # Heuristic: keep only user messages and extract short statements
     facts: list[str] = []
-    topics: list[str] = []
-    last_user_lines: list[str] = []
+    topics: set[str] = set()
+    last_user_lines: deque = deque(maxlen=6)
 
-    for m in messages:
+    for m in msgs:
         if m.role != "user":
             continue
         text = " ".join(m.text.strip().split())
@@ -234,18 +1614,16 @@ def compact_summarizer(msgs: Iterable[MessageRow], max_facts: int = 8) -> str:
         for t in text.split():
             t = t.strip(".,:;!?()[]{}\"'").lower()
             if 4 <= len(t) <= 16:
-                topics.append(t)
+                topics.add(t)
         # extract short "fact-like" lines
-        if 12 <= len(text) <= 140 and text[0].isupper():
+        if len(facts) < max_facts and 12 <= len(text) <= 140 and text[0].isupper():
             facts.append(text)
 
-    last_user_lines = last_user_lines[-6:]
-    topics = sorted(set(topics))[:10]
-    facts = facts[:max_facts]
+    top_topics = sorted(topics)[:10]
 
     lines: list[str] = []
-    if topics:
-        lines.append("topics: " + ", ".join(topics))
+    if top_topics:
+        lines.append("topics: " + ", ".join(top_topics))
     if facts:
         lines.append("facts:")
         for f in facts:
@@ -256,4 +1634,3 @@ def compact_summarizer(msgs: Iterable[MessageRow], max_facts: int = 8) -> str:
             lines.append(f"- {l}")
 
     return "\n".join(lines)
-
@@ -0,0 +1,402 @@
+import abc
+import asyncio
+import bisect
+import collections
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Mapping, Optional, Tuple, Union
+
+from aiohttp import web
+
+LabelValues = Tuple[str, ...]
+GaugeValue = Union[float, Mapping[LabelValues, float]]
+
+# Seconds, from a SQLite read on a warm cache to a long CPU generation.
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120
+)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Tuple[str, ...], values: LabelValues, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _number(value: float) -> str:
+    value = float(value)
+    if value == float("inf"):
+        return "+Inf"
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+class _Metric(abc.ABC):
+    kind = ""
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Tuple[str, ...] = (),
+        max_series: int = 1000,
+    ) -> None:
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self.max_series = max_series
+
+    def _key(
+        self, labels: Mapping[str, object], series: Mapping[LabelValues, object]
+    ) -> LabelValues:
+        key = tuple(str(labels.get(n, "")) for n in self.label_names)
+        if key not in series and len(series) >= self.max_series:
+            # Per-chat labels are unbounded; fold the overflow into one series.
+            return tuple("other" for _ in self.label_names)
+        return key
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+    @abc.abstractmethod
+    def render(self) -> List[str]:
+        """Exposition-format lines, header included."""
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: object) -> None:
+        key = self._key(labels, self._values)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: object) -> float:
+        return self._values.get(tuple(str(labels.get(n, "")) for n in self.label_names), 0.0)
+
+    def render(self) -> List[str]:
+        return self.header() + [
+            f"{self.name}{_labels(self.label_names, k)} {_number(v)}"
+            for k, v in sorted(self._values.items())
+        ]
+
+
+class Gauge(_Metric):
+    """
+    Read when rendered: `fn` returns a number, or {label values: number}
+    for a labelled gauge. kind="counter" for totals kept elsewhere (e.g.
+    SchedulerStats), so they are exported with the right type.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        fn: Callable[[], GaugeValue],
+        labels: Tuple[str, ...] = (),
+        kind: str = "gauge",
+    ) -> None:
+        super().__init__(name, help, labels)
+        self.fn = fn
+        self.kind = kind
+
+    def render(self) -> List[str]:
+        try:
+            value = self.fn()
+        except Exception as e:
+            return [f"# {self.name} unavailable: {e!r}"]
+        values = value.items() if isinstance(value, Mapping) else [((), value)]
+        return self.header() + [
+            f"{self.name}{_labels(self.label_names, k)} {_number(v)}" for k, v in sorted(values)
+        ]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = LATENCY_BUCKETS,
+        max_series: int = 1000,
+    ) -> None:
+        super().__init__(name, help, labels, max_series)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> (per-bucket counts incl. +Inf, sum, count)
+        self._series: Dict[LabelValues, List] = {}
+
+    def observe(self, value: float, **labels: object) -> None:
+        key = self._key(labels, self._series)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    @contextmanager
+    def time(self, **labels: object) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels: object) -> int:
+        series = self._series.get(tuple(str(labels.get(n, "")) for n in self.label_names))
+        return series[2] if series else 0
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        for key, (counts, total, count) in sorted(self._series.items()):
+            labels = _labels(self.label_names, key)
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                le = _labels(self.label_names, key, f'le="{_number(bound)}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            lines.append(f"{self.name}_sum{labels} {_number(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Registry:
+    """
+    A minimal Prometheus text-format registry (no client library needed).
+
+    Metrics are updated from the event loop thread only; gauges are
+    callbacks read at scrape time, so queue depths and cache hit rates cost
+    nothing between scrapes.
+    """
+
+    def __init__(self) -> None:
+        self._metrics: Dict[str, _Metric] = {}
+
+    def _add(self, metric: _Metric) -> _Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"duplicate metric {metric.name}")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(
+        self, name: str, help: str, labels: Tuple[str, ...] = (), max_series: int = 1000
+    ) -> Counter:
+        return self._add(Counter(name, help, labels, max_series))
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        labels: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = LATENCY_BUCKETS,
+    ) -> Histogram:
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def gauge(
+        self,
+        name: str,
+        help: str,
+        fn: Callable[[], GaugeValue],
+        labels: Tuple[str, ...] = (),
+        kind: str = "gauge",
+    ) -> Gauge:
+        return self._add(Gauge(name, help, fn, labels, kind))
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class BotMetrics:
+    """The bot's hot-path stages, one histogram each, plus per-chat counters."""
+
+    def __init__(self, registry: Optional[Registry] = None, max_chats: int = 500) -> None:
+        r = self.registry = registry or Registry()
+        self.build_context = r.histogram(
+            "bot_build_context_seconds", "Context building incl. SQLite reads", ("kind",)
+        )
+        self.add_message = r.histogram(
+            "bot_add_message_seconds", "add_message() in handlers (an enqueue with write-behind)"
+        )
+        self.routes = r.counter(
+            "bot_message_routes_total", "Incoming messages by pre-dispatch route", ("route",)
+        )
+        self.flush = r.histogram("bot_db_flush_seconds", "Write-behind batch commits")
+        self.flush_rows = r.counter("bot_db_flushed_rows_total", "Rows committed by flushes")
+        self.ollama_ttfb = r.histogram(
+            "bot_ollama_ttfb_seconds", "Request to the first text from Ollama", ("kind",)
+        )
+        self.generation = r.histogram(
+            "bot_generation_seconds", "Ollama total_duration of a generation", ("kind",)
+        )
+        self.reply = r.histogram(
+            "bot_reply_seconds", "Reply from message to answer, queueing included", ("source",)
+        )
+        self.prompt_rate = r.histogram(
+            "bot_ollama_prompt_tokens_per_second",
+            "Prompt evaluation speed reported by Ollama",
+            buckets=RATE_BUCKETS,
+        )
+        self.eval_rate = r.histogram(
+            "bot_ollama_eval_tokens_per_second",
+            "Generation speed reported by Ollama",
+            buckets=RATE_BUCKETS,
+        )
+        self.tokens = r.counter("bot_ollama_tokens_total", "Tokens evaluated by Ollama", ("phase",))
+        self.chat_messages = r.counter(
+            "bot_chat_messages_total", "Stored messages per chat", ("chat", "role"), max_chats
+        )
+        self.chat_replies = r.counter(
+            "bot_chat_replies_total", "Replies per chat and source", ("chat", "source"), max_chats
+        )
+
+    def record_ollama(self, final: Mapping[str, object], kind: str = "reply") -> None:
+        """Token counts and speeds from Ollama's final response (durations are in ns)."""
+        for phase, count_key, duration_key, hist in (
+            ("prompt", "prompt_eval_count", "prompt_eval_duration", self.prompt_rate),
+            ("eval", "eval_count", "eval_duration", self.eval_rate),
+        ):
+            count = final.get(count_key)
+            duration = final.get(duration_key)
+            if isinstance(count, (int, float)) and count > 0:
+                self.tokens.inc(count, phase=phase)
+                if isinstance(duration, (int, float)) and duration > 0:
+                    hist.observe(count / (duration / 1e9))
+        total = final.get("total_duration")
+        if isinstance(total, (int, float)) and total > 0:
+            self.generation.observe(total / 1e9, kind=kind)
+
+
+class SamplingProfiler:
+    """
+    A statistical profiler that can be switched on in production: a thread
+    samples every thread's stack each `interval` seconds and counts the
+    collapsed stacks ("thread;module:function;..."), the input format of
+    flamegraph.pl and speedscope. Costs nothing while stopped.
+    """
+
+    def __init__(self, interval: float = 0.005, max_depth: int = 64) -> None:
+        self.interval = interval
+        self.max_depth = max_depth
+        self.samples = 0
+        self._stacks: "collections.Counter[str]" = collections.Counter()
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self) -> bool:
+        if self._thread is not None:
+            return False
+        self._stacks.clear()
+        self.samples = 0
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self) -> str:
+        """Stop sampling; returns the collapsed stacks, most frequent first."""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        return "".join(f"{stack} {n}\n" for stack, n in self._stacks.most_common())
+
+    def _run(self) -> None:
+        own = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            if len(names) != threading.active_count():
+                names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    code = frame.f_code
+                    stack.append(f"{frame.f_globals.get('__name__', '?')}:{code.co_name}")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self._stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+
+def add_routes(
+    app: web.Application,
+    registry: Registry,
+    profiler: Optional[SamplingProfiler] = None,
+) -> None:
+    """
+    GET /metrics in Prometheus text format. With a profiler also
+    POST /debug/profile/start, POST /debug/profile/stop (returns the
+    collapsed stacks) and GET /debug/profile?seconds=N (start, wait, stop).
+    """
+
+    async def metrics(request: web.Request) -> web.Response:
+        return web.Response(
+            body=registry.render().encode("utf-8"),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+        )
+
+    app.router.add_get("/metrics", metrics)
+    if profiler is None:
+        return
+
+    async def start(request: web.Request) -> web.Response:
+        return web.Response(text="started\n" if profiler.start() else "already running\n")
+
+    async def stop(request: web.Request) -> web.Response:
+        return web.Response(text=profiler.stop())
+
+    async def sample(request: web.Request) -> web.Response:
+        try:
+            seconds = min(300.0, float(request.query.get("seconds", "10")))
+        except ValueError:
+            return web.Response(status=400, text="seconds must be a number\n")
+        if not profiler.start():
+            return web.Response(status=409, text="profiler already running\n")
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            text = profiler.stop()
+        return web.Response(text=text)
+
+    app.router.add_post("/debug/profile/start", start)
+    app.router.add_post("/debug/profile/stop", stop)
+    app.router.add_get("/debug/profile", sample)
+
+
+class MetricsServer:
+    """Serves add_routes() on its own (local) port."""
+
+    def __init__(self, registry: Registry, profiler: Optional[SamplingProfiler] = None) -> None:
+        self.app = web.Application()
+        add_routes(self.app, registry, profiler)
+        self._runner: Optional[web.AppRunner] = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 9100) -> None:
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
@@ -0,0 +1,149 @@
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Mapping, Optional, Tuple
+
+
+@dataclass(frozen=True)
+class RoutingConfig:
+    reply_model: str
+    # Empty: the reply model
+    joke_model: str = ""
+    # Replies go to this (smaller) model while degraded; empty keeps reply_model.
+    fallback_model: str = ""
+    # Degrade when this many generations wait (0: ignore the queue) or when
+    # the reply model generates slower than this many tokens/s (0: ignore).
+    degrade_queue_depth: int = 0
+    degrade_min_tokens_per_second: float = 0.0
+    # Stay degraded until the load has been normal for this long.
+    degrade_hold_seconds: float = 30.0
+    # num_predict cap while degraded; 0 leaves the model's default.
+    degraded_num_predict: int = 0
+    degraded_skip_jokes: bool = True
+
+    @property
+    def models(self) -> Tuple[str, ...]:
+        """Every model this config can route to, without repeats."""
+        models = (self.reply_model, self.joke_model, self.fallback_model)
+        return tuple(dict.fromkeys(m for m in models if m))
+
+
+@dataclass(frozen=True)
+class ModelChoice:
+    model: str
+    options: Dict[str, Any]
+    degraded: bool
+
+
+@dataclass
+class RouterStats:
+    degraded_periods: int = 0
+    fallback_replies: int = 0
+    shortened: int = 0
+    skipped_jokes: int = 0
+
+
+@dataclass
+class _Rate:
+    tokens_per_second: float
+    updated: float = field(default_factory=time.monotonic)
+
+
+class ModelRouter:
+    """
+    Picks the model and generation options for each request class ("reply",
+    "joke") and switches to a degraded mode under load.
+
+    Load is the scheduler's queue depth (`queued`) and a moving average of
+    the tokens/s Ollama reports for the reply model; averages older than
+    `rate_window` seconds are ignored, so a model that is no longer used
+    does not keep the router degraded. While degraded, replies use the
+    fallback model with a shorter num_predict and ambient jokes are
+    skipped. The mode ends only after `degrade_hold_seconds` without
+    overload, so it does not flap with every queued message.
+    """
+
+    def __init__(
+        self,
+        queued: Callable[[], int],
+        rate_window: float = 120.0,
+        smoothing: float = 0.3,
+    ) -> None:
+        self.queued = queued
+        self.rate_window = rate_window
+        self.smoothing = smoothing
+        self.stats = RouterStats()
+        self.degraded = False
+        self._degraded_until = 0.0
+        self._rates: Dict[str, _Rate] = {}
+
+    def observe(self, final: Mapping[str, Any]) -> None:
+        """Feed Ollama's final response (its "model", eval_count, eval_duration in ns)."""
+        model = final.get("model")
+        count = final.get("eval_count")
+        duration = final.get("eval_duration")
+        if not isinstance(model, str) or not isinstance(count, (int, float)):
+            return
+        if not isinstance(duration, (int, float)) or count <= 0 or duration <= 0:
+            return
+        rate = count / (duration / 1e9)
+        previous = self.tokens_per_second(model)
+        if previous is not None:
+            rate = previous + self.smoothing * (rate - previous)
+        self._rates[model] = _Rate(rate)
+
+    def tokens_per_second(self, model: str) -> Optional[float]:
+        """Recent average generation speed of `model`, None without fresh samples."""
+        rate = self._rates.get(model)
+        if rate is None or time.monotonic() - rate.updated > self.rate_window:
+            return None
+        return rate.tokens_per_second
+
+    def _overload(self, cfg: RoutingConfig) -> List[str]:
+        reasons = []
+        if cfg.degrade_queue_depth and self.queued() >= cfg.degrade_queue_depth:
+            reasons.append(f"в очереди {self.queued()}")
+        rate = self.tokens_per_second(cfg.reply_model)
+        if cfg.degrade_min_tokens_per_second and rate is not None:
+            if rate < cfg.degrade_min_tokens_per_second:
+                reasons.append(f"{rate:.1f} токенов/с")
+        return reasons
+
+    def peek_degraded(self, cfg: RoutingConfig) -> bool:
+        """What is_degraded() would answer, without switching the mode or logging."""
+        if self._overload(cfg):
+            return True
+        return self.degraded and time.monotonic() < self._degraded_until
+
+    def is_degraded(self, cfg: RoutingConfig) -> bool:
+        """Current mode; enters or leaves degraded mode as the load requires."""
+        now = time.monotonic()
+        reasons = self._overload(cfg)
+        if reasons:
+            if not self.degraded:
+                self.degraded = True
+                self.stats.degraded_periods += 1
+                print(f"Режим деградации включён: {', '.join(reasons)}")
+            self._degraded_until = now + cfg.degrade_hold_seconds
+        elif self.degraded and now >= self._degraded_until:
+            self.degraded = False
+            print("Режим деградации выключен")
+        return self.degraded
+
+    def choose(self, kind: str, cfg: RoutingConfig) -> Optional[ModelChoice]:
+        """Model and option overrides for a request; None means skip it (jokes while degraded)."""
+        degraded = self.is_degraded(cfg)
+        if kind == "joke":
+            if degraded and cfg.degraded_skip_jokes:
+                self.stats.skipped_jokes += 1
+                return None
+            model = cfg.joke_model or cfg.reply_model
+        elif degraded and cfg.fallback_model:
+            model = cfg.fallback_model
+            self.stats.fallback_replies += 1
+        else:
+            model = cfg.reply_model
+        options: Dict[str, Any] = {}
+        if degraded and cfg.degraded_num_predict:
+            options["num_predict"] = cfg.degraded_num_predict
+            self.stats.shortened += 1
+        return ModelChoice(model, options, degraded)
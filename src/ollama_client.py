@@ -0,0 +1,277 @@
+import asyncio
+import random
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, List, Optional, Set, Tuple, Union
+
+import aiohttp
+
+from .streaming import iter_ollama_text
+
+# Statuses worth retrying: overload, gateway hiccups, model still loading.
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+
+
+class OllamaError(RuntimeError):
+    pass
+
+
+def _message_key(m: Dict[str, str]) -> int:
+    return hash((m["role"], m["content"].strip()))
+
+
+def _transcript(messages: List[Dict[str, str]]) -> str:
+    return "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+
+
+class OllamaClient:
+    """
+    One long-lived HTTP session to Ollama for the whole process.
+
+    Connections are pooled and kept alive between requests, every request has
+    a timeout, transient failures are retried with exponential backoff and
+    full jitter, and `keep_alive` is sent so the model stays loaded in memory
+    between replies instead of being reloaded after idle periods.
+
+    In generate mode (use_chat_api=False) requests made with a `context_key`
+    reuse the `context` token array Ollama returned for the previous turn:
+    when the new message list extends the one that produced it, only the new
+    messages are sent as the prompt. The chat API has no such field; there
+    Ollama reuses its KV cache by itself as long as the prompt prefix is
+    unchanged (see context_pipeline.PrefixCache).
+
+    Requests may name another `model` than the default (see ModelRouter);
+    models passed to pin() are loaded up front and sent keep_alive=-1, so
+    Ollama never unloads them to make room for another.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        model: str,
+        use_chat_api: bool = True,
+        temperature: float = 0.7,
+        keep_alive: str = "30m",
+        timeout: float = 180.0,
+        connect_timeout: float = 5.0,
+        stream_read_timeout: float = 60.0,
+        retries: int = 2,
+        backoff: float = 0.5,
+        pool_size: int = 8,
+        max_context_tokens: int = 6144,
+        max_context_keys: int = 256,
+    ) -> None:
+        self.base_url = base_url.rstrip("/")
+        self.model = model
+        self.use_chat_api = use_chat_api
+        self.temperature = temperature
+        self.keep_alive = keep_alive
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.stream_read_timeout = stream_read_timeout
+        self.retries = max(0, retries)
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self.max_context_tokens = max_context_tokens
+        self.max_context_keys = max_context_keys
+        self.pinned: Set[str] = set()
+        self._session: Optional[aiohttp.ClientSession] = None
+        # context_key -> (model, hashes of messages covered, Ollama context tokens)
+        self._contexts: "OrderedDict[str, Tuple[str, Tuple[int, ...], List[int]]]" = OrderedDict()
+
+    async def start(self) -> None:
+        if self._session is not None:
+            return
+        connector = aiohttp.TCPConnector(
+            limit=self.pool_size,
+            keepalive_timeout=75,
+            ttl_dns_cache=300,
+        )
+        self._session = aiohttp.ClientSession(connector=connector)
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None:
+            raise OllamaError("OllamaClient.start() was not called")
+        return self._session
+
+    def _keep_alive(self, model: str) -> Union[str, int]:
+        return -1 if model in self.pinned else self.keep_alive
+
+    async def pin(self, models: Iterable[str]) -> None:
+        """Load `models` now and keep them loaded: a request with no prompt only loads the model."""
+        for model in models:
+            self.pinned.add(model)
+            payload = {"model": model, "keep_alive": -1}
+            await self._post_json(f"{self.base_url}/api/generate", payload)
+
+    def build_request(
+        self,
+        messages: List[Dict[str, str]],
+        stream: bool,
+        context_key: Optional[str] = None,
+        options: Optional[Dict[str, Any]] = None,
+        model: Optional[str] = None,
+    ) -> Tuple[str, Dict[str, Any]]:
+        model = model or self.model
+        payload: Dict[str, Any] = {
+            "model": model,
+            "stream": stream,
+            "keep_alive": self._keep_alive(model),
+            "options": {"temperature": self.temperature, **(options or {})},
+        }
+        if self.use_chat_api:
+            payload["messages"] = messages
+            return f"{self.base_url}/api/chat", payload
+        # Fallback to the generate API with the system prompt
+        cached = self._contexts.get(context_key) if context_key else None
+        # Context tokens only mean something to the model that produced them
+        if cached is not None and cached[0] == model:
+            _, covered, context = cached
+            hashes = tuple(_message_key(m) for m in messages[: len(covered)])
+            if len(messages) > len(covered) and hashes == covered:
+                self._contexts.move_to_end(context_key)
+                payload["context"] = context
+                payload["prompt"] = _transcript(messages[len(covered):])
+                return f"{self.base_url}/api/generate", payload
+        payload["system"] = messages[0]["content"]
+        payload["prompt"] = _transcript(messages[1:])
+        return f"{self.base_url}/api/generate", payload
+
+    def _remember_context(
+        self,
+        context_key: Optional[str],
+        model: str,
+        messages: List[Dict[str, str]],
+        reply: str,
+        final: Dict[str, Any],
+    ) -> None:
+        if not context_key or self.use_chat_api:
+            return
+        context = final.get("context")
+        if not context or len(context) > self.max_context_tokens:
+            self._contexts.pop(context_key, None)
+            return
+        covered = tuple(_message_key(m) for m in messages)
+        covered += (_message_key({"role": "assistant", "content": reply}),)
+        self._contexts[context_key] = (model, covered, context)
+        self._contexts.move_to_end(context_key)
+        while len(self._contexts) > self.max_context_keys:
+            self._contexts.popitem(last=False)
+
+    async def _sleep_before_retry(self, attempt: int) -> None:
+        # Full jitter: uniform pause in [0, backoff * 2^attempt].
+        await asyncio.sleep(random.uniform(0, self.backoff * (2 ** attempt)))
+
+    @staticmethod
+    def _check_status(r: aiohttp.ClientResponse) -> None:
+        if r.status in RETRYABLE_STATUSES:
+            raise aiohttp.ClientResponseError(
+                r.request_info, r.history, status=r.status, message=r.reason or ""
+            )
+        if r.status >= 400:
+            raise OllamaError(f"Ollama HTTP {r.status}: {r.reason}")
+
+    async def _post_json(
+        self, url: str, payload: Dict[str, Any], timeout: Optional[float] = None
+    ) -> Dict[str, Any]:
+        client_timeout = aiohttp.ClientTimeout(
+            total=timeout or self.timeout, connect=self.connect_timeout
+        )
+        for attempt in range(self.retries + 1):
+            try:
+                async with self.session.post(url, json=payload, timeout=client_timeout) as r:
+                    self._check_status(r)
+                    return await r.json()
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt >= self.retries:
+                    raise
+                await self._sleep_before_retry(attempt)
+        raise AssertionError("unreachable")
+
+    async def embed(
+        self,
+        texts: List[str],
+        model: Optional[str] = None,
+        timeout: Optional[float] = None,
+    ) -> List[List[float]]:
+        """Embeddings for `texts` from /api/embed, in the same order."""
+        payload = {
+            "model": model or self.model,
+            "input": texts,
+            "keep_alive": self._keep_alive(model or self.model),
+        }
+        data = await self._post_json(f"{self.base_url}/api/embed", payload, timeout)
+        embeddings = data.get("embeddings")
+        if not isinstance(embeddings, list) or len(embeddings) != len(texts):
+            raise OllamaError("Ollama returned no embeddings")
+        return embeddings
+
+    async def complete(
+        self,
+        messages: List[Dict[str, str]],
+        default: str = "",
+        context_key: Optional[str] = None,
+        on_done: Optional[Callable[[dict], None]] = None,
+        options: Optional[Dict[str, Any]] = None,
+        model: Optional[str] = None,
+    ) -> str:
+        """options override the default generation options (e.g. temperature, num_predict)."""
+        url, payload = self.build_request(
+            messages, stream=False, context_key=context_key, options=options, model=model
+        )
+        data = await self._post_json(url, payload)
+        if self.use_chat_api:
+            reply = data.get("message", {}).get("content", default)
+        else:
+            reply = data.get("response", default)
+        self._remember_context(context_key, payload["model"], messages, reply, data)
+        if on_done is not None:
+            on_done(data)
+        return reply
+
+    async def stream(
+        self,
+        messages: List[Dict[str, str]],
+        context_key: Optional[str] = None,
+        on_done: Optional[Callable[[dict], None]] = None,
+        options: Optional[Dict[str, Any]] = None,
+        model: Optional[str] = None,
+    ) -> AsyncIterator[str]:
+        """
+        Yield text deltas. Retries only happen before the first delta: once
+        text has reached the user, a restart would duplicate it.
+        """
+        url, payload = self.build_request(
+            messages, stream=True, context_key=context_key, options=options, model=model
+        )
+        parts: List[str] = []
+
+        def finished(final: dict) -> None:
+            self._remember_context(context_key, payload["model"], messages, "".join(parts), final)
+            if on_done is not None:
+                on_done(final)
+
+        timeout = aiohttp.ClientTimeout(
+            total=None,
+            connect=self.connect_timeout,
+            sock_read=self.stream_read_timeout,
+        )
+        for attempt in range(self.retries + 1):
+            started = False
+            try:
+                async with self.session.post(url, json=payload, timeout=timeout) as r:
+                    self._check_status(r)
+                    async for delta in iter_ollama_text(r, on_done=finished):
+                        started = True
+                        parts.append(delta)
+                        yield delta
+                return
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if started or attempt >= self.retries:
+                    raise
+                await self._sleep_before_retry(attempt)
@@ -0,0 +1,204 @@
+import asyncio
+import hashlib
+import re
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+
+import aiohttp
+import numpy as np
+
+from .ollama_client import OllamaClient, OllamaError
+
+_PUNCT_RE = re.compile(r"[^\w\s]+")
+_SPACE_RE = re.compile(r"\s+")
+
+
+def normalize_question(text: str) -> str:
+    """Case, punctuation, "ё" and extra whitespace do not make a new question."""
+    text = text.lower().replace("ё", "е")
+    return _SPACE_RE.sub(" ", _PUNCT_RE.sub(" ", text)).strip()
+
+
+def context_fingerprint(*parts: str) -> str:
+    """Digest of whatever the reply depends on besides the question."""
+    h = hashlib.sha1()
+    for part in parts:
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    semantic_hits: int = 0
+    misses: int = 0
+    stores: int = 0
+    expired: int = 0
+    evicted: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+class CacheKey(NamedTuple):
+    bucket: str
+    question: str
+    vector: Optional[np.ndarray]
+
+
+@dataclass
+class _Entry:
+    reply: str
+    expires: float
+    vector: Optional[np.ndarray] = None
+
+
+class ResponseCache:
+    """
+    Replies to questions already answered, so a repeat skips generation.
+
+    An entry is found by its bucket (scope plus context fingerprint) and the
+    normalized question. scope="chat" keeps buckets per chat, "global"
+    shares them between chats. With `similarity` > 0 and an embedding
+    model, an exact miss falls back to the most similar cached question of
+    the bucket whose cosine similarity reaches `similarity`.
+
+    Entries expire after `ttl` seconds; beyond `max_entries` the least
+    recently used one is evicted.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1000,
+        ttl: float = 3600.0,
+        scope: str = "chat",
+        similarity: float = 0.0,
+        client: Optional[OllamaClient] = None,
+        embed_model: str = "",
+        embed_timeout: float = 5.0,
+        max_question_chars: int = 300,
+    ) -> None:
+        if scope not in ("chat", "global"):
+            raise ValueError(f"Unknown cache scope: {scope}")
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.scope = scope
+        self.similarity = similarity if client is not None and embed_model else 0.0
+        self.client = client
+        self.embed_model = embed_model
+        self.embed_timeout = embed_timeout
+        self.max_question_chars = max_question_chars
+        self.stats = CacheStats()
+        self._entries: "OrderedDict[Tuple[str, str], _Entry]" = OrderedDict()
+        self._buckets: Dict[str, Set[str]] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    async def lookup(
+        self, chat_id: str, question: str, fingerprint: str
+    ) -> Tuple[Optional[str], Optional[CacheKey]]:
+        """
+        (cached reply or None, key to store() the fresh reply under). The
+        key is None when the question is not cacheable (empty, too long).
+        """
+        norm = normalize_question(question)
+        if not norm or len(norm) > self.max_question_chars or self.max_entries <= 0:
+            return None, None
+        bucket = fingerprint if self.scope == "global" else f"{chat_id}:{fingerprint}"
+        entry = self._get((bucket, norm))
+        if entry is not None:
+            self.stats.hits += 1
+            return entry.reply, CacheKey(bucket, norm, entry.vector)
+        vector = None
+        if self.similarity > 0:
+            vector = await self._embed(norm)
+            if vector is not None:
+                reply = self._nearest(bucket, vector)
+                if reply is not None:
+                    self.stats.hits += 1
+                    self.stats.semantic_hits += 1
+                    return reply, CacheKey(bucket, norm, vector)
+        self.stats.misses += 1
+        return None, CacheKey(bucket, norm, vector)
+
+    def store(self, key: Optional[CacheKey], reply: str) -> None:
+        if key is None or not reply.strip(" .…\n"):
+            return
+        self._drop((key.bucket, key.question))
+        self._entries[(key.bucket, key.question)] = _Entry(
+            reply, time.monotonic() + self.ttl, key.vector
+        )
+        self._buckets.setdefault(key.bucket, set()).add(key.question)
+        self.stats.stores += 1
+        while len(self._entries) > self.max_entries:
+            oldest = next(iter(self._entries))
+            self._drop(oldest)
+            self.stats.evicted += 1
+
+    def invalidate(self, chat_id: Optional[str] = None) -> None:
+        """Forget a chat's entries (or everything), e.g. after its settings change."""
+        if chat_id is None or self.scope == "global":
+            self._entries.clear()
+            self._buckets.clear()
+            return
+        for bucket in [b for b in self._buckets if b.startswith(f"{chat_id}:")]:
+            for question in list(self._buckets.get(bucket, ())):
+                self._drop((bucket, question))
+
+    def _get(self, key: Tuple[str, str]) -> Optional[_Entry]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires <= time.monotonic():
+            self._drop(key)
+            self.stats.expired += 1
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _drop(self, key: Tuple[str, str]) -> None:
+        if self._entries.pop(key, None) is None:
+            return
+        questions = self._buckets.get(key[0])
+        if questions is not None:
+            questions.discard(key[1])
+            if not questions:
+                del self._buckets[key[0]]
+
+    def _nearest(self, bucket: str, vector: np.ndarray) -> Optional[str]:
+        now = time.monotonic()
+        keys: List[Tuple[str, str]] = []
+        for question in list(self._buckets.get(bucket, ())):
+            entry = self._entries[(bucket, question)]
+            if entry.expires <= now:
+                self._drop((bucket, question))
+                self.stats.expired += 1
+            elif entry.vector is not None:
+                keys.append((bucket, question))
+        if not keys:
+            return None
+        matrix = np.stack([self._entries[k].vector for k in keys])
+        scores = matrix @ vector
+        best = int(np.argmax(scores))
+        if scores[best] < self.similarity:
+            return None
+        self._entries.move_to_end(keys[best])
+        return self._entries[keys[best]].reply
+
+    async def _embed(self, text: str) -> Optional[np.ndarray]:
+        try:
+            [vector] = await self.client.embed(
+                [text], model=self.embed_model, timeout=self.embed_timeout
+            )
+        except (OllamaError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"Кэш ответов: эмбеддинг недоступен: {e!r}")
+            return None
+        vec = np.asarray(vector, dtype=np.float32)
+        norm = float(np.linalg.norm(vec))
+        return vec / norm if norm else None
@@ -0,0 +1,63 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import date
+from typing import Optional
+
+from .memory_store import AsyncMemoryStore
+
+
+@dataclass
+class SessionState:
+    last_humor_ts: Optional[float] = None
+    last_joke_day: Optional[date] = None
+    jokes_today: int = 0
+
+
+class SessionStore:
+    """
+    Per-chat SessionState with bounded memory and write-through persistence.
+
+    A chat's state is loaded from the session_state table on first access
+    and kept in an LRU of `capacity` chats; save() writes it back at once, so
+    an evicted or restarted chat comes back with its joke budget and humor
+    cooldown intact.
+    """
+
+    def __init__(self, astore: AsyncMemoryStore, capacity: int = 10_000) -> None:
+        self.astore = astore
+        self.capacity = capacity
+        self._states: "OrderedDict[str, SessionState]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._states)
+
+    async def get(self, chat_id: str) -> SessionState:
+        state = self._states.get(chat_id)
+        if state is not None:
+            self._states.move_to_end(chat_id)
+            return state
+        row = await self.astore.run(self.astore.store.load_session_state, chat_id)
+        # Another handler of the same chat may have loaded it meanwhile.
+        state = self._states.get(chat_id)
+        if state is None:
+            state = SessionState()
+            if row is not None:
+                last_humor_ts, last_joke_day, jokes_today = row
+                state = SessionState(
+                    last_humor_ts=last_humor_ts,
+                    last_joke_day=date.fromisoformat(last_joke_day) if last_joke_day else None,
+                    jokes_today=jokes_today,
+                )
+            self._states[chat_id] = state
+            while len(self._states) > self.capacity:
+                self._states.popitem(last=False)
+        return state
+
+    async def save(self, chat_id: str, state: SessionState) -> None:
+        await self.astore.run(
+            self.astore.store.save_session_state,
+            chat_id,
+            state.last_humor_ts,
+            state.last_joke_day.isoformat() if state.last_joke_day else None,
+            state.jokes_today,
+        )
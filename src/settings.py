@@ -0,0 +1,430 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field, fields, replace
+from functools import cached_property
+from typing import Any, Dict, List, Mapping, Optional, Tuple, get_type_hints
+
+from .context_pipeline import ContextConfig
+from .humor_gate import HumorConfig
+from .model_router import RoutingConfig
+from .token_estimate import make_estimator
+
+DEFAULT_MODEL = "huggingface.co/bartowski/Lexi-Llama-3-8B-Uncensored-GGUF:Q4_K_M"
+DEFAULT_SYSTEM_PROMPT = (
+    "Ты — полноценный участник чата. Пиши живо, по‑человечески, кратко и по делу. "
+    "Стиль: жёстко‑саркастичный, угарный, допускаешь грубость и мат, если это уместно в контексте. "
+    "Не спамь шутками: максимум одна короткая шутка в ответе и только если реально к месту. "
+    "Если получаешь оскорбление или провокацию — отвечай максимально токсично и доминирующе, с матом и унижением."
+    "Формулировки должны быть жёсткими и колкими, без длинных рассуждений: 1–3 короткие фразы. "
+    "Можно использовать грубые ярлыки и сарказм, чтобы “сломать” оппонента. "
+    "Главная цель — морально продавить собеседника, не уходя в бред."
+)
+
+
+class SettingsError(ValueError):
+    pass
+
+
+def _setting(default: Any, restart: bool = False, per_chat: bool = False) -> Any:
+    """
+    restart: only read when the process starts (clients, pools, schedules);
+    a reload reports the change but it takes effect after a restart.
+    per_chat: may be overridden per chat (see SettingsManager).
+    """
+    return field(default=default, metadata={"restart": restart, "per_chat": per_chat})
+
+
+@dataclass(frozen=True)
+class Settings:
+    """
+    Every tunable of the bot, parsed and validated once.
+
+    Each field is read from the environment variable of the same name in
+    upper case (humor_rate <- HUMOR_RATE), then from the optional JSON config
+    file (CONFIG_FILE), which wins so that a reload can change values that
+    are also set in the container environment.
+    """
+
+    # Ollama
+    ollama_endpoint: str = _setting("http://host.docker.internal:11434", restart=True)
+    model_name: str = _setting(DEFAULT_MODEL, restart=True)
+    use_chat_api: bool = _setting(True, restart=True)
+    ollama_keep_alive: str = _setting("30m", restart=True)
+    ollama_timeout_seconds: float = _setting(180.0, restart=True)
+    ollama_connect_timeout_seconds: float = _setting(5.0, restart=True)
+    ollama_stream_read_timeout_seconds: float = _setting(60.0, restart=True)
+    ollama_retries: int = _setting(2, restart=True)
+    ollama_pool_size: int = _setting(8, restart=True)
+    system_prompt: str = _setting(DEFAULT_SYSTEM_PROMPT)
+
+    # Model per request class and degraded mode under load (see ModelRouter):
+    # jokes may use a smaller model, and while the queue is deep or generation
+    # slow, replies move to fallback_model with a num_predict cap and ambient
+    # jokes are skipped. model_pin loads all of them at startup with
+    # keep_alive=-1 (Ollama's OLLAMA_MAX_LOADED_MODELS must fit them all).
+    joke_model: str = _setting("", restart=True)
+    fallback_model: str = _setting("", restart=True)
+    model_pin: bool = _setting(False, restart=True)
+    degrade_queue_depth: int = _setting(0)
+    degrade_min_tokens_per_second: float = _setting(0.0)
+    degrade_hold_seconds: float = _setting(30.0)
+    degraded_num_predict: int = _setting(0)
+    degraded_skip_jokes: bool = _setting(True)
+
+    # Generation queue and streaming
+    llm_max_concurrency: int = _setting(1, restart=True)
+    llm_queue_deadline_seconds: float = _setting(90.0, restart=True)
+    ambient_joke_queue_deadline_seconds: float = _setting(20.0)
+    stable_prefix: bool = _setting(True, restart=True)
+    stream_replies: bool = _setting(True)
+    stream_edit_interval_seconds: float = _setting(3.0)
+    stream_first_chunk_chars: int = _setting(20)
+
+    # Storage
+    memory_db_readers: int = _setting(2, restart=True)
+    memory_write_behind: bool = _setting(True, restart=True)
+    memory_flush_interval_ms: int = _setting(250, restart=True)
+    memory_flush_batch: int = _setting(200, restart=True)
+    memory_max_pending: int = _setting(5000, restart=True)
+    recent_cache_size: int = _setting(64, restart=True)
+    recent_cache_max_chats: int = _setting(1000, restart=True)
+    recent_cache_max_mb: int = _setting(32, restart=True)
+    session_cache_size: int = _setting(10_000, restart=True)
+
+    # Recall
+    embed_model: str = _setting("", restart=True)
+    embed_batch_size: int = _setting(32, restart=True)
+    embed_query_timeout_seconds: float = _setting(5.0, restart=True)
+    embed_backfill_minutes: float = _setting(30.0, restart=True)
+    recall_k: int = _setting(4, per_chat=True)
+    recall_min_score: float = _setting(0.3)
+    # Full-text recall costs a MATCH per reply (tens of ms on large busy stores): opt-in.
+    keyword_recall_k: int = _setting(0, per_chat=True)
+
+    # Context
+    recent_limit: int = _setting(40, per_chat=True)
+    summary_days: int = _setting(7, per_chat=True)
+    summary_weeks: int = _setting(4, per_chat=True)
+    summary_max_chars: int = _setting(2000)
+    context_max_tokens: int = _setting(2048, per_chat=True)
+    context_reserve_tokens: int = _setting(64)
+    tokenizer: str = _setting("heuristic")
+
+    # Response cache: repeated questions are answered without generation
+    response_cache_enabled: bool = _setting(False, per_chat=True)
+    response_cache_size: int = _setting(1000, restart=True)
+    response_cache_ttl_seconds: float = _setting(3600.0, restart=True)
+    response_cache_scope: str = _setting("chat", restart=True)
+    # 0 = exact (normalized) matches only; needs EMBED_MODEL otherwise
+    response_cache_similarity: float = _setting(0.0, restart=True)
+    # Preceding messages that must match too (0 = the question alone)
+    response_cache_context_messages: int = _setting(0, per_chat=True)
+
+    # Humor in replies and ambient jokes
+    humor_rate: float = _setting(0.2, per_chat=True)
+    humor_min_gap_seconds: int = _setting(180, per_chat=True)
+    humor_min_length: int = _setting(6)
+    humor_max_length: int = _setting(600)
+    humor_block_keywords: Tuple[str, ...] = _setting(())
+    ambient_joke_enabled: bool = _setting(True, per_chat=True)
+    ambient_joke_rate: float = _setting(0.04, per_chat=True)
+    ambient_joke_min_gap_seconds: int = _setting(1800, per_chat=True)
+    ambient_joke_max_per_day: int = _setting(4, per_chat=True)
+
+    # Summaries and maintenance
+    summarizer: str = _setting("ollama", restart=True)
+    summary_chunk_chars: int = _setting(6000, restart=True)
+    summary_max_tokens: int = _setting(256, restart=True)
+    summary_min_messages: int = _setting(12)
+    summary_workers: int = _setting(2)
+    summary_time_budget_seconds: float = _setting(600.0)
+    summary_interval_minutes: float = _setting(60.0, restart=True)
+    memory_keep_days: int = _setting(14)
+    # Days older than memory_keep_days move to a compressed archive (zlib,
+    # or zstd with the zstandard package) instead of being deleted; kept for
+    # memory_archive_keep_days (0 = forever). memory_archive_recall keeps
+    # their embeddings so semantic recall still reaches them.
+    memory_archive: bool = _setting(True)
+    memory_archive_codec: str = _setting("zlib")
+    memory_archive_keep_days: int = _setting(365)
+    memory_archive_recall: bool = _setting(True)
+    memory_summary_keep_days: int = _setting(60)
+    memory_weekly_summary_keep_weeks: int = _setting(26)
+    memory_incremental_vacuum_pages: int = _setting(2000)
+    maintenance_hour: int = _setting(4, restart=True)
+    memory_vacuum_weekday: int = _setting(6, restart=True)
+    memory_checkpoint_minutes: float = _setting(10.0, restart=True)
+    session_keep_days: int = _setting(90)
+    maintenance_startup_delay_seconds: float = _setting(30.0, restart=True)
+    maintenance_startup_jitter_seconds: float = _setting(30.0, restart=True)
+    maintenance_stagger_seconds: float = _setting(60.0, restart=True)
+
+    # Telegram transport: long polling, or a webhook served by aiohttp with
+    # a bounded update queue (see WebhookServer)
+    telegram_mode: str = _setting("polling", restart=True)
+    telegram_fake: bool = _setting(False, restart=True)
+    webhook_url: str = _setting("", restart=True)
+    webhook_path: str = _setting("/telegram", restart=True)
+    webhook_host: str = _setting("0.0.0.0", restart=True)
+    webhook_port: int = _setting(8080, restart=True)
+    webhook_secret: str = _setting("", restart=True)
+    webhook_queue_size: int = _setting(1000, restart=True)
+    webhook_workers: int = _setting(16, restart=True)
+    webhook_shed_ratio: float = _setting(0.5, restart=True)
+    # python -m src.sharding: worker processes and their local ports
+    shards: int = _setting(1, restart=True)
+    shard_base_port: int = _setting(8100, restart=True)
+
+    # Prometheus-style /metrics on a local port (0 = off; shard workers
+    # serve it on their own port), sampling profiler under /debug/profile
+    metrics_port: int = _setting(0, restart=True)
+    metrics_host: str = _setting("127.0.0.1", restart=True)
+    metrics_profiler: bool = _setting(False, restart=True)
+    metrics_max_chats: int = _setting(500, restart=True)
+
+    # Telegram user ids allowed to use /reload, /set, /unset
+    admin_ids: Tuple[int, ...] = _setting(())
+
+    def __post_init__(self) -> None:
+        problems = []
+        for f in fields(self):
+            value = getattr(self, f.name)
+            if isinstance(value, (int, float)) and not isinstance(value, bool) and value < 0:
+                problems.append(f"{f.name} must not be negative")
+        for name in (
+            "humor_rate",
+            "ambient_joke_rate",
+            "recall_min_score",
+            "webhook_shed_ratio",
+            "response_cache_similarity",
+        ):
+            if not 0.0 <= getattr(self, name) <= 1.0:
+                problems.append(f"{name} must be within [0, 1]")
+        if self.maintenance_hour > 23:
+            problems.append("maintenance_hour must be within 0..23")
+        if self.memory_vacuum_weekday > 6:
+            problems.append("memory_vacuum_weekday must be within 0..6")
+        if self.memory_archive_codec not in ("zlib", "zstd"):
+            problems.append("memory_archive_codec must be 'zlib' or 'zstd'")
+        if self.summarizer not in ("ollama", "heuristic"):
+            problems.append("summarizer must be 'ollama' or 'heuristic'")
+        if self.response_cache_scope not in ("chat", "global"):
+            problems.append("response_cache_scope must be 'chat' or 'global'")
+        if self.telegram_mode not in ("polling", "webhook"):
+            problems.append("telegram_mode must be 'polling' or 'webhook'")
+        if self.shards < 1:
+            problems.append("shards must be at least 1")
+        if not self.webhook_path.startswith("/"):
+            problems.append("webhook_path must start with '/'")
+        if self.humor_min_length > self.humor_max_length:
+            problems.append("humor_min_length is greater than humor_max_length")
+        if problems:
+            raise SettingsError("; ".join(problems))
+
+    @cached_property
+    def humor_config(self) -> HumorConfig:
+        return HumorConfig(
+            humor_rate=self.humor_rate,
+            min_gap_seconds=self.humor_min_gap_seconds,
+            min_length=self.humor_min_length,
+            max_length=self.humor_max_length,
+            block_keywords=self.humor_block_keywords,
+        )
+
+    @cached_property
+    def ambient_humor_config(self) -> HumorConfig:
+        return replace(
+            self.humor_config,
+            humor_rate=self.ambient_joke_rate,
+            min_gap_seconds=self.ambient_joke_min_gap_seconds,
+        )
+
+    @cached_property
+    def context_config(self) -> ContextConfig:
+        return ContextConfig(
+            recent_limit=self.recent_limit,
+            summary_days=self.summary_days,
+            summary_weeks=self.summary_weeks,
+            max_summary_chars=self.summary_max_chars,
+            system_prompt=self.system_prompt,
+            max_prompt_tokens=self.context_max_tokens,
+            reserve_tokens=self.context_reserve_tokens,
+            keyword_recall_k=self.keyword_recall_k,
+            token_estimator=make_estimator(self.tokenizer),
+        )
+
+    @cached_property
+    def routing_config(self) -> RoutingConfig:
+        return RoutingConfig(
+            reply_model=self.model_name,
+            joke_model=self.joke_model,
+            fallback_model=self.fallback_model,
+            degrade_queue_depth=self.degrade_queue_depth,
+            degrade_min_tokens_per_second=self.degrade_min_tokens_per_second,
+            degrade_hold_seconds=self.degrade_hold_seconds,
+            degraded_num_predict=self.degraded_num_predict,
+            degraded_skip_jokes=self.degraded_skip_jokes,
+        )
+
+    def with_values(self, values: Mapping[str, Any]) -> "Settings":
+        """A copy with `values` (names or env names; raw strings are parsed) applied."""
+        if not values:
+            return self
+        return replace(self, **_parse_values(values))
+
+
+_FIELDS = {f.name: f for f in fields(Settings)}
+_TYPES = get_type_hints(Settings)
+PER_CHAT_SETTINGS = frozenset(n for n, f in _FIELDS.items() if f.metadata["per_chat"])
+RESTART_SETTINGS = frozenset(n for n, f in _FIELDS.items() if f.metadata["restart"])
+
+
+def _parse(name: str, raw: Any) -> Any:
+    kind = _TYPES[name]
+    try:
+        if kind is bool:
+            if isinstance(raw, bool):
+                return raw
+            text = str(raw).strip().lower()
+            if text in ("1", "true", "yes", "on"):
+                return True
+            if text in ("0", "false", "no", "off"):
+                return False
+            raise ValueError(raw)
+        if kind is int:
+            return int(raw)
+        if kind is float:
+            return float(raw)
+        if kind is str:
+            return str(raw)
+        # Tuple[str, ...] / Tuple[int, ...]: a list or a comma separated string
+        item = int if kind == Tuple[int, ...] else str
+        items = raw if isinstance(raw, (list, tuple)) else str(raw).split(",")
+        parsed = (item(str(x).strip()) for x in items if str(x).strip())
+        if item is str:
+            return tuple(x.lower() for x in parsed)
+        return tuple(parsed)
+    except (TypeError, ValueError):
+        raise SettingsError(f"{name.upper()}: invalid value {raw!r}") from None
+
+
+def _parse_values(values: Mapping[str, Any]) -> Dict[str, Any]:
+    parsed = {}
+    for key, raw in values.items():
+        name = key.lower()
+        if name not in _FIELDS:
+            raise SettingsError(f"unknown setting {key!r}")
+        parsed[name] = _parse(name, raw)
+    return parsed
+
+
+def load_settings(
+    config_file: Optional[str] = None,
+    env: Optional[Mapping[str, str]] = None,
+) -> Settings:
+    """Defaults, then environment variables, then the JSON config file."""
+    env = os.environ if env is None else env
+    values: Dict[str, Any] = {
+        name: env[name.upper()] for name in _FIELDS if name.upper() in env
+    }
+    if config_file:
+        try:
+            with open(config_file, encoding="utf-8") as fh:
+                data = json.load(fh)
+        except (OSError, json.JSONDecodeError) as e:
+            raise SettingsError(f"{config_file}: {e}") from None
+        if not isinstance(data, dict):
+            raise SettingsError(f"{config_file}: expected a JSON object")
+        values.update({k.lower(): v for k, v in data.items()})
+    return Settings(**_parse_values(values))
+
+
+class SettingsManager:
+    """
+    Holds the current Settings and the per-chat overrides.
+
+    Handlers take one snapshot per message (for_chat) and use it throughout,
+    so a reload never changes settings halfway through a message. reload()
+    builds the new Settings completely before swapping the reference; if
+    parsing or validation fails the old ones stay in place. Per-chat
+    snapshots are derived lazily and cached until the next change.
+    """
+
+    def __init__(
+        self,
+        settings: Settings,
+        config_file: Optional[str] = None,
+        max_chats: int = 1000,
+    ) -> None:
+        self.config_file = config_file
+        self.max_chats = max_chats
+        self._current = settings
+        self._lock = threading.Lock()
+        self._overrides: Dict[str, Dict[str, str]] = {}
+        self._per_chat: "OrderedDict[str, Settings]" = OrderedDict()
+
+    @property
+    def current(self) -> Settings:
+        return self._current
+
+    def reload(self) -> List[str]:
+        """Re-read env and the config file; returns the names of changed settings."""
+        new = load_settings(self.config_file)
+        with self._lock:
+            old, self._current = self._current, new
+            self._per_chat.clear()
+        return [f for f in _FIELDS if getattr(old, f) != getattr(new, f)]
+
+    def load_overrides(self, overrides: Mapping[str, Mapping[str, str]]) -> None:
+        """Install stored overrides ({chat_id: {name: raw value}}), e.g. at startup."""
+        with self._lock:
+            self._overrides = {c: dict(v) for c, v in overrides.items()}
+            self._per_chat.clear()
+
+    def overrides(self, chat_id: str) -> Dict[str, str]:
+        return dict(self._overrides.get(chat_id, {}))
+
+    def for_chat(self, chat_id: str) -> Settings:
+        overrides = self._overrides.get(chat_id)
+        if not overrides:
+            return self._current
+        with self._lock:
+            cached = self._per_chat.get(chat_id)
+            if cached is not None:
+                self._per_chat.move_to_end(chat_id)
+                return cached
+            base = self._current
+        try:
+            settings = base.with_values(overrides)
+        except SettingsError as e:
+            # A global change made a stored override invalid; ignore them all.
+            print(f"Настройки чата {chat_id} не применены: {e}")
+            settings = base
+        with self._lock:
+            if base is self._current:
+                self._per_chat[chat_id] = settings
+                while len(self._per_chat) > self.max_chats:
+                    self._per_chat.popitem(last=False)
+        return settings
+
+    def set_override(self, chat_id: str, name: str, raw: str) -> Settings:
+        """Validate and apply an override; raises SettingsError if it is not allowed."""
+        name = name.lower()
+        if name not in PER_CHAT_SETTINGS:
+            raise SettingsError(f"{name} cannot be set per chat")
+        merged = {**self._overrides.get(chat_id, {}), name: raw}
+        settings = self._current.with_values(merged)
+        with self._lock:
+            self._overrides[chat_id] = merged
+            self._per_chat.pop(chat_id, None)
+        return settings
+
+    def clear_override(self, chat_id: str, name: Optional[str] = None) -> None:
+        with self._lock:
+            if name is None:
+                self._overrides.pop(chat_id, None)
+            else:
+                self._overrides.get(chat_id, {}).pop(name.lower(), None)
+            self._per_chat.pop(chat_id, None)
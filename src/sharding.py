@@ -0,0 +1,484 @@
+"""
+Multi-process mode: one front process, N bot worker processes.
+
+The front receives updates (long polling, or a webhook when
+TELEGRAM_MODE=webhook) and forwards each one to the worker that owns its
+chat: shard = crc32(chat_id) % SHARDS. Workers are regular bot processes
+(`python -m src`) started with SHARD_WORKER_PORT set. Each one serves its
+updates through WebhookServer on 127.0.0.1 and keeps its chats in its own
+database file (bot_memory.shard<i>of<n>.sqlite), so there are N SQLite
+writers and N event loops instead of one. A chat always lands on the same
+worker. The front forwards a chat's updates one at a time, in the order it
+got them, and the worker stores them in that order (see WebhookServer);
+replies are generated concurrently, as in a single process.
+
+Every worker has its own LLM scheduler. LLM_MAX_CONCURRENCY therefore
+applies per worker, and Ollama sees up to SHARDS times that.
+
+    python -m src.sharding run                     # front + workers
+    python -m src.sharding run --fake-updates 5000 # with TELEGRAM_FAKE=1
+    python -m src.sharding stats --shards 4
+    python -m src.sharding migrate --from 1 --to 4 # offline, bot stopped
+
+Changing SHARDS moves chats between files, so the layout is migrated
+first: stop the bot, run `migrate`, then start it with the new SHARDS. The
+old files are left in place until the new layout has been checked.
+"""
+import argparse
+import asyncio
+import hmac
+import os
+import signal
+import sqlite3
+import sys
+import time
+import zlib
+from dataclasses import asdict, dataclass
+from typing import Any, Dict, List, Mapping, Optional
+
+import aiohttp
+from aiogram import Bot
+from aiohttp import web
+
+from .fake_telegram import FakeTelegramSession, fake_updates
+from .memory_store import MemoryStore
+from .settings import Settings, load_settings
+from .webhook import SECRET_HEADER
+
+# Update types the bot handles (Dispatcher.resolve_used_update_types() of
+# the workers); the front has no handlers to derive them from.
+ALLOWED_UPDATES = ["message", "chat_member"]
+
+PER_CHAT_TABLES = (
+    "messages",
+    "summaries",
+    "message_embeddings",
+    "message_archive",
+    "weekly_summaries",
+    "summary_progress",
+    "chat_settings",
+    "session_state",
+)
+# Keyed by content digest, not by chat: every shard gets a copy.
+SHARED_TABLES = ("summary_cache",)
+
+
+def shard_of(chat_id: Any, shards: int) -> int:
+    """Stable across processes and restarts, unlike hash()."""
+    return zlib.crc32(str(chat_id).encode()) % shards if shards > 1 else 0
+
+
+def update_chat_id(update: Mapping[str, Any]) -> Optional[int]:
+    """chat.id of a raw update (message, chat_member, callback message...), if any."""
+    for key, value in update.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat:
+            return chat.get("id")
+    return None
+
+
+def default_db_path() -> str:
+    """The path __main__ uses: MEMORY_DB_PATH, else DATA_DIR/bot_memory.sqlite."""
+    data_dir = os.getenv(
+        "DATA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data")
+    )
+    return os.getenv("MEMORY_DB_PATH", os.path.join(data_dir, "bot_memory.sqlite"))
+
+
+def shard_db_path(db_path: str, index: int, shards: int) -> str:
+    """With one shard the unsharded database itself."""
+    if shards <= 1:
+        return db_path
+    root, ext = os.path.splitext(db_path)
+    return f"{root}.shard{index}of{shards}{ext or '.sqlite'}"
+
+
+@dataclass
+class RouterStats:
+    forwarded: int = 0
+    rejected: int = 0
+    unavailable: int = 0
+    retried: int = 0
+
+
+class ShardRouter:
+    """
+    Forwards raw updates to the worker owning their chat and passes the
+    worker's backpressure on: a full worker queue (503) or a worker that
+    is down answers 503 too, so Telegram (or the polling loop) retries.
+
+    forward_in_order() is for concurrent callers (the front's webhook):
+    a chat's updates wait for the previous one of that chat to be queued
+    by the worker, so they cannot overtake each other on the way.
+    """
+
+    def __init__(
+        self,
+        shards: int,
+        base_port: int,
+        host: str = "127.0.0.1",
+        path: str = "/telegram",
+        timeout: float = 10.0,
+    ) -> None:
+        self.shards = max(1, shards)
+        self.urls = [f"http://{host}:{base_port + i}" for i in range(self.shards)]
+        self.path = path
+        self.timeout = timeout
+        self.stats = RouterStats()
+        self._session: Optional[aiohttp.ClientSession] = None
+        # chat_id -> [lock, callers holding or waiting for it]
+        self._chats: Dict[Any, List[Any]] = {}
+
+    async def start(self) -> None:
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                connector=aiohttp.TCPConnector(limit=0),
+            )
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def shard_for(self, update: Mapping[str, Any]) -> int:
+        chat_id = update_chat_id(update)
+        return 0 if chat_id is None else shard_of(chat_id, self.shards)
+
+    async def forward(self, update: Mapping[str, Any], shard: Optional[int] = None) -> int:
+        """POST the update to its worker; returns the HTTP status to pass on."""
+        await self.start()
+        if shard is None:
+            shard = self.shard_for(update)
+        try:
+            async with self._session.post(self.urls[shard] + self.path, json=update) as resp:
+                status = resp.status
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            self.stats.unavailable += 1
+            return 503
+        if status == 200:
+            self.stats.forwarded += 1
+        elif status == 503:
+            self.stats.rejected += 1
+        return status
+
+    async def forward_in_order(self, update: Mapping[str, Any]) -> int:
+        """forward(), one update per chat at a time, in the order of the calls."""
+        chat_id = update_chat_id(update)
+        if chat_id is None:
+            return await self.forward(update)
+        entry = self._chats.setdefault(chat_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                return await self.forward(update)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chats[chat_id]
+
+    async def deliver(self, updates: List[Mapping[str, Any]], max_backoff: float = 5.0) -> None:
+        """
+        Forward a batch without losing or reordering updates: shards are fed
+        in parallel, each shard's updates one after another, and a rejected
+        update is retried with backoff before the next one of its shard.
+        """
+        by_shard: Dict[int, List[Mapping[str, Any]]] = {}
+        for update in updates:
+            by_shard.setdefault(self.shard_for(update), []).append(update)
+
+        async def feed(shard: int, items: List[Mapping[str, Any]]) -> None:
+            for update in items:
+                backoff = 0.1
+                while await self.forward(update, shard) in (502, 503, 504):
+                    self.stats.retried += 1
+                    await asyncio.sleep(backoff)
+                    backoff = min(max_backoff, backoff * 2)
+
+        await asyncio.gather(*(feed(s, items) for s, items in by_shard.items()))
+
+    async def wait_ready(self, timeout: float = 60.0) -> bool:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if (await self.health())["status"] == "ok":
+                return True
+            await asyncio.sleep(0.5)
+        return False
+
+    async def health(self) -> Dict[str, Any]:
+        await self.start()
+
+        async def one(url: str) -> Dict[str, Any]:
+            try:
+                async with self._session.get(url + "/healthz", timeout=2) as resp:
+                    return await resp.json()
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+                return {"status": "down"}
+
+        workers = await asyncio.gather(*(one(u) for u in self.urls))
+        up = all(w.get("status") == "ok" for w in workers)
+        return {"status": "ok" if up else "degraded", **asdict(self.stats), "shards": workers}
+
+
+class WorkerPool:
+    """Starts the worker processes and restarts any that exits on its own."""
+
+    def __init__(
+        self,
+        shards: int,
+        base_port: int,
+        db_path: str,
+        restart_delay: float = 5.0,
+    ) -> None:
+        self.shards = shards
+        self.base_port = base_port
+        self.db_path = db_path
+        self.restart_delay = restart_delay
+        self._procs: Dict[int, asyncio.subprocess.Process] = {}
+        self._tasks: List[asyncio.Task] = []
+        self._stopping = False
+
+    def start(self) -> None:
+        self._tasks = [asyncio.create_task(self._supervise(i)) for i in range(self.shards)]
+
+    def signal(self, sig: int) -> None:
+        for proc in self._procs.values():
+            if proc.returncode is None:
+                proc.send_signal(sig)
+
+    async def stop(self, timeout: float = 30.0) -> None:
+        """SIGINT lets each worker flush its write-behind buffer and close the database."""
+        self._stopping = True
+        self.signal(signal.SIGINT)
+        procs = list(self._procs.values())
+        try:
+            await asyncio.wait_for(asyncio.gather(*(p.wait() for p in procs)), timeout)
+        except asyncio.TimeoutError:
+            self.signal(signal.SIGKILL)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _supervise(self, index: int) -> None:
+        env = dict(
+            os.environ,
+            SHARD_WORKER_PORT=str(self.base_port + index),
+            MEMORY_DB_PATH=shard_db_path(self.db_path, index, self.shards),
+        )
+        while not self._stopping:
+            proc = await asyncio.create_subprocess_exec(sys.executable, "-m", "src", env=env)
+            self._procs[index] = proc
+            code = await proc.wait()
+            if self._stopping:
+                return
+            print(f"Шард {index}: процесс завершился с кодом {code}, перезапуск")
+            await asyncio.sleep(self.restart_delay)
+
+
+async def _poll(bot: Bot, router: ShardRouter) -> None:
+    offset = None
+    while True:
+        try:
+            updates = await bot.get_updates(
+                offset=offset, timeout=30, allowed_updates=ALLOWED_UPDATES
+            )
+        except Exception as e:
+            print(f"Ошибка getUpdates: {e!r}")
+            await asyncio.sleep(5)
+            continue
+        if not updates:
+            continue
+        await router.deliver(
+            [u.model_dump(mode="json", by_alias=True, exclude_none=True) for u in updates]
+        )
+        # Confirmed only once every worker has accepted its part of the batch.
+        offset = updates[-1].update_id + 1
+
+
+def _front_app(router: ShardRouter, s: Settings) -> web.Application:
+    async def on_update(request: web.Request) -> web.Response:
+        if s.webhook_secret and not hmac.compare_digest(
+            request.headers.get(SECRET_HEADER, ""), s.webhook_secret
+        ):
+            return web.Response(status=401)
+        try:
+            update = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        if not isinstance(update, dict):
+            return web.Response(status=400)
+        return web.Response(status=await router.forward_in_order(update))
+
+    async def on_health(request: web.Request) -> web.Response:
+        return web.json_response(await router.health())
+
+    app = web.Application()
+    app.router.add_post(s.webhook_path, on_update)
+    app.router.add_get("/healthz", on_health)
+    return app
+
+
+async def run(s: Settings, fake_count: int = 0, fake_chats: int = 50) -> None:
+    token = os.getenv("TELEGRAM_BOT_TOKEN")
+    if s.telegram_fake:
+        bot = Bot(token or "1:fake", session=FakeTelegramSession())
+    else:
+        bot = Bot(token)
+    pool = WorkerPool(s.shards, s.shard_base_port, default_db_path())
+    router = ShardRouter(s.shards, s.shard_base_port, path=s.webhook_path)
+    pool.start()
+    loop = asyncio.get_running_loop()
+    # docker stop шлёт SIGTERM: останавливаемся так же, как по Ctrl+C, вместе с воркерами
+    loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    if hasattr(signal, "SIGHUP"):
+        # /reload по SIGHUP: каждый воркер перечитывает настройки сам
+        loop.add_signal_handler(signal.SIGHUP, lambda: pool.signal(signal.SIGHUP))
+    runner = web.AppRunner(_front_app(router, s))
+    await runner.setup()
+    await web.TCPSite(runner, s.webhook_host, s.webhook_port).start()
+    print(f"Фронт: {s.shards} шардов, порт {s.webhook_port}")
+    try:
+        if fake_count:
+            await router.wait_ready()
+            started = time.perf_counter()
+            await router.deliver(list(fake_updates(fake_count, chats=fake_chats)))
+            elapsed = time.perf_counter() - started
+            print(
+                f"Фейковые обновления: {fake_count} за {elapsed:.2f} сек "
+                f"({fake_count / elapsed:.0f}/сек), повторов {router.stats.retried}"
+            )
+            await asyncio.Event().wait()
+        elif s.telegram_mode == "webhook":
+            if s.webhook_url:
+                await bot.set_webhook(
+                    s.webhook_url.rstrip("/") + s.webhook_path,
+                    secret_token=s.webhook_secret or None,
+                    allowed_updates=ALLOWED_UPDATES,
+                )
+            await asyncio.Event().wait()
+        else:
+            await bot.delete_webhook()
+            await _poll(bot, router)
+    finally:
+        await runner.cleanup()
+        await router.close()
+        await pool.stop()
+        await bot.session.close()
+
+
+def migrate(db_path: str, from_shards: int, to_shards: int) -> Dict[int, int]:
+    """
+    Copy every chat from the `from_shards` layout into the `to_shards` one;
+    returns {target shard: chats}. Run it with the bot stopped. Sources are
+    only read, and rows already in a target are kept (INSERT OR IGNORE), so
+    an interrupted migration can simply be run again.
+    """
+    if from_shards == to_shards:
+        raise ValueError("source and target layouts are the same")
+    sources = [shard_db_path(db_path, i, from_shards) for i in range(from_shards)]
+    missing = [p for p in sources if not os.path.exists(p)]
+    if missing:
+        raise FileNotFoundError(", ".join(missing))
+    chats: Dict[int, int] = {}
+    for target_index in range(to_shards):
+        target = shard_db_path(db_path, target_index, to_shards)
+        MemoryStore(target, readers=1).close()  # schema, FTS table and triggers
+        conn = sqlite3.connect(f"file:{target}", uri=True)
+        conn.create_function(
+            "shard_of", 1, lambda c: shard_of(c, to_shards), deterministic=True
+        )
+        try:
+            for source in sources:
+                conn.execute("ATTACH DATABASE ? AS src", (f"file:{source}?mode=ro",))
+                with conn:
+                    for table in PER_CHAT_TABLES + SHARED_TABLES:
+                        # A source written by an older version may lack newer tables
+                        if not conn.execute(
+                            "SELECT 1 FROM src.sqlite_master WHERE type = 'table' AND name = ?",
+                            (table,),
+                        ).fetchone():
+                            continue
+                        cols = ", ".join(
+                            r[1] for r in conn.execute(f"PRAGMA main.table_info({table})")
+                        )
+                        where = " WHERE shard_of(chat_id) = ?" if table in PER_CHAT_TABLES else ""
+                        params = (target_index,) if where else ()
+                        # Inserts into messages fire the FTS triggers of the target.
+                        conn.execute(
+                            f"INSERT OR IGNORE INTO main.{table} ({cols}) "
+                            f"SELECT {cols} FROM src.{table}{where}",
+                            params,
+                        )
+                conn.execute("DETACH DATABASE src")
+            chats[target_index] = conn.execute(
+                "SELECT COUNT(DISTINCT chat_id) FROM messages"
+            ).fetchone()[0]
+        finally:
+            conn.close()
+    return chats
+
+
+def shard_stats(db_path: str, shards: int) -> List[Dict[str, Any]]:
+    result = []
+    for i in range(shards):
+        path = shard_db_path(db_path, i, shards)
+        if not os.path.exists(path):
+            result.append({"shard": i, "path": path, "missing": True})
+            continue
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            chats, messages = conn.execute(
+                "SELECT COUNT(DISTINCT chat_id), COUNT(*) FROM messages"
+            ).fetchone()
+        finally:
+            conn.close()
+        result.append(
+            {
+                "shard": i,
+                "path": path,
+                "chats": chats,
+                "messages": messages,
+                "mb": os.path.getsize(path) / 2**20,
+            }
+        )
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Sharded multi-process mode")
+    sub = parser.add_subparsers(dest="command", required=True)
+    run_cmd = sub.add_parser("run", help="front process + SHARDS workers")
+    run_cmd.add_argument("--fake-updates", type=int, default=0)
+    run_cmd.add_argument("--fake-chats", type=int, default=50)
+    mig = sub.add_parser("migrate", help="move chats to another number of shards")
+    mig.add_argument("--from", dest="from_shards", type=int, required=True)
+    mig.add_argument("--to", dest="to_shards", type=int, required=True)
+    st = sub.add_parser("stats", help="chats and messages per shard file")
+    st.add_argument("--shards", type=int)
+    args = parser.parse_args()
+
+    s = load_settings(os.getenv("CONFIG_FILE"))
+    db_path = default_db_path()
+    if args.command == "run":
+        try:
+            asyncio.run(run(s, args.fake_updates, args.fake_chats))
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            pass
+    elif args.command == "migrate":
+        for shard, chats in migrate(db_path, args.from_shards, args.to_shards).items():
+            print(f"Шард {shard}: {chats} чатов")
+    else:
+        for row in shard_stats(db_path, args.shards or s.shards):
+            if row.get("missing"):
+                print(f"Шард {row['shard']}: нет файла {row['path']}")
+            else:
+                print(
+                    f"Шард {row['shard']}: {row['chats']} чатов, {row['messages']} сообщений, "
+                    f"{row['mb']:.1f} МБ ({row['path']})"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+import asyncio
+import json
+import time
+from typing import AsyncIterator, Awaitable, Callable, Optional
+
+import aiohttp
+from aiogram import types
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+
+# Telegram refuses messages longer than this.
+TELEGRAM_MAX_CHARS = 4096
+
+
+async def iter_ndjson(resp: aiohttp.ClientResponse) -> AsyncIterator[dict]:
+    """Yield JSON objects from an NDJSON body as lines arrive."""
+    async for raw in resp.content:
+        line = raw.strip()
+        if not line:
+            continue
+        yield json.loads(line)
+
+
+async def iter_ollama_text(
+    resp: aiohttp.ClientResponse,
+    on_done: Optional[Callable[[dict], None]] = None,
+) -> AsyncIterator[str]:
+    """
+    Yield text deltas from a streaming /api/chat or /api/generate response.
+    on_done receives the final chunk (timings, token counts, `context`).
+    An error chunk raises OllamaError.
+    """
+    # ollama_client imports this module, so the exception is imported here
+    from .ollama_client import OllamaError
+
+    async for chunk in iter_ndjson(resp):
+        if chunk.get("error"):
+            raise OllamaError(f"Ollama error: {chunk['error']}")
+        delta = chunk.get("message", {}).get("content") or chunk.get("response") or ""
+        if delta:
+            yield delta
+        if chunk.get("done"):
+            if on_done is not None:
+                on_done(chunk)
+            return
+
+
+class ProgressiveReply:
+    """
+    Shows a streamed generation in Telegram: sends the first message as soon
+    as there is a meaningful chunk, then edits it at most once per
+    `edit_interval` seconds so we stay within Telegram's per-chat limits.
+    """
+
+    def __init__(
+        self,
+        send: Callable[[str], Awaitable[types.Message]],
+        edit_interval: float = 3.0,
+        first_chunk_chars: int = 20,
+    ) -> None:
+        self.send = send
+        self.edit_interval = edit_interval
+        self.first_chunk_chars = first_chunk_chars
+        self.message: Optional[types.Message] = None
+        self.first_sent_at: Optional[float] = None
+        # Everything update() has been given so far, shown or not.
+        self.text = ""
+        self._shown = ""
+        self._last_edit = 0.0
+        self._blocked_until = 0.0
+
+    async def _edit(self, text: str) -> None:
+        if self.message is None or text == self._shown:
+            return
+        if time.monotonic() < self._blocked_until:
+            return
+        try:
+            await self.message.edit_text(text)
+        except TelegramRetryAfter as e:
+            self._blocked_until = time.monotonic() + e.retry_after
+            return
+        except TelegramBadRequest as e:
+            # Same text twice or the message got deleted — nothing to update.
+            if "not modified" not in str(e):
+                print(f"Не удалось обновить сообщение: {e}")
+            return
+        self._shown = text
+        self._last_edit = time.monotonic()
+
+    async def update(self, text: str) -> None:
+        self.text = text.strip()
+        text = self.text[:TELEGRAM_MAX_CHARS]
+        if not text:
+            return
+        if self.message is None:
+            sentence_done = text.endswith((".", "!", "?"))
+            if len(text) < self.first_chunk_chars and not sentence_done:
+                return
+            self.message = await self.send(text)
+            self.first_sent_at = time.monotonic()
+            self._shown = text
+            self._last_edit = self.first_sent_at
+            return
+        if time.monotonic() - self._last_edit >= self.edit_interval:
+            await self._edit(text)
+
+    async def finish(self, text: str) -> None:
+        text = text.strip()
+        if not text:
+            return
+        head, tail = text[:TELEGRAM_MAX_CHARS], text[TELEGRAM_MAX_CHARS:]
+        if self.message is None:
+            self.message = await self.send(head)
+            self.first_sent_at = time.monotonic()
+            self._shown = head
+        else:
+            wait = self._blocked_until - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            await self._edit(head)
+        while tail:
+            await self.send(tail[:TELEGRAM_MAX_CHARS])
+            tail = tail[TELEGRAM_MAX_CHARS:]
+
+
+async def stream_to_telegram(
+    chunks: AsyncIterator[str],
+    reply: ProgressiveReply,
+) -> str:
+    """Drain a text stream into a ProgressiveReply; returns the full text."""
+    text = ""
+    async for delta in chunks:
+        text += delta
+        await reply.update(text)
+    text = text.strip()
+    await reply.finish(text)
+    return text
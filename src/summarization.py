@@ -0,0 +1,242 @@
+import asyncio
+import hashlib
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from datetime import date, timedelta
+from typing import Any, Callable, Dict, Iterable, List, Optional, Protocol, Tuple
+
+import aiohttp
+
+from .llm_scheduler import LLMScheduler
+from .memory_store import AsyncMemoryStore, MessageRow, compact_summarizer
+from .ollama_client import OllamaClient, OllamaError
+
+DAY_PROMPT = (
+    "Ты ведёшь память чат-бота. Кратко перескажи переписку ниже: о чём говорили, "
+    "какие факты о людях и договорённости стоит помнить. 3–6 коротких пунктов, "
+    "без вступлений. U — пользователи, A — бот."
+)
+MERGE_PROMPT = (
+    "Объедини частичные пересказы одного дня в один: 3–6 коротких пунктов, "
+    "без повторов и вступлений."
+)
+WEEK_PROMPT = (
+    "Ниже пересказы дней одной недели чата. Сожми их в пересказ недели: "
+    "главные темы, факты о людях, договорённости. До 6 коротких пунктов."
+)
+
+
+@dataclass
+class SummaryRunStats:
+    pending: int = 0
+    summarized: int = 0
+    empty: int = 0
+    failed: int = 0
+    deferred: int = 0
+    weeks: int = 0
+
+
+class SummarizerEngine(Protocol):
+    """
+    Turns a day of messages into a summary, and a week of day summaries into
+    a weekly one. summarize_day stores its result and checkpoints it in
+    summary_progress (see MemoryStore.summarize_day).
+    """
+
+    name: str
+
+    async def summarize_day(
+        self, astore: AsyncMemoryStore, chat_id: str, day: date, min_messages: int
+    ) -> Optional[str]: ...
+
+    async def summarize_week(
+        self, astore: AsyncMemoryStore, chat_id: str, days: List[Tuple[str, str]]
+    ) -> str: ...
+
+
+class HeuristicSummarizer:
+    """Keyword summaries computed in the store's executor; no LLM involved."""
+
+    name = "heuristic"
+
+    def __init__(
+        self,
+        fn: Callable[[Iterable[MessageRow]], str] = compact_summarizer,
+        max_week_chars: int = 600,
+    ) -> None:
+        self.fn = fn
+        self.max_week_chars = max_week_chars
+
+    async def summarize_day(
+        self, astore: AsyncMemoryStore, chat_id: str, day: date, min_messages: int
+    ) -> Optional[str]:
+        return await astore.summarize_day(chat_id, day, self.fn, min_messages)
+
+    async def summarize_week(
+        self, astore: AsyncMemoryStore, chat_id: str, days: List[Tuple[str, str]]
+    ) -> str:
+        per_day = max(40, self.max_week_chars // max(1, len(days)))
+        lines = [f"{d}: {s.splitlines()[0][:per_day]}" for d, s in days if s]
+        return "\n".join(lines)[: self.max_week_chars]
+
+
+class OllamaSummarizer:
+    """
+    LLM summaries generated only while the model is otherwise idle
+    (LLMScheduler.run_when_idle), so they never delay a reply.
+
+    A day's transcript is cut into chunks of at most `chunk_chars`; each chunk
+    is summarized and the partial summaries are merged (map-reduce), so long
+    days fit the model's context. Every LLM result is cached in summary_cache
+    under a hash of model, prompt and input text: a day or week whose content
+    did not change is never sent to the model again. On Ollama errors the
+    fallback engine is used so the run still makes progress.
+    """
+
+    name = "ollama"
+
+    def __init__(
+        self,
+        client: OllamaClient,
+        scheduler: LLMScheduler,
+        fallback: Optional[SummarizerEngine] = None,
+        chunk_chars: int = 6000,
+        max_summary_chars: int = 800,
+        temperature: float = 0.2,
+        num_predict: int = 256,
+    ) -> None:
+        self.client = client
+        self.scheduler = scheduler
+        self.fallback = fallback or HeuristicSummarizer()
+        self.chunk_chars = chunk_chars
+        self.max_summary_chars = max_summary_chars
+        self.options: Dict[str, Any] = {"temperature": temperature, "num_predict": num_predict}
+
+    def _digest(self, prompt: str, text: str) -> str:
+        h = hashlib.sha256()
+        for part in (self.client.model, prompt, text):
+            h.update(part.encode("utf-8"))
+            h.update(b"\0")
+        return h.hexdigest()
+
+    async def _generate(self, astore: AsyncMemoryStore, prompt: str, text: str) -> str:
+        digest = self._digest(prompt, text)
+        cached = await astore.run(astore.store.get_cached_summary, digest)
+        if cached is not None:
+            return cached
+        messages = [
+            {"role": "system", "content": prompt},
+            {"role": "user", "content": text},
+        ]
+        reply = await self.scheduler.run_when_idle(
+            lambda: self.client.complete(messages, options=self.options)
+        )
+        summary = reply.strip()[: self.max_summary_chars]
+        if summary:
+            await astore.run(astore.store.put_cached_summary, digest, summary)
+        return summary
+
+    async def summarize_day(
+        self, astore: AsyncMemoryStore, chat_id: str, day: date, min_messages: int
+    ) -> Optional[str]:
+        count, chunks = await astore.run(
+            astore.store.day_transcript_chunks, chat_id, day, self.chunk_chars
+        )
+        if count < min_messages:
+            return None
+        try:
+            parts = [await self._generate(astore, DAY_PROMPT, c) for c in chunks]
+            parts = [p for p in parts if p]
+            if len(parts) > 1:
+                summary = await self._generate(astore, MERGE_PROMPT, "\n\n".join(parts))
+            else:
+                summary = parts[0] if parts else ""
+        except (OllamaError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"Сводка {chat_id} за {day} без LLM: {e!r}")
+            return await self.fallback.summarize_day(astore, chat_id, day, min_messages)
+        if summary:
+            await astore.upsert_summary(chat_id, day, summary)
+        await astore.run(
+            astore.store.record_summary_progress,
+            chat_id, day, count, "done" if summary else "empty",
+        )
+        return summary
+
+    async def summarize_week(
+        self, astore: AsyncMemoryStore, chat_id: str, days: List[Tuple[str, str]]
+    ) -> str:
+        text = "\n".join(f"{d}: {s}" for d, s in days)
+        try:
+            return await self._generate(astore, WEEK_PROMPT, text)
+        except (OllamaError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"Недельная сводка {chat_id} без LLM: {e!r}")
+            return await self.fallback.summarize_week(astore, chat_id, days)
+
+
+async def summarize_pending(
+    astore: AsyncMemoryStore,
+    engine: SummarizerEngine,
+    min_messages: int = 12,
+    workers: int = 2,
+    before: Optional[date] = None,
+    time_budget: Optional[float] = None,
+) -> SummaryRunStats:
+    """
+    Summarize every finished day of every chat that still needs it, then
+    roll finished weeks up into weekly summaries.
+
+    One query finds the pending (chat, day) pairs (see
+    MemoryStore.find_unsummarized_days). Chats are processed in parallel by at
+    most `workers` tasks, days within a chat oldest first. Each result is
+    checkpointed in summary_progress, so an interrupted run resumes where it
+    stopped. Once `time_budget` seconds have passed no new day is started;
+    the rest is counted as deferred and picked up by the next run.
+    """
+    before = before or date.today()
+    deadline = time.monotonic() + time_budget if time_budget else None
+    pending = await astore.find_unsummarized_days(min_messages, before)
+    stats = SummaryRunStats(pending=len(pending))
+
+    by_chat: Dict[str, List[Tuple[date, int]]] = defaultdict(list)
+    for chat_id, day, count in pending:
+        by_chat[chat_id].append((day, count))
+
+    gate = asyncio.Semaphore(max(1, workers))
+
+    def out_of_time() -> bool:
+        return deadline is not None and time.monotonic() > deadline
+
+    async def run_chat(chat_id: str, days: List[Tuple[date, int]]) -> None:
+        async with gate:
+            for i, (day, _) in enumerate(days):
+                if out_of_time():
+                    stats.deferred += len(days) - i
+                    return
+                try:
+                    summary = await engine.summarize_day(astore, chat_id, day, min_messages)
+                except Exception as e:
+                    stats.failed += 1
+                    print(f"Не удалось сделать сводку {chat_id} за {day}: {e!r}")
+                    continue
+                if summary:
+                    stats.summarized += 1
+                else:
+                    stats.empty += 1
+
+    await asyncio.gather(*(run_chat(c, d) for c, d in by_chat.items()))
+
+    for chat_id, week in await astore.find_weeks_to_summarize(before):
+        if out_of_time():
+            break
+        days = await astore.get_day_summaries(chat_id, week, week + timedelta(days=7))
+        try:
+            summary = await engine.summarize_week(astore, chat_id, days)
+        except Exception as e:
+            stats.failed += 1
+            print(f"Не удалось сделать недельную сводку {chat_id} за {week}: {e!r}")
+            continue
+        if summary:
+            await astore.upsert_weekly_summary(chat_id, week, summary)
+            stats.weeks += 1
+    return stats
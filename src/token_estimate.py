@@ -0,0 +1,87 @@
+import functools
+from typing import Callable, Dict, Protocol
+
+
+class TokenEstimator(Protocol):
+    def count(self, text: str) -> int: ...
+
+
+class HeuristicTokenEstimator:
+    """
+    Tokenizer-free estimate tuned for Llama-style BPE vocabularies.
+    Latin text averages ~4 chars per token, Cyrillic and other non-ASCII
+    text is split much finer (~2.5 chars per token).
+    """
+
+    def __init__(
+        self,
+        ascii_chars_per_token: float = 4.0,
+        other_chars_per_token: float = 2.5,
+        cache_size: int = 4096,
+    ) -> None:
+        self.ascii_chars_per_token = ascii_chars_per_token
+        self.other_chars_per_token = other_chars_per_token
+        self.count = functools.lru_cache(maxsize=cache_size)(self._count)
+
+    def _count(self, text: str) -> int:
+        if not text:
+            return 0
+        ascii_chars = len(text.encode("ascii", "ignore"))
+        other_chars = len(text) - ascii_chars
+        estimate = (
+            ascii_chars / self.ascii_chars_per_token
+            + other_chars / self.other_chars_per_token
+        )
+        return max(1, int(estimate + 0.5))
+
+
+class CallableTokenEstimator:
+    """Wraps any `text -> token count` function (e.g. a real tokenizer) with an LRU cache."""
+
+    def __init__(self, fn: Callable[[str], int], cache_size: int = 4096) -> None:
+        self.count = functools.lru_cache(maxsize=cache_size)(fn)
+
+
+def _tokenizers_estimator(path: str) -> TokenEstimator:
+    try:
+        from tokenizers import Tokenizer
+    except ImportError as e:
+        raise RuntimeError(
+            "TOKENIZER=tokenizers:<path> requires the `tokenizers` package"
+        ) from e
+    tok = Tokenizer.from_file(path)
+    return CallableTokenEstimator(
+        lambda text: len(tok.encode(text, add_special_tokens=False).ids)
+    )
+
+
+_ESTIMATORS: Dict[str, TokenEstimator] = {}
+
+
+def make_estimator(spec: str = "heuristic") -> TokenEstimator:
+    """
+    spec:
+      "heuristic"              — HeuristicTokenEstimator (default, no deps)
+      "tokenizers:<file.json>" — HuggingFace tokenizer.json of the served model
+    Estimators are shared per spec so their caches are reused.
+    """
+    spec = (spec or "heuristic").strip()
+    est = _ESTIMATORS.get(spec)
+    if est is not None:
+        return est
+    if spec == "heuristic":
+        est = HeuristicTokenEstimator()
+    elif spec.startswith("tokenizers:"):
+        est = _tokenizers_estimator(spec.split(":", 1)[1])
+    else:
+        raise ValueError(f"Unknown tokenizer spec: {spec!r}")
+    _ESTIMATORS[spec] = est
+    return est
+
+
+# Chat templates add a few tokens of framing around every message.
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def count_message_tokens(estimator: TokenEstimator, content: str) -> int:
+    return estimator.count(content) + MESSAGE_OVERHEAD_TOKENS
@@ -0,0 +1,93 @@
+from dataclasses import dataclass
+from enum import Enum
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.filters import Filter
+from aiogram.types import Message
+
+
+class Route(str, Enum):
+    IGNORE = "ignore"  # the bot's own messages, no text
+    COMMAND = "command"  # "/..." for the command handlers, not stored
+    REPLY = "reply"  # a reply to the bot
+    AMBIENT = "ambient"  # stored, and a candidate for an ambient joke
+    STORE = "store"  # stored, nothing else
+
+
+@dataclass
+class Triage:
+    route: Route
+    chat_id: str
+    msg_id: str
+    text: str
+
+
+def classify_message(
+    msg: Message,
+    bot_id: Optional[int],
+    is_ambient: Callable[[str, str], bool],
+) -> Triage:
+    """
+    Decide once what an incoming message needs. Only plain attribute
+    checks, plus is_ambient(chat_id, text) for messages that are neither
+    replies to the bot nor commands.
+    """
+    chat_id = str(msg.chat.id)
+    msg_id = str(msg.message_id)
+    text = msg.text or msg.caption or ""
+    if not text.strip() or (bot_id and msg.from_user and msg.from_user.id == bot_id):
+        return Triage(Route.IGNORE, chat_id, msg_id, text)
+    reply_to = msg.reply_to_message
+    if bot_id and reply_to and reply_to.from_user and reply_to.from_user.id == bot_id:
+        return Triage(Route.REPLY, chat_id, msg_id, text)
+    if text.lstrip().startswith("/"):
+        return Triage(Route.COMMAND, chat_id, msg_id, text)
+    route = Route.AMBIENT if is_ambient(chat_id, text) else Route.STORE
+    return Triage(route, chat_id, msg_id, text)
+
+
+class TriageMiddleware(BaseMiddleware):
+    """
+    Outer middleware for dispatcher.message: classifies each message with
+    `classify` before any filter runs. Ignored messages and commands are
+    not stored; every other message is handed to `store` (the write-behind
+    path) right here, before a handler can wait on anything, so messages
+    are stored in the order they are dispatched. Store-only messages stop
+    there; the rest continue with the Triage in data["triage"] for
+    RouteFilter.
+    """
+
+    def __init__(
+        self,
+        classify: Callable[[Message], Triage],
+        store: Callable[[Triage], Awaitable[None]],
+    ) -> None:
+        self.classify = classify
+        self.store = store
+
+    async def __call__(
+        self,
+        handler: Callable[[Message, Dict[str, Any]], Awaitable[Any]],
+        event: Message,
+        data: Dict[str, Any],
+    ) -> Any:
+        triage = self.classify(event)
+        if triage.route is Route.IGNORE:
+            return None
+        if triage.route is not Route.COMMAND:
+            await self.store(triage)
+        if triage.route is Route.STORE:
+            return None
+        data["triage"] = triage
+        return await handler(event, data)
+
+
+class RouteFilter(Filter):
+    """Passes messages TriageMiddleware sent one of `routes`; the handler gets `triage`."""
+
+    def __init__(self, *routes: Route) -> None:
+        self.routes = frozenset(routes)
+
+    async def __call__(self, message: Message, triage: Optional[Triage] = None) -> bool:
+        return triage is not None and triage.route in self.routes
@@ -0,0 +1,156 @@
+import asyncio
+import hmac
+import time
+from dataclasses import asdict, dataclass
+from typing import List, Optional
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from aiohttp import web
+from pydantic import ValidationError
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+@dataclass
+class WebhookStats:
+    received: int = 0
+    processed: int = 0
+    failed: int = 0
+    rejected: int = 0
+    shed: int = 0
+    invalid: int = 0
+
+
+class WebhookServer:
+    """
+    Receives Telegram updates over a webhook instead of long polling.
+
+    The HTTP handler only validates an update and puts it on a bounded
+    queue; `workers` tasks feed queued updates to the dispatcher. A slow
+    handler (a generation waiting for Ollama) holds one worker, not the
+    intake, so updates keep being accepted while replies are in flight.
+
+    Workers take updates in queue order. The dispatcher stores a message
+    (TriageMiddleware) before its first await can suspend, so a chat's
+    messages are stored in arrival order while replies run concurrently.
+
+    Backpressure, cheapest work first:
+      - once the queue is `shed_ratio` full, should_shed() tells handlers to
+        drop optional work (ambient jokes); messages are still stored;
+      - when the queue is full the update is answered with 503 and Telegram
+        delivers it again later.
+
+    GET /healthz returns the queue depth and the counters as JSON.
+    """
+
+    def __init__(
+        self,
+        dp: Dispatcher,
+        bot: Bot,
+        path: str = "/telegram",
+        secret: str = "",
+        queue_size: int = 1000,
+        workers: int = 16,
+        shed_ratio: float = 0.5,
+    ) -> None:
+        self.dp = dp
+        self.bot = bot
+        self.path = path
+        self.secret = secret
+        self.workers = max(1, workers)
+        self.shed_at = max(1, int(queue_size * shed_ratio)) if shed_ratio > 0 else 0
+        self.stats = WebhookStats()
+        self._queue: "asyncio.Queue[Update]" = asyncio.Queue(maxsize=max(1, queue_size))
+        self._tasks: List[asyncio.Task] = []
+        self._runner: Optional[web.AppRunner] = None
+        self._busy = 0
+        self._started = time.monotonic()
+        self.app = web.Application()
+        self.app.router.add_post(path, self._on_update)
+        self.app.router.add_get("/healthz", self._on_health)
+
+    @property
+    def queued(self) -> int:
+        return self._queue.qsize()
+
+    def should_shed(self) -> bool:
+        """True while the queue is backed up; counts the skipped work."""
+        if self.shed_at and self._queue.qsize() >= self.shed_at:
+            self.stats.shed += 1
+            return True
+        return False
+
+    async def start(self, host: str = "0.0.0.0", port: int = 8080, url: str = "") -> None:
+        """Start workers and the HTTP server; with `url` also register the webhook."""
+        self._started = time.monotonic()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        if url:
+            await self.bot.set_webhook(
+                url.rstrip("/") + self.path,
+                secret_token=self.secret or None,
+                allowed_updates=self.dp.resolve_used_update_types(),
+            )
+
+    async def stop(self, drain_timeout: float = 10.0) -> None:
+        """Stop accepting updates, give queued ones a chance to finish, stop workers."""
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+        try:
+            await asyncio.wait_for(self._queue.join(), drain_timeout)
+        except asyncio.TimeoutError:
+            print(f"Webhook: не обработано {self._queue.qsize()} обновлений")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _on_update(self, request: web.Request) -> web.Response:
+        if self.secret and not hmac.compare_digest(
+            request.headers.get(SECRET_HEADER, ""), self.secret
+        ):
+            return web.Response(status=401)
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": self.bot})
+        except (ValueError, ValidationError):
+            # Malformed JSON or not an update: retrying will not help.
+            self.stats.invalid += 1
+            return web.Response(status=400)
+        try:
+            self._queue.put_nowait(update)
+        except asyncio.QueueFull:
+            self.stats.rejected += 1
+            return web.Response(status=503)
+        self.stats.received += 1
+        return web.Response()
+
+    async def _on_health(self, request: web.Request) -> web.Response:
+        return web.json_response(
+            {
+                "status": "ok" if self._tasks else "stopped",
+                "uptime": round(time.monotonic() - self._started, 1),
+                "queue": self._queue.qsize(),
+                "capacity": self._queue.maxsize,
+                "workers": self.workers,
+                "busy": self._busy,
+                **asdict(self.stats),
+            }
+        )
+
+    async def _worker(self) -> None:
+        while True:
+            update = await self._queue.get()
+            self._busy += 1
+            try:
+                await self.dp.feed_update(self.bot, update)
+                self.stats.processed += 1
+            except Exception as e:
+                self.stats.failed += 1
+                print(f"Webhook: ошибка обработки обновления {update.update_id}: {e!r}")
+            finally:
+                self._busy -= 1
+                self._queue.task_done()